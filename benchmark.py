@@ -0,0 +1,328 @@
+import argparse
+import base64
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+from datetime import date, datetime, timedelta, timezone
+from hashlib import shake_256
+
+from classification import ClassificationTable, PriorProbabilityEstimator
+from ct import CertificateTransparency
+from dataset import Dataset, Key
+from journal import save_json_atomically
+from metrics import Metrics
+from rapid7 import Rapid7
+
+
+class SyntheticData:
+    """Reproducible synthetic inputs of the pipeline
+
+    Every record is a new key or, with probability `duplicate_ratio`, a repetition of an earlier key.
+    A key is derived from its index only, so the generator needs constant memory for any number of
+    records and the same seed always gives the same files.
+    """
+
+    MODULUS_BITS = 2048
+    DEFAULT_EXPONENTS = {65537: 1.0}
+
+    def __init__(self, records, duplicate_ratio=0.1, exponents=None, days=3, seed=1):
+        """
+        :param records:         Number of records
+        :param duplicate_ratio: Probability that a record repeats an earlier key
+        :param exponents:       Dictionary exponent -> weight of exponents of new keys
+        :param days:            Number of days CT timestamps are spread over
+        :param seed:            Seed of the generator
+        """
+        self.records = records
+        self.duplicate_ratio = duplicate_ratio
+        self.exponents = exponents or self.DEFAULT_EXPONENTS
+        self.days = days
+        self.seed = seed
+        self.start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    def key(self, index) -> Key:
+        digest = shake_256(b"%d:%d" % (self.seed, index)).digest(self.MODULUS_BITS // 8 + 8)
+        n = int.from_bytes(digest[:self.MODULUS_BITS // 8], "big")
+        n |= (1 << (self.MODULUS_BITS - 1)) | 1
+        choice = int.from_bytes(digest[-8:], "big") / 2 ** 64 * sum(self.exponents.values())
+        e = list(self.exponents)[-1]
+        for exponent, weight in self.exponents.items():
+            if choice < weight:
+                e = exponent
+                break
+            choice -= weight
+        return Key(["host-%d.example" % index, self.start.strftime("%Y-%m-%d")], n, e)
+
+    def indices(self):
+        """Generate (record number, key index) of all records"""
+        rng = random.Random(self.seed)
+        unique = 0
+        for record in range(self.records):
+            if unique > 0 and rng.random() < self.duplicate_ratio:
+                yield record, rng.randrange(unique)
+            else:
+                yield record, unique
+                unique += 1
+
+    def timestamp(self, record) -> int:
+        """Timestamp in ms of a record, records are spread evenly over the days"""
+        offset = timedelta(days=self.days) * record / max(self.records, 1)
+        return int((self.start + offset).timestamp() * 1000)
+
+    def write_rapid7(self, path):
+        """Lines `name,base64 DER certificate` of a Rapid7 data set"""
+        with open(path, "w") as fp:
+            for record, index in self.indices():
+                key = self.key(index)
+                certificate = SyntheticData.certificate(key.n, key.e, key.source[0], self.start)
+                fp.write("%040x,%s\n" % (record, base64.b64encode(certificate).decode("ascii")))
+
+    def write_ct(self, path):
+        """JSON-lines of keys with `timestamp` as written by the CT download"""
+        with open(path, "w") as fp:
+            for record, index in self.indices():
+                js = json.loads(self.key(index).get_as_string())
+                js["timestamp"] = self.timestamp(record)
+                fp.write(json.dumps(js) + "\n")
+
+    def write_keys(self, path):
+        """JSON-lines of keys with duplicities"""
+        with open(path, "w") as fp:
+            for _, index in self.indices():
+                fp.write(self.key(index).get_as_string() + "\n")
+
+    @staticmethod
+    def der(tag, content: bytes) -> bytes:
+        length = len(content)
+        if length < 0x80:
+            return bytes([tag, length]) + content
+        size = (length.bit_length() + 7) // 8
+        return bytes([tag, 0x80 | size]) + length.to_bytes(size, "big") + content
+
+    @staticmethod
+    def der_integer(value) -> bytes:
+        return SyntheticData.der(0x02, value.to_bytes(value.bit_length() // 8 + 1, "big"))
+
+    @staticmethod
+    def der_name(common_name) -> bytes:
+        attribute = SyntheticData.der(0x30, SyntheticData.der(0x06, bytes.fromhex("550403")) +
+                                      SyntheticData.der(0x0c, common_name.encode("UTF-8")))
+        return SyntheticData.der(0x30, SyntheticData.der(0x31, attribute))
+
+    @staticmethod
+    def certificate(n, e, common_name, not_before: datetime) -> bytes:
+        """Unsigned X.509 certificate of an RSA key, the signature is not checked by the converter"""
+        der = SyntheticData.der
+        algorithm = der(0x30, der(0x06, bytes.fromhex("2a864886f70d01010b")) + der(0x05, b""))
+        public_key = der(0x30, SyntheticData.der_integer(n) + SyntheticData.der_integer(e))
+        public_key_info = der(0x30, der(0x30, der(0x06, bytes.fromhex("2a864886f70d010101")) + der(0x05, b"")) +
+                              der(0x03, b"\x00" + public_key))
+        validity = der(0x30, der(0x17, not_before.strftime("%y%m%d%H%M%SZ").encode("ascii")) +
+                       der(0x17, b"491231235959Z"))
+        tbs = der(0x30, der(0xa0, SyntheticData.der_integer(2)) + SyntheticData.der_integer(n & 0xffffffff) +
+                  algorithm + SyntheticData.der_name("Benchmark CA") + validity +
+                  SyntheticData.der_name(common_name) + public_key_info)
+        return der(0x30, tbs + algorithm + der(0x03, b"\x00" + bytes(256)))
+
+
+class Benchmark:
+    """Benchmark of pipeline stages on synthetic inputs
+
+    Every stage runs in its own process, so its peak RSS is not affected by earlier stages. Results are
+    stored by their parameters in a baseline file and compared with the stored baseline of the same
+    parameters.
+    """
+
+    STAGES = ("convert", "bucket", "remove_duplicities", "statistics", "classify")
+
+    def __init__(self, data: SyntheticData, work_path, table_path="classification-table.json", workers=1):
+        """
+        :param data:       Generator of inputs
+        :param work_path:  Directory of generated inputs and outputs, inputs are reused by later runs
+        :param table_path: Path to classification table
+        :param workers:    Number of worker processes of the converter and bucketing
+        """
+        self.data = data
+        self.work_path = work_path
+        self.table_path = table_path
+        self.workers = workers
+        self.input_path = os.path.join(work_path, "inputs-%s" % self.parameters_id())
+
+    def parameters(self) -> dict:
+        return {
+            "records": self.data.records,
+            "duplicate_ratio": self.data.duplicate_ratio,
+            "exponents": {str(e): w for e, w in self.data.exponents.items()},
+            "days": self.data.days,
+            "seed": self.data.seed,
+            "workers": self.workers
+        }
+
+    def parameters_id(self) -> str:
+        parameters = dict(self.parameters())
+        del parameters["workers"]
+        return shake_256(json.dumps(parameters, sort_keys=True).encode("UTF-8")).hexdigest(6)
+
+    def path(self, name):
+        return os.path.join(self.input_path, name)
+
+    def generate(self):
+        """Generate missing input files"""
+        if not os.path.exists(self.input_path):
+            os.makedirs(self.input_path)
+        for name, write in (("rapid7.csv", self.data.write_rapid7), ("ct.json", self.data.write_ct),
+                            ("keys.json", self.data.write_keys)):
+            if not os.path.exists(self.path(name)):
+                print("Generating " + name)
+                write(self.path(name) + ".part")
+                os.replace(self.path(name) + ".part", self.path(name))
+
+    def run(self, stages=None) -> list:
+        """Run stages, each in a new process
+
+        :return: list of dictionaries of measured stages
+        """
+        self.generate()
+        results = []
+        context = multiprocessing.get_context("spawn")
+        for stage in stages or self.STAGES:
+            receiver, sender = context.Pipe(False)
+            process = context.Process(target=self.run_stage, args=(stage, sender))
+            process.start()
+            sender.close()
+            try:
+                results.append(receiver.recv())
+            except EOFError:
+                raise RuntimeError("Benchmark of " + stage + " failed")
+            finally:
+                process.join()
+            print("  %s: %.2f s, %.0f records/s, peak RSS %s" % (
+                stage, results[-1]["wall_time"], results[-1]["records_per_second"],
+                Metrics.format_bytes(results[-1]["peak_rss"])))
+        return results
+
+    def run_stage(self, name, sender):
+        """Measure a stage in a child process and send its dictionary back"""
+        output_path = os.path.join(self.work_path, "output")
+        if os.path.exists(output_path):
+            shutil.rmtree(output_path)
+        os.makedirs(output_path)
+        metrics = Metrics()
+        with metrics.stage(name) as stage:
+            getattr(self, "stage_" + name)(stage, output_path)
+        shutil.rmtree(output_path)
+        sender.send(stage.to_dict())
+
+    def stage_convert(self, stage, output_path):
+        stage.input_bytes = Metrics.path_size(self.path("rapid7.csv"))
+        results = Rapid7.Converter.convert(self.path("rapid7.csv"), os.path.join(output_path, "keys.json"),
+                                           workers=self.workers)
+        stage.records = results["all"]
+        stage.output_bytes = Metrics.path_size(output_path)
+
+    def stage_bucket(self, stage, output_path):
+        temporary_path = os.path.join(output_path, "temporary")
+        days_path = os.path.join(output_path, "days")
+        os.makedirs(temporary_path)
+        os.makedirs(days_path)
+        shutil.copy(self.path("ct.json"), temporary_path)
+        stage.input_bytes = Metrics.path_size(temporary_path)
+        stage.records = CertificateTransparency.process_temporary(temporary_path, days_path, None, self.workers)
+        stage.output_bytes = Metrics.path_size(days_path)
+
+    def stage_remove_duplicities(self, stage, output_path):
+        stage.input_bytes = Metrics.path_size(self.path("keys.json"))
+        stage.records = self.data.records
+        Dataset.remove_duplicities(self.path("keys.json"), os.path.join(output_path, "unique.json"))
+        stage.output_bytes = Metrics.path_size(output_path)
+
+    def stage_statistics(self, stage, output_path):
+        stage.input_bytes = Metrics.path_size(self.path("keys.json"))
+        with open(self.path("keys.json")) as fp:
+            stats = Dataset.statistics(fp)
+        stage.records = stats["keys"]
+
+    def stage_classify(self, stage, output_path):
+        stage.input_bytes = Metrics.path_size(self.path("keys.json"))
+        estimator = PriorProbabilityEstimator(ClassificationTable(self.table_path))
+        with open(self.path("keys.json")) as fp:
+            for k in Dataset.file_keys(fp):
+                estimator.add_key(k)
+                stage.records += 1
+        estimator.save(output_path)
+        stage.output_bytes = Metrics.path_size(output_path)
+
+    def compare(self, baseline_path, results, tolerance=0.1) -> bool:
+        """Compare throughput of results with the baseline of the same parameters
+
+        :return: False if a stage is slower than the baseline by more than tolerance
+        """
+        if not os.path.exists(baseline_path):
+            return True
+        with open(baseline_path) as fp:
+            baseline = json.load(fp).get(self.parameters_id() + "-%d" % self.workers)
+        if baseline is None:
+            return True
+        passed = True
+        previous = {stage["name"]: stage for stage in baseline["stages"]}
+        print("Comparison with baseline of " + baseline["date"] + ":")
+        for stage in results:
+            if stage["name"] not in previous or previous[stage["name"]]["records_per_second"] == 0:
+                continue
+            ratio = stage["records_per_second"] / previous[stage["name"]]["records_per_second"]
+            line = "  %s: %.2fx throughput" % (stage["name"], ratio)
+            if ratio < 1 - tolerance:
+                line += ", regression"
+                passed = False
+            print(line)
+        return passed
+
+    def save_baseline(self, baseline_path, results):
+        baselines = {}
+        if os.path.exists(baseline_path):
+            with open(baseline_path) as fp:
+                baselines = json.load(fp)
+        baselines[self.parameters_id() + "-%d" % self.workers] = {
+            "date": date.today().isoformat(),
+            "parameters": self.parameters(),
+            "stages": results
+        }
+        save_json_atomically(baseline_path, baselines)
+
+
+def parse_exponents(value) -> dict:
+    """Parse exponent mix `65537:0.99,3:0.01`"""
+    exponents = {}
+    for part in value.split(","):
+        exponent, _, weight = part.partition(":")
+        exponents[int(exponent)] = float(weight or 1)
+    return exponents
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of pipeline stages on synthetic inputs")
+    parser.add_argument("-r", "--records", type=float, default=1e4, help="number of records, e.g. 1e6")
+    parser.add_argument("-d", "--duplicates", type=float, default=0.1, help="ratio of duplicate records")
+    parser.add_argument("-e", "--exponents", type=parse_exponents, default="65537:1",
+                        help="mix of exponents, e.g. 65537:0.99,3:0.01")
+    parser.add_argument("--days", type=int, default=3, help="number of days of CT timestamps")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-w", "--workers", type=int, default=1, help="worker processes of parallel stages")
+    parser.add_argument("-s", "--stages", default=",".join(Benchmark.STAGES), help="comma separated stages")
+    parser.add_argument("--work-path", default="temp-benchmark", help="directory of generated inputs")
+    parser.add_argument("--baseline", default="benchmark-baseline.json", help="file of stored baselines")
+    parser.add_argument("--save-baseline", action="store_true", help="store results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed throughput drop")
+    args = parser.parse_args()
+
+    benchmark = Benchmark(SyntheticData(int(args.records), args.duplicates, args.exponents, args.days, args.seed),
+                          args.work_path, workers=args.workers)
+    print("Benchmark of %d records" % int(args.records))
+    results = benchmark.run(args.stages.split(","))
+    passed = benchmark.compare(args.baseline, results, args.tolerance)
+    if args.save_baseline:
+        benchmark.save_baseline(args.baseline, results)
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,482 @@
+import collections
+import functools
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+
+import numpy as np
+
+from journal import save_json_atomically
+
+
+class ClassificationError(Exception):
+    """Classification table has an unsupported format"""
+    pass
+
+
+class KeyBatch:
+    """Moduli and exponents of a chunk of keys packed into little endian uint64 limb arrays"""
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.size = len(keys)
+        self.n = self.pack([k.n for k in keys])
+        self.n_bit_length = self.bit_length(self.n)
+
+    @functools.cached_property
+    def e(self):
+        return self.pack([k.e for k in self.keys])
+
+    @functools.cached_property
+    def e_bit_length(self):
+        return self.bit_length(self.e)
+
+    @staticmethod
+    def pack(values):
+        limbs = max([(v.bit_length() + 63) // 64 for v in values] + [1])
+        data = b"".join(v.to_bytes(limbs * 8, "little") for v in values)
+        return np.frombuffer(data, dtype="<u8").reshape(len(values), limbs)
+
+    @staticmethod
+    def bit_length64(x):
+        """Bit length of every element of uint64 array"""
+        x = x.copy()
+        length = np.zeros(x.shape, dtype=np.int64)
+        for shift in (32, 16, 8, 4, 2, 1):
+            big = x >= (np.uint64(1) << np.uint64(shift))
+            length[big] += shift
+            x[big] >>= np.uint64(shift)
+        return length + (x > 0)
+
+    @staticmethod
+    def bit_length(limbs):
+        rows, columns = limbs.shape
+        nonzero = limbs != 0
+        top = columns - 1 - np.argmax(nonzero[:, ::-1], axis=1)
+        length = top * 64 + KeyBatch.bit_length64(limbs[np.arange(rows), top])
+        return np.where(nonzero.any(axis=1), length, 0)
+
+    @staticmethod
+    def remainder(limbs, divisor):
+        """Remainder of division of every packed value by a small divisor"""
+        base = pow(2, 64, divisor)
+        weights = np.array([pow(base, i, divisor) for i in range(limbs.shape[1])], dtype=np.uint64)
+        parts = (limbs % np.uint64(divisor)) * weights
+        return (parts.sum(axis=1, dtype=np.uint64) % np.uint64(divisor)).astype(np.int64)
+
+    @staticmethod
+    def window(limbs, position, bits):
+        """Bits [position, position + bits) of every packed value, negative position shifts to the left"""
+        rows, columns = limbs.shape
+        index = position // 64
+        offset = (position % 64).astype(np.uint64)
+        padded = np.concatenate([np.zeros((rows, 1), dtype=np.uint64), limbs,
+                                 np.zeros((rows, 1), dtype=np.uint64)], axis=1)
+        low = padded[np.arange(rows), np.clip(index + 1, 0, columns + 1)]
+        high = padded[np.arange(rows), np.clip(index + 2, 0, columns + 1)]
+        value = low >> offset
+        value |= np.where(offset > 0, high << ((np.uint64(64) - offset) % np.uint64(64)), np.uint64(0))
+        return (value & np.uint64((1 << bits) - 1)).astype(np.int64)
+
+
+class Transformation:
+    """One part of identification mask, e.g. remainder of n divided by 3
+
+    Value of a part is an integer digit in range [0, radix), which allows to encode the whole mask
+    as a single integer code.
+    """
+
+    def __init__(self, identification):
+        self.part = identification.get("transform", "").lower()
+        self.transformation_id = identification.get("transformationId")
+        options = identification.get("options", {})
+        if self.part not in ("n", "e", "nblen"):
+            raise ClassificationError("Unsupported transform '" + self.part + "'.")
+
+        if self.transformation_id == "RemainderFromDivision":
+            self.divisor = options["divisor"]
+            self.radix = self.divisor
+        elif self.transformation_id in ("LeastSignificantBits", "MostSignificantBits"):
+            self.bits = options["bits"]
+            self.skip = options.get("skip", 0)
+            if self.bits > 32 or self.skip > 32:
+                raise ClassificationError("Transformation " + self.transformation_id + " supports at most 32 bits.")
+            self.radix = 1 << self.bits
+        else:
+            raise ClassificationError("Unsupported transformation '" + str(self.transformation_id) + "'.")
+
+    def value(self, n, e) -> int:
+        if self.part == "n":
+            value = n
+        elif self.part == "e":
+            value = e
+        else:
+            value = n.bit_length()
+
+        if self.transformation_id == "RemainderFromDivision":
+            return value % self.divisor
+        if self.transformation_id == "LeastSignificantBits":
+            return (value >> self.skip) & (self.radix - 1)
+        shift = value.bit_length() - self.skip - self.bits
+        value = value >> shift if shift >= 0 else value << -shift
+        return value & (self.radix - 1)
+
+    def values(self, batch: KeyBatch):
+        if self.part == "nblen":
+            limbs = batch.n_bit_length.astype(np.uint64).reshape(batch.size, 1)
+            bit_length = KeyBatch.bit_length(limbs)
+        elif self.part == "n":
+            limbs, bit_length = batch.n, batch.n_bit_length
+        else:
+            limbs, bit_length = batch.e, batch.e_bit_length
+
+        if self.transformation_id == "RemainderFromDivision":
+            return KeyBatch.remainder(limbs, self.divisor)
+        if self.transformation_id == "LeastSignificantBits":
+            return KeyBatch.window(limbs, np.full(batch.size, self.skip, dtype=np.int64), self.bits)
+        return KeyBatch.window(limbs, bit_length - self.skip - self.bits, self.bits)
+
+    def format(self, value) -> str:
+        if self.transformation_id == "RemainderFromDivision":
+            return str(value)
+        return format(value, "0" + str(self.bits) + "b")
+
+    def parse(self, string) -> int:
+        if self.transformation_id == "RemainderFromDivision":
+            return int(string)
+        return int(string, 2)
+
+
+class ClassificationTable:
+    """Classification table used for estimation of prior probability of groups of sources
+
+    Sources with mask distributions closer than `maxEuclideanDistance` are grouped together the same way
+    as classify_rsa_key.jar does it, groups are named `Group 1`, `Group 2`, ... by their sorted sources.
+    Masks are encoded as integer codes in mixed radix of their parts, so a batch of keys can be
+    histogrammed by numpy.
+
+    The compiled table (source and group matrices, weights and groups) can be cached as `.npz` file keyed
+    by the hash and date of the JSON table, later runs then skip parsing and grouping.
+    """
+
+    DEFAULT_MAX_EUCLIDEAN_DISTANCE = 0.02
+    DEFAULT_SOURCE_WEIGHT = 1
+    CACHE_PREFIX = "classification-table-"
+
+    def __init__(self, path="classification-table.json", cache_path=None):
+        """
+        :param path:       Path to classification table in JSON
+        :param cache_path: Directory of compiled tables, None for no caching
+        """
+        with open(path, "rb") as fp:
+            raw = fp.read()
+        self.hash = hashlib.sha1(raw).hexdigest()
+        date = re.search(rb'"date"\s*:\s*"([^"]*)"', raw)
+        self.date = date.group(1).decode("UTF-8") if date else None
+
+        cache_file = None
+        if cache_path is not None:
+            cache_file = os.path.join(cache_path, self.CACHE_PREFIX + self.hash[:16] + ".npz")
+        if cache_file is None or not self.load_compiled(cache_file):
+            self.compile(json.loads(raw))
+            if cache_file is not None:
+                self.save_compiled(cache_file)
+
+        self.transformations = [Transformation(identification) for identification in self.identifications]
+        self.code_count = 1
+        for transformation in self.transformations:
+            self.code_count *= transformation.radix
+        self.mask_rows = np.full(self.code_count, -1, dtype=np.int64)
+        for row, mask in enumerate(self.masks):
+            self.mask_rows[self.mask_code(mask)] = row
+        self.group_names = list(self.groups)
+
+    def compile(self, content):
+        self.identifications = content["identifications"]
+        self.max_distance = content.get("groups", {}).get("maxEuclideanDistance",
+                                                          self.DEFAULT_MAX_EUCLIDEAN_DISTANCE)
+        table = content["table"]
+        weights = content.get("weights", {})
+        self.sources = sorted(table)
+        self.masks = sorted({mask for source in table for mask in table[source]})
+        self.source_matrix = np.zeros((len(self.sources), len(self.masks)))
+        mask_index = {mask: index for index, mask in enumerate(self.masks)}
+        for row, source in enumerate(self.sources):
+            for mask, count in table[source].items():
+                self.source_matrix[row, mask_index[mask]] = count
+            self.source_matrix[row] /= self.source_matrix[row].sum()
+        self.source_weights = np.array([weights.get(source, self.DEFAULT_SOURCE_WEIGHT) for source in self.sources],
+                                       dtype=float)
+        self.groups = self.compute_groups()
+        self.matrix = self.compute_group_matrix()
+
+    def save_compiled(self, cache_file):
+        group_of_source = np.zeros(len(self.sources), dtype=np.int64)
+        for index, sources in enumerate(self.groups.values()):
+            for source in sources:
+                group_of_source[self.sources.index(source)] = index
+        temporary = cache_file + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(cache_file) or ".", exist_ok=True)
+            with open(temporary, "wb") as fp:
+                np.savez(fp, hash=self.hash, date=str(self.date), identifications=json.dumps(self.identifications),
+                         max_distance=self.max_distance, sources=np.array(self.sources), masks=np.array(self.masks),
+                         source_matrix=self.source_matrix, source_weights=self.source_weights,
+                         group_names=np.array(list(self.groups)), group_of_source=group_of_source,
+                         matrix=self.matrix)
+            os.replace(temporary, cache_file)
+        except OSError as e:
+            logging.warning("Cannot cache classification table: " + str(e))
+
+    def load_compiled(self, cache_file) -> bool:
+        if not os.path.exists(cache_file):
+            return False
+        try:
+            with np.load(cache_file) as compiled:
+                if str(compiled["hash"]) != self.hash or str(compiled["date"]) != str(self.date):
+                    return False
+                self.identifications = json.loads(str(compiled["identifications"]))
+                self.max_distance = float(compiled["max_distance"])
+                self.sources = [str(source) for source in compiled["sources"]]
+                self.masks = [str(mask) for mask in compiled["masks"]]
+                self.source_matrix = compiled["source_matrix"]
+                self.source_weights = compiled["source_weights"]
+                self.matrix = compiled["matrix"]
+                group_of_source = compiled["group_of_source"]
+                self.groups = collections.OrderedDict(
+                    (str(name), [source for source, group in zip(self.sources, group_of_source) if group == index])
+                    for index, name in enumerate(compiled["group_names"]))
+            return True
+        except (OSError, KeyError, ValueError) as e:
+            logging.warning("Cannot load cached classification table: " + str(e))
+            return False
+
+    def mask(self, n, e) -> str:
+        """Compute identification mask of a key, e.g. `0|1|0|001000`"""
+        return "|".join(transformation.format(transformation.value(n, e))
+                        for transformation in self.transformations)
+
+    def mask_code(self, mask) -> int:
+        code = 0
+        for transformation, part in zip(self.transformations, mask.split("|")):
+            code = code * transformation.radix + transformation.parse(part)
+        return code
+
+    def code_mask(self, code) -> str:
+        parts = []
+        for transformation in reversed(self.transformations):
+            code, value = divmod(code, transformation.radix)
+            parts.append(transformation.format(value))
+        return "|".join(reversed(parts))
+
+    def mask_codes(self, keys):
+        """Compute mask codes of a chunk of keys
+
+        :param keys: List of keys
+        :return: numpy int64 array of mask codes
+        """
+        codes = np.zeros(len(keys), dtype=np.int64)
+        if not keys:
+            return codes
+        batch = KeyBatch(keys)
+        for transformation in self.transformations:
+            codes = codes * transformation.radix + transformation.values(batch)
+        return codes
+
+    def compute_groups(self) -> dict:
+        """Cluster sources by complete linkage until the closest clusters are farther than max distance"""
+        distances = {}
+        for i, x in enumerate(self.sources):
+            for j, y in enumerate(self.sources):
+                distances[x, y] = float(np.linalg.norm(self.source_matrix[i] - self.source_matrix[j]))
+
+        clusters = [[source] for source in self.sources]
+        while len(clusters) > 1:
+            min_distance = None
+            min_pair = None
+            for i in range(len(clusters)):
+                for j in range(i + 1, len(clusters)):
+                    distance = max(distances[x, y] for x in clusters[i] for y in clusters[j])
+                    if min_distance is None or distance < min_distance:
+                        min_distance = distance
+                        min_pair = (i, j)
+            if min_distance > self.max_distance:
+                break
+            i, j = min_pair
+            clusters[i] = sorted(clusters[i] + clusters[j])
+            clusters.pop(j)
+
+        clusters.sort(key=lambda cluster: "[" + ", ".join(cluster) + "]")
+        groups = collections.OrderedDict()
+        for index, cluster in enumerate(clusters):
+            groups["Group " + str(index + 1)] = cluster
+        return groups
+
+    def compute_group_matrix(self):
+        """Matrix of mask probabilities (masks x groups), group is a weighted mean of its sources"""
+        matrix = np.zeros((len(self.masks), len(self.groups)))
+        for index, sources in enumerate(self.groups.values()):
+            rows = [self.sources.index(source) for source in sources]
+            weights = self.source_weights[rows]
+            matrix[:, index] = weights @ self.source_matrix[rows] / weights.sum()
+        return matrix
+
+
+class PriorProbabilityEstimator:
+    """Estimate prior probability of groups from masks of keys in a data set
+
+    Observed mask frequencies are fitted by non-negative least squares to the mask distributions of groups,
+    the output has the same structure as prior_probability.json written by classify_rsa_key.jar.
+    Keys added one by one are buffered and their masks are computed in batches.
+    """
+
+    OUTPUT_FILE = "prior_probability.json"
+    HISTOGRAM_FILE = "mask_histogram.json"
+    BATCH_SIZE = 65536
+
+    def __init__(self, table: ClassificationTable, key_filter=None):
+        """
+        :param table:      Classification table
+        :param key_filter: Callable selecting keys to classify from a batch, e.g. RegistryFilter
+        """
+        self.table = table
+        self.key_filter = key_filter
+        self.counts = np.zeros(table.code_count, dtype=np.int64)
+        self.pending = []
+
+    def add_key(self, key):
+        self.pending.append(key)
+        if len(self.pending) >= self.BATCH_SIZE:
+            self.flush()
+
+    def add_keys(self, keys):
+        if self.key_filter is not None:
+            keys = self.key_filter(keys)
+        self.add_codes(self.table.mask_codes(keys))
+
+    def add_codes(self, codes):
+        """Add keys by their mask codes, e.g. merged from indexes of several days"""
+        self.counts += np.bincount(codes, minlength=self.table.code_count)
+
+    def add_mask(self, mask, count=1):
+        self.counts[self.table.mask_code(mask)] += count
+
+    def flush(self):
+        if self.pending:
+            self.add_keys(self.pending)
+            self.pending = []
+
+    @property
+    def frequencies(self) -> dict:
+        self.flush()
+        frequencies = {self.table.code_mask(int(code)): int(self.counts[code])
+                       for code in np.flatnonzero(self.counts)}
+        return collections.OrderedDict((mask, frequencies[mask]) for mask in sorted(frequencies))
+
+    def compute_prior_probability(self) -> dict:
+        self.flush()
+        known = self.table.mask_rows >= 0
+        observed = np.zeros(len(self.table.masks))
+        np.add.at(observed, self.table.mask_rows[known], self.counts[known])
+        total = observed.sum()
+        if total == 0:
+            parameters = np.full(len(self.table.group_names), 1.0 / len(self.table.group_names))
+        else:
+            parameters = nnls(self.table.matrix, observed / total)
+            if parameters.sum() > 0:
+                parameters = parameters / parameters.sum()
+        return collections.OrderedDict(
+            (group, float(parameters[index])) for index, group in enumerate(self.table.group_names))
+
+    def to_json(self) -> dict:
+        content = collections.OrderedDict()
+        content["probability"] = self.compute_prior_probability()
+        content["frequencies"] = self.frequencies
+        content["groups"] = collections.OrderedDict(self.table.groups)
+        return content
+
+    def save(self, out_path, content=None) -> str:
+        """Save estimation into `out_path/prior_probability.json`
+
+        :param out_path: Directory of the estimation
+        :param content:  Estimation already computed by to_json, computed if None
+        :return: path to the stored estimation
+        """
+        if not os.path.exists(out_path):
+            os.makedirs(out_path)
+        file_path = os.path.join(out_path, self.OUTPUT_FILE)
+        with open(file_path, "w") as fp:
+            json.dump(self.to_json() if content is None else content, fp)
+        return file_path
+
+    def save_histogram(self, out_path, source, period, date) -> str:
+        """Save mask frequencies of a data set into `out_path/mask_histogram.json`
+
+        The histogram identifies the data set and the classification table, so the estimation can be
+        computed again by `from_histogram` with another table using the same masks.
+
+        :param out_path: Directory of the estimation
+        :param source:   CMoCL source, e.g. `ct`
+        :param period:   CMoCL period, e.g. `day`
+        :param date:     Date of the data set in ISO format
+        :return: path to the stored histogram
+        """
+        if not os.path.exists(out_path):
+            os.makedirs(out_path)
+        file_path = os.path.join(out_path, self.HISTOGRAM_FILE)
+        save_json_atomically(file_path, {
+            "source": source,
+            "period": period,
+            "date": date,
+            "table": self.table.hash,
+            "identifications": self.table.identifications,
+            "frequencies": self.frequencies
+        })
+        return file_path
+
+    @staticmethod
+    def from_histogram(table: ClassificationTable, histogram: dict):
+        """Estimator of a stored histogram
+
+        :raise: ClassificationError if masks of the histogram differ from masks of the table
+        """
+        if histogram["identifications"] != table.identifications:
+            raise ClassificationError("Histogram uses different identification masks than the table.")
+        estimator = PriorProbabilityEstimator(table)
+        for mask, count in histogram["frequencies"].items():
+            estimator.add_mask(mask, count)
+        return estimator
+
+
+def nnls(a, b, max_iterations=None):
+    """Solve argmin_x || a x - b || subject to x >= 0 by the Lawson-Hanson active set method"""
+    rows, columns = a.shape
+    if max_iterations is None:
+        max_iterations = 3 * columns
+    tolerance = 10 * np.finfo(float).eps * np.linalg.norm(a, 1) * max(rows, columns)
+    x = np.zeros(columns)
+    passive = np.zeros(columns, dtype=bool)
+    gradient = a.T @ (b - a @ x)
+    iterations = 0
+    while not passive.all() and (gradient[~passive] > tolerance).any():
+        candidate = np.where(~passive, gradient, -math.inf)
+        passive[int(np.argmax(candidate))] = True
+        while True:
+            z = np.zeros(columns)
+            z[passive] = np.linalg.lstsq(a[:, passive], b, rcond=None)[0]
+            if (z[passive] > tolerance).all():
+                break
+            iterations += 1
+            if iterations > max_iterations:
+                return x
+            mask = passive & (z <= tolerance)
+            difference = x[mask] - z[mask]
+            alpha = np.min(np.where(difference > 0, x[mask] / np.where(difference > 0, difference, 1), 0))
+            x = x + alpha * (z - x)
+            passive &= x > tolerance
+        x = z
+        gradient = a.T @ (b - a @ x)
+    return x
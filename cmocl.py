@@ -1,6 +1,8 @@
 import json
 import logging
-import requests
+import time
+
+from session import Session
 
 
 class CMoCLError(Exception):
@@ -16,55 +18,61 @@ class CMoCL:
     PERIOD_MONTH = "month"
     PERIOD_OCCASIONAL = "occasional"
 
-    def __init__(self, url, api_key):
+    DATES_CACHE_TTL = 300
+
+    def __init__(self, url, api_key, session=None):
+        """
+        :param url:     URL of CMoCL API
+        :param api_key: API key for uploading
+        :param session: Shared HTTP session, a new one is created if None
+        """
         self.url = url
         self.api_key = api_key
+        self.session = session if session is not None else Session()
+        self.dates_cache = {}
 
     def entries(self, source, period, date_from, date_to) -> list:
-        response = requests.get(self.url+"/"+source+"/"+period+"/"+date_from+"/"+date_to)
+        response = self.session.get(self.url+"/"+source+"/"+period+"/"+date_from+"/"+date_to)
         if response.ok:
             return response.json()
-        elif response.status_code == 404:
-            return []
-        elif response.status_code == 400:
-            try:
-                content = response.json()
-                message = content["message"]
-                logging.warning("CMoCL GET - "+message)
-            except ValueError:
-                pass
-            return []
-        else:
-            message = str(response.status_code)
-            try:
-                content = response.json()
-                message = content["message"]
-            except ValueError:
-                logging.error("CMoCL GET - An error occurs.")
-            raise CMoCLError("GET An error occurs: "+message)
+        self.check_get_failure(response)
+        return []
 
     def dates(self, source, period) -> list:
-        response = requests.get(self.url+"/"+source+"/"+period)
+        response = self.session.get(self.url+"/"+source+"/"+period)
         if response.ok:
             return response.json()
-        elif response.status_code == 404:
-            return []
-        elif response.status_code == 400:
-            try:
-                content = response.json()
-                message = content["message"]
-                logging.warning("CMoCL GET - "+message)
-            except ValueError:
-                pass
-            return []
-        else:
-            message = str(response.status_code)
-            try:
-                content = response.json()
-                message = content["message"]
-            except ValueError:
-                logging.error("CMoCL GET - An error occurs.")
-            raise CMoCLError("GET An error occurs: "+message)
+        self.check_get_failure(response)
+        return []
+
+    def stored_dates(self, source, period) -> set:
+        """Set of dates stored in CMoCL database, cached for DATES_CACHE_TTL seconds
+
+        :param source:
+        :param period:
+        :return: set of dates in ISO format
+        """
+        cached = self.dates_cache.get((source, period))
+        if cached is not None and time.monotonic() - cached[0] < self.DATES_CACHE_TTL:
+            return cached[1]
+        stored = set(self.dates(source, period))
+        self.dates_cache[(source, period)] = (time.monotonic(), stored)
+        return stored
+
+    def forget_stored_dates(self, source, period):
+        """Drop cached dates, e.g. after records were uploaded by another client"""
+        self.dates_cache.pop((source, period), None)
+
+    def missing(self, source, period, candidate_dates) -> list:
+        """Filter dates without a record in CMoCL database by a single request
+
+        :param source:
+        :param period:
+        :param candidate_dates: Iterable of dates in ISO format
+        :return: list of candidate dates not stored yet, in the given order
+        """
+        stored = self.stored_dates(source, period)
+        return [date for date in candidate_dates if date not in stored]
 
     def exists(self, source, period, date) -> bool:
         """Check if a record already exists in CMoCL database
@@ -74,11 +82,71 @@ class CMoCL:
         :param date:
         :return: True if a record exists, False otherwise
         """
-        response = requests.get(self.url+"/"+source+"/"+period+"/"+date)
+        response = self.session.get(self.url+"/"+source+"/"+period+"/"+date)
         if response.ok:
             return True
-        elif response.status_code == 404:
-            return False
+        self.check_get_failure(response)
+        return False
+
+    def upload(self, source, period, date, file_path=None, estimation=None) -> bool:
+        """Upload estimation to
+
+        :param source:
+        :param period:
+        :param date:
+        :param file_path:  Path to prior_probability.json
+        :param estimation: Already loaded estimation, used instead of file_path
+        :return:
+        """
+        request = self.upload_request(source, period, date, file_path, estimation)
+        response = self.session.post(self.url+"/", json=request,
+                                     headers={"Authorization": "Bearer " + self.api_key})
+        if response.ok:
+            self.forget_stored_dates(source, period)
+            return True
+        return self.check_post_failure(response)
+
+    def replace(self, source, period, date, file_path=None, estimation=None) -> bool:
+        """Replace estimation of an already stored record by PUT request to the record
+
+        :param source:
+        :param period:
+        :param date:
+        :param file_path:  Path to prior_probability.json
+        :param estimation: Already loaded estimation, used instead of file_path
+        :return: True if replaced, False if rejected
+        :raise: CMoCLError also if CMoCL API does not allow to replace records
+        """
+        request = self.upload_request(source, period, date, file_path, estimation)
+        response = self.session.put(self.url+"/"+source+"/"+period+"/"+date, json=request,
+                                    headers={"Authorization": "Bearer " + self.api_key})
+        if response.ok:
+            return True
+        if response.status_code == 405:
+            raise CMoCLError("PUT Replacing of records is not supported by CMoCL API")
+        return self.check_post_failure(response, "PUT")
+
+    @staticmethod
+    def upload_request(source, period, date, file_path=None, estimation=None) -> dict:
+        if estimation is None:
+            with open(file_path) as fp:
+                estimation = json.load(fp)
+        return {
+            "source": source,
+            "period": period,
+            "date": date,
+            "estimation": estimation
+        }
+
+    @staticmethod
+    def check_get_failure(response):
+        """Handle unsuccessful GET response, 400 and 404 mean no data
+
+        :param response: Response with `status_code` and `json()`
+        :raise: CMoCLError for other statuses
+        """
+        if response.status_code == 404:
+            return
         elif response.status_code == 400:
             try:
                 content = response.json()
@@ -86,7 +154,6 @@ class CMoCL:
                 logging.warning("CMoCL GET - "+message)
             except ValueError:
                 pass
-            return False
         else:
             message = str(response.status_code)
             try:
@@ -96,27 +163,16 @@ class CMoCL:
                 logging.error("CMoCL GET - An error occurs.")
             raise CMoCLError("GET An error occurs: "+message)
 
-    def upload(self, source, period, date, file_path) -> bool:
-        """Upload estimation to
+    @staticmethod
+    def check_post_failure(response, method="POST") -> bool:
+        """Handle unsuccessful POST or PUT response
 
-        :param source:
-        :param period:
-        :param date:
-        :param file_path:
-        :return:
+        :param response: Response with `status_code` and `json()`
+        :param method:   Method of the request used in messages
+        :return: False for 400, 403 and 409
+        :raise: CMoCLError for other statuses
         """
-        with open(file_path) as fp:
-            content = json.load(fp)
-        request = {
-            "source": source,
-            "period": period,
-            "date": date,
-            "estimation": content
-        }
-        response = requests.post(self.url+"/", json=request, headers={"Authorization": "Bearer " + self.api_key})
-        if response.ok:
-            return True
-        elif response.status_code == 400 or response.status_code == 403 or response.status_code == 409:
+        if response.status_code == 400 or response.status_code == 403 or response.status_code == 409:
             if response.status_code == 400:
                 head = "Incorrect format of estimation"
             elif response.status_code == 403:
@@ -126,9 +182,9 @@ class CMoCL:
             try:
                 content = response.json()
                 message = content["message"]
-                logging.error("CMoCL POST - "+head+": " + message)
+                logging.error("CMoCL "+method+" - "+head+": " + message)
             except ValueError:
-                logging.error("CMoCL POST - "+head+".")
+                logging.error("CMoCL "+method+" - "+head+".")
             return False
         else:
             message = str(response.status_code)
@@ -136,5 +192,5 @@ class CMoCL:
                 content = response.json()
                 message = content["message"]
             except ValueError:
-                logging.error("CMoCL POST - An error occurs.")
-            raise CMoCLError("POST An error occurs: "+message)
+                logging.error("CMoCL "+method+" - An error occurs.")
+            raise CMoCLError(method+" An error occurs: "+message)
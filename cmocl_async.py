@@ -0,0 +1,98 @@
+import asyncio
+
+import httpx
+
+from cmocl import CMoCL
+
+
+class AsyncCMoCL:
+    """Asynchronous client of CMoCL API with a bounded number of concurrent requests
+
+    Responses are handled the same way as in CMoCL: redirects are followed, statuses below 400 succeed,
+    failed GET requests return no data for 400 and 404, failed uploads return False for 400, 403 and 409
+    and other statuses raise CMoCLError.
+    """
+
+    def __init__(self, url, api_key, concurrency=8, timeout=60, client=None):
+        """
+        :param url:         URL of CMoCL API
+        :param api_key:     API key for uploading
+        :param concurrency: Maximal number of requests in flight
+        :param timeout:     Timeout of a request in seconds
+        :param client:      Shared httpx.AsyncClient, a new one is created if None
+        """
+        self.url = url
+        self.api_key = api_key
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.own_client = client is None
+        self.client = client if client is not None else httpx.AsyncClient(
+            timeout=timeout, limits=httpx.Limits(max_connections=concurrency), follow_redirects=True)
+
+    async def close(self):
+        if self.own_client:
+            await self.client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    @staticmethod
+    def ok(response) -> bool:
+        """Same as `ok` of a requests response"""
+        return response.status_code < 400
+
+    async def get(self, path):
+        async with self.semaphore:
+            return await self.client.get(self.url + path)
+
+    async def entries(self, source, period, date_from, date_to) -> list:
+        response = await self.get("/"+source+"/"+period+"/"+date_from+"/"+date_to)
+        if self.ok(response):
+            return response.json()
+        CMoCL.check_get_failure(response)
+        return []
+
+    async def dates(self, source, period) -> list:
+        response = await self.get("/"+source+"/"+period)
+        if self.ok(response):
+            return response.json()
+        CMoCL.check_get_failure(response)
+        return []
+
+    async def exists(self, source, period, date) -> bool:
+        response = await self.get("/"+source+"/"+period+"/"+date)
+        if self.ok(response):
+            return True
+        CMoCL.check_get_failure(response)
+        return False
+
+    async def upload(self, source, period, date, file_path=None, estimation=None) -> bool:
+        """Upload estimation
+
+        :param source:
+        :param period:
+        :param date:
+        :param file_path:  Path to prior_probability.json
+        :param estimation: Already loaded estimation, used instead of file_path
+        :return: True if uploaded, False if rejected
+        """
+        if estimation is None:
+            request = await asyncio.to_thread(CMoCL.upload_request, source, period, date, file_path)
+        else:
+            request = CMoCL.upload_request(source, period, date, estimation=estimation)
+        async with self.semaphore:
+            response = await self.client.post(self.url+"/", json=request,
+                                              headers={"Authorization": "Bearer " + self.api_key})
+        if self.ok(response):
+            return True
+        return CMoCL.check_post_failure(response)
+
+    async def upload_many(self, uploads) -> list:
+        """Upload several estimations concurrently
+
+        :param uploads: Iterable of dictionaries with keyword arguments of upload
+        :return: list of upload results in the given order, an exception in place of a failed upload
+        """
+        return await asyncio.gather(*[self.upload(**upload) for upload in uploads], return_exceptions=True)
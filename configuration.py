@@ -1,3 +1,4 @@
+import collections
 import json
 import logging
 import os
@@ -6,6 +7,9 @@ import ssl
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from getpass import getpass
+from urllib.parse import urlparse
+
+from journal import save_json_atomically
 
 
 class Configuration:
@@ -24,6 +28,31 @@ class Configuration:
 
     CONF_CT_LOG_URL = "ct-log-url"
     CONF_CT_LAST_ENTRY = "ct-last-entry"
+    CONF_CT_LOGS = "ct-logs"
+    CONF_CT_SHARD_SIZE = "ct-shard-size"
+    CONF_CT_WORKERS = "ct-workers"
+    CONF_CT_RETRIES = "ct-retries"
+    CONF_CT_BATCH_SIZE = "ct-batch-size"
+    CONF_CT_BUCKET_WORKERS = "ct-bucket-workers"
+    CONF_CT_OPEN_FILES = "ct-open-files"
+    CONF_REGISTRY_PATH = "registry-path"
+    CONF_REGISTRY_NEW_ONLY = "registry-new-only"
+
+    CONF_DEDUP_MEMORY_LIMIT = "dedup-memory-limit"
+    CONF_RAPID7_WORKERS = "rapid7-workers"
+    CONF_RAPID7_CHUNK_SIZE = "rapid7-chunk-size"
+    CONF_RAPID7_CONNECTIONS = "rapid7-connections"
+    CONF_RAPID7_DECOMPRESSOR = "rapid7-decompressor"
+
+    CONF_HTTP_RETRIES = "http-retries"
+    CONF_HTTP_BACKOFF = "http-backoff"
+    CONF_HTTP_TIMEOUT = "http-timeout"
+    CONF_CMOCL_UPLOADS = "cmocl-uploads"
+    CONF_CMOCL_REPLACE = "cmocl-replace"
+
+    CONF_DAEMON_RAPID7_INTERVAL = "daemon-rapid7-interval"
+    CONF_DAEMON_CT_INTERVAL = "daemon-ct-interval"
+    CONF_DAEMON_CT_POLL_INTERVAL = "daemon-ct-poll-interval"
     
     def __init__(self):
         self.CONF_path = self.CONFIGURATION_PATH
@@ -39,8 +68,7 @@ class Configuration:
         raise Exception("Cannot load configuration.")
 
     def save_configuration(self):
-        with open(self.CONF_path, "w") as json_file:
-            return json.dump(self.conf, json_file)
+        save_json_atomically(self.CONF_path, self.conf)
 
     def get(self, key):
         if key in self.conf:
@@ -52,8 +80,19 @@ class Configuration:
             return True
         return False
 
-    def update_ct_last_download_entry(self, entry):
-        self.conf[self.CONF_CT_LAST_ENTRY] = entry
+    def get_or_default(self, key, default):
+        if key in self.conf:
+            return self.conf[key]
+        return default
+
+    def update_ct_last_download_entry(self, entry, url=None):
+        """Store the cursor of a CT log, of the single `ct-log-url` log if url is None"""
+        if url is not None and self.CONF_CT_LOGS in self.conf:
+            for log in self.conf[self.CONF_CT_LOGS]:
+                if log["url"] == url:
+                    log["last-entry"] = entry
+        else:
+            self.conf[self.CONF_CT_LAST_ENTRY] = entry
         self.save_configuration()
 
     def get_ct_last_download_entry(self):
@@ -61,6 +100,43 @@ class Configuration:
             return self.conf[self.CONF_CT_LAST_ENTRY]
         return 0
 
+    def get_ct_logs(self) -> list:
+        """Monitored CT logs
+
+        Logs are listed in `ct-logs` as objects with `url`, optional `last-entry` and optional `workers`
+        overriding `ct-workers`. Without `ct-logs`, the single log of `ct-log-url` is monitored.
+
+        :return: list of dictionaries with keys `url`, `last-entry`, `workers` and `single`
+        """
+        workers = int(self.get_or_default(self.CONF_CT_WORKERS, 4))
+        if self.CONF_CT_LOGS not in self.conf:
+            return [{"url": self.get(self.CONF_CT_LOG_URL), "last-entry": self.get_ct_last_download_entry(),
+                     "workers": workers, "single": True}]
+        return [{"url": log["url"], "last-entry": int(log.get("last-entry", 0)),
+                 "workers": int(log.get("workers", workers)), "single": False}
+                for log in self.conf[self.CONF_CT_LOGS]]
+
+    def get_http_pool_size(self, minimum=10) -> int:
+        """Number of connections kept per host, enough for all parallel downloads from one host
+
+        CT logs on the same host share its connections, a Rapid7 data set is downloaded by
+        `rapid7-connections` ranges next to API requests.
+        """
+        sizes = [minimum, int(self.get_or_default(self.CONF_RAPID7_CONNECTIONS, 1)) + 1]
+        if self.exists(self.CONF_CT_LOGS) or self.exists(self.CONF_CT_LOG_URL):
+            hosts = collections.Counter()
+            for log in self.get_ct_logs():
+                url = log["url"] if "://" in log["url"] else "https://" + log["url"]
+                hosts[urlparse(url).netloc] += log["workers"]
+            sizes.extend(hosts.values())
+        return max(sizes)
+
+    def get_dedup_memory_limit(self):
+        """Memory budget of removing duplicities in bytes, None if unlimited"""
+        if self.CONF_DEDUP_MEMORY_LIMIT in self.conf and self.conf[self.CONF_DEDUP_MEMORY_LIMIT]:
+            return int(self.conf[self.CONF_DEDUP_MEMORY_LIMIT]) * 1024 * 1024
+        return None
+
     def send_mail(self, email_text):
         if self.conf[self.CONF_SMTP_HOST]:
             try:
@@ -1,67 +1,519 @@
+import base64
+import collections
 import json
 import logging
-import subprocess
+import os
+import re
+import shutil
+import struct
+from concurrent.futures import ThreadPoolExecutor
 from json import JSONDecodeError
 from os import listdir
 from os.path import isfile, join
 
 from datetime import date
 
+from session import Session
+
+
+class DayWriters:
+    """Buffered append writers of day files with a bounded number of open files
+
+    The least recently used writer is closed when the limit is reached and reopened on its next write.
+    """
+
+    def __init__(self, storage_days, max_open=64, buffer_size=65536):
+        """
+        :param storage_days: Directory of day files
+        :param max_open:     Maximal number of open day files
+        :param buffer_size:  Buffer size of a writer
+        """
+        self.storage_days = storage_days
+        self.max_open = max(1, max_open)
+        self.buffer_size = buffer_size
+        self.opened = collections.OrderedDict()
+
+    def path(self, day):
+        return join(self.storage_days, day + ".json")
+
+    def write(self, day, data):
+        fp = self.opened.get(day)
+        if fp is None:
+            if len(self.opened) >= self.max_open:
+                self.opened.popitem(last=False)[1].close()
+            fp = open(self.path(day), "ab", buffering=self.buffer_size)
+            self.opened[day] = fp
+        else:
+            self.opened.move_to_end(day)
+        fp.write(data)
+
+    def flush(self):
+        for fp in self.opened.values():
+            fp.flush()
+
+    def close(self):
+        while self.opened:
+            self.opened.popitem()[1].close()
+
+
+class CertificateTransparencyError(Exception):
+    """An error occurs"""
+    pass
+
 
 class CertificateTransparency:
+    """RFC 6962 client of a Certificate Transparency log"""
+
+    ENTRY_X509 = 0
+    ENTRY_PRECERT = 1
+    LEAF_HEADER = struct.Struct(">BBQH")
+
+    def __init__(self, url, session=None, batch_size=256):
+        """
+        :param url:        URL of a CT log, https:// is used if the scheme is missing
+        :param session:    Shared HTTP session, a new one is created if None
+        :param batch_size: Number of entries requested by one get-entries request
+        """
+        if "://" not in url:
+            url = "https://" + url
+        self.url = url.rstrip("/") + "/ct/v1/"
+        self.session = session if session is not None else Session()
+        self.batch_size = batch_size
 
-    def __init__(self, url, downloader_path, classifier_path):
-        self.url = url
-        self.downloader_path = downloader_path
-        self.classifier_path = classifier_path
+    CHECKPOINT_LINES = 100000
+    TEMPORARY_NAME = re.compile(r"^(\d+)-(\d+)\.json$")
+    TIMESTAMP_ATTRIBUTE = b'"timestamp":'
+    TIMESTAMP_VALUE = re.compile(rb"\s*(\d+)")
+    # Every UTC offset is a multiple of 15 minutes, all timestamps of a slot are in the same local day
+    DAY_SLOT = 900000
+    DAY_CACHE_SIZE = 100000
+    BUCKETS_SUFFIX = ".days"
 
     @staticmethod
-    def process_temporary(storage_temporary, storage_days):
-        opened_fp = {}
-        for f in listdir(storage_temporary):
+    def process_temporary(storage_temporary, storage_days, journal=None, workers=1, max_open=64):
+        """Append keys of temporary files into day files by their timestamp
+
+        With a journal, bucketing progress is checkpointed and a bucketed temporary file is removed, an
+        interrupted file is resumed from its last checkpoint after the day files it wrote are truncated to
+        their sizes at that checkpoint. Other day files are left untouched, but a day file written by the
+        interrupted file must not be appended to by anyone else before it is resumed.
+
+        With several workers, temporary files are bucketed in parallel into their own directories of day
+        files, which are then appended to day files in the order of temporary files.
+
+        :param storage_temporary: Directory of downloaded files
+        :param storage_days:      Directory of day files
+        :param journal:           Journal of CT ingestion, optional
+        :param workers:           Number of processes bucketing temporary files
+        :param max_open:          Maximal number of open day files of a process
+        :return: number of processed lines
+        """
+        files = []
+        for f in sorted(listdir(storage_temporary)):
             path = join(storage_temporary, f)
-            if isfile(path):
-                with open(path) as fp:
-                    lines = 0
-                    while True:
-                        try:
-                            line = fp.readline()
-                            if not line:
-                                break
-                            js = json.loads(line)
-                            if "timestamp" not in js:
-                                logging.warning(
-                                    "File " + path + " does not contains timestamp attribute in keys. Skipping.")
-                                break
-                            dt_object = date.fromtimestamp(int(js["timestamp"] / 1000))
-                            d = dt_object.strftime('%Y-%m-%d')
-                            if d not in opened_fp:
-                                try:
-                                    opened_fp[d] = open(join(storage_days, d + ".json"), "a")
-                                except IOError as e:
-                                    logging.error("Cannot open file " + path + ": " + e.msg)
-                            if d in opened_fp:
-                                opened_fp[d].write(line)
-                                lines += 1
-                        except UnicodeDecodeError as e:
-                            logging.error("Error with decoding line: " + e.reason)
-                        except JSONDecodeError as e:
-                            logging.error("Error with decoding line: " + e.msg)
+            if not isfile(path) or f.endswith(".part"):
+                continue
+            if journal is not None and journal.is_bucketed(f):
+                CertificateTransparency.remove_temporary(path)
+                journal.forget_bucketed(f)
+                continue
+            files.append(f)
+
+        tasks = []
+        if workers > 1:
+            # Files interrupted during serial bucketing are resumed serially
+            tasks = [f for f in files
+                     if not os.path.isdir(join(storage_temporary, f) + CertificateTransparency.BUCKETS_SUFFIX) and
+                     (journal is None or journal.bucketing_checkpoint(f) is None)]
+
+        writers = DayWriters(storage_days, max_open)
+        pool = None
+        processed = 0
+        try:
+            if tasks:
+                from rapid7 import Rapid7
+                pool = Rapid7.Converter.process_pool(min(workers, len(tasks)))
+                results = pool.imap(CertificateTransparency.bucket_file,
+                                    [(join(storage_temporary, f), max_open) for f in tasks])
+            for f in files:
+                path = join(storage_temporary, f)
+                buckets_path = path + CertificateTransparency.BUCKETS_SUFFIX
+                if f in tasks:
+                    lines = next(results)
+                    processed += lines
+                    print("Processed " + str(lines) + " lines")
+                if os.path.isdir(buckets_path):
+                    writers.flush()
+                    CertificateTransparency.merge_buckets(f, buckets_path, storage_days, journal)
+                else:
+                    lines = CertificateTransparency.process_file(path, storage_days, writers, journal)
+                    processed += lines
                     print("Processed " + str(lines) + " lines")
-        for d in opened_fp:
-            opened_fp[d].close()
-
-    def download(self, index_from, index_to, out_path):
-        ret = subprocess.run(["java", "-jar", self.downloader_path,
-                              "download", self.url, out_path,
-                              str(index_from), str(index_to)],
-                             stdout=subprocess.DEVNULL)
-        return ret.returncode
-
-    def get_log_size(self):
-        proc = subprocess.run(["java", "-jar", self.downloader_path,
-                               "state", self.url],
-                              stdout=subprocess.PIPE)
-        if proc.stdout[0:16] != b'Current treeSize':
+                    writers.flush()
+                if journal is not None:
+                    journal.mark_bucketed(f)
+                    CertificateTransparency.remove_temporary(path)
+                    journal.forget_bucketed(f)
+        finally:
+            if pool is not None:
+                pool.terminate()
+            writers.close()
+        return processed
+
+    @staticmethod
+    def remove_temporary(path):
+        os.remove(path)
+        if os.path.isdir(path + CertificateTransparency.BUCKETS_SUFFIX):
+            shutil.rmtree(path + CertificateTransparency.BUCKETS_SUFFIX)
+
+    @staticmethod
+    def bucket_file(task):
+        """Bucket one temporary file into its own directory of day files, used by a worker process
+
+        :param task: tuple (path of temporary file, maximal number of open day files)
+        :return: number of processed lines
+        """
+        path, max_open = task
+        buckets_path = path + CertificateTransparency.BUCKETS_SUFFIX
+        part_path = buckets_path + ".part"
+        if os.path.exists(part_path):
+            shutil.rmtree(part_path)
+        os.makedirs(part_path)
+        writers = DayWriters(part_path, max_open)
+        try:
+            lines = CertificateTransparency.process_file(path, part_path, writers)
+        finally:
+            writers.close()
+        os.replace(part_path, buckets_path)
+        return lines
+
+    @staticmethod
+    def merge_buckets(name, buckets_path, storage_days, journal=None):
+        """Append day files bucketed from one temporary file to day files
+
+        With a journal, sizes of the merged day files are checkpointed before merging and an interrupted
+        merge is repeated after these day files are truncated to them.
+        """
+        days = sorted(listdir(buckets_path))
+        if journal is not None:
+            checkpoint = journal.bucketing_checkpoint(name)
+            if checkpoint is not None:
+                CertificateTransparency.truncate_days(storage_days, checkpoint[1])
+            else:
+                journal.checkpoint_bucketing(name, 0, CertificateTransparency.day_sizes(
+                    storage_days, [f[:-len(".json")] for f in days if f.endswith(".json")]))
+        for f in days:
+            with open(join(buckets_path, f), "rb") as fp, open(join(storage_days, f), "ab") as fop:
+                shutil.copyfileobj(fp, fop)
+        if journal is None:
+            shutil.rmtree(buckets_path)
+
+    @staticmethod
+    def day_sizes(storage_days, days, writers=None) -> dict:
+        """Sizes of day files including data buffered by writers, 0 for missing files
+
+        :param days: Days whose files are written by a bucketing run
+        """
+        if writers is not None:
+            writers.flush()
+        sizes = {}
+        for day in days:
+            path = join(storage_days, day + ".json")
+            sizes[day] = os.path.getsize(path) if os.path.exists(path) else 0
+        return sizes
+
+    @staticmethod
+    def truncate_days(storage_days, day_sizes):
+        """Roll back lines appended to checkpointed day files after the checkpoint
+
+        Only day files of the checkpoint are touched, they are the only files written by the interrupted
+        bucketing run. Files empty at the checkpoint are removed.
+        """
+        for day, size in day_sizes.items():
+            path = join(storage_days, day + ".json")
+            if not os.path.exists(path):
+                continue
+            if size == 0:
+                os.remove(path)
+            else:
+                os.truncate(path, size)
+
+    @staticmethod
+    def timestamp(line):
+        """Timestamp of a JSON line, the whole record is parsed only if the attribute is not found
+
+        :return: timestamp in milliseconds or None if the record has no timestamp
+        :raise: JSONDecodeError or UnicodeDecodeError for a malformed line
+        """
+        position = line.rfind(CertificateTransparency.TIMESTAMP_ATTRIBUTE)
+        if position >= 0:
+            match = CertificateTransparency.TIMESTAMP_VALUE.match(
+                line, position + len(CertificateTransparency.TIMESTAMP_ATTRIBUTE))
+            if match:
+                return int(match.group(1))
+        js = json.loads(line)
+        if "timestamp" not in js:
             return None
-        return int(proc.stdout[18:])
+        return int(js["timestamp"])
+
+    @staticmethod
+    def day_name(timestamp, cache):
+        """Local date of a timestamp in milliseconds, dates are cached by 15 minute slots"""
+        slot = timestamp // CertificateTransparency.DAY_SLOT
+        d = cache.get(slot)
+        if d is None:
+            if len(cache) >= CertificateTransparency.DAY_CACHE_SIZE:
+                cache.clear()
+            d = date.fromtimestamp(slot * CertificateTransparency.DAY_SLOT // 1000).strftime('%Y-%m-%d')
+            cache[slot] = d
+        return d
+
+    @staticmethod
+    def process_file(path, storage_days, writers, journal=None) -> int:
+        """Append lines of one temporary file to day files
+
+        :param path:         Path of temporary file
+        :param storage_days: Directory of day files
+        :param writers:      DayWriters of storage_days
+        :param journal:      Journal of CT ingestion, optional
+        :return: number of processed lines
+        """
+        name = os.path.basename(path)
+        offset = 0
+        # Days written by this file, a checkpoint records sizes of their files before the first write
+        touched = set()
+        if journal is not None:
+            checkpoint = journal.bucketing_checkpoint(name)
+            if checkpoint is not None:
+                offset, day_sizes = checkpoint
+                writers.close()
+                CertificateTransparency.truncate_days(storage_days, day_sizes)
+                touched.update(day_sizes)
+            else:
+                journal.checkpoint_bucketing(name, 0, {})
+
+        days = {}
+        lines = 0
+        with open(path, "rb") as fp:
+            fp.seek(offset)
+            for line in fp:
+                try:
+                    timestamp = CertificateTransparency.timestamp(line)
+                    if timestamp is None:
+                        logging.warning(
+                            "File " + path + " does not contains timestamp attribute in keys. Skipping.")
+                        break
+                    d = CertificateTransparency.day_name(timestamp, days)
+                    if journal is not None and d not in touched:
+                        touched.add(d)
+                        journal.checkpoint_bucketing(name, fp.tell() - len(line),
+                                                     CertificateTransparency.day_sizes(storage_days, touched, writers))
+                    try:
+                        writers.write(d, line)
+                    except IOError as e:
+                        logging.error("Cannot open file " + writers.path(d) + ": " + str(e))
+                        continue
+                    lines += 1
+                    if journal is not None and lines % CertificateTransparency.CHECKPOINT_LINES == 0:
+                        journal.checkpoint_bucketing(name, fp.tell(),
+                                                     CertificateTransparency.day_sizes(storage_days, touched, writers))
+                except UnicodeDecodeError as e:
+                    logging.error("Error with decoding line: " + e.reason)
+                except JSONDecodeError as e:
+                    logging.error("Error with decoding line: " + e.msg)
+        return lines
+
+    def get_sth(self) -> dict:
+        response = self.session.get(self.url + "get-sth")
+        if not response.ok:
+            raise CertificateTransparencyError("get-sth failed with status " + str(response.status_code))
+        return response.json()
+
+    def get_log_size(self) -> int:
+        return int(self.get_sth()["tree_size"])
+
+    def get_entries(self, start, end) -> list:
+        """Entries from start to end inclusive, a log may return fewer of them
+
+        :return: list of dictionaries with `leaf_input` and `extra_data`
+        """
+        response = self.session.get(self.url + "get-entries", params={"start": start, "end": end})
+        if not response.ok:
+            raise CertificateTransparencyError("get-entries " + str(start) + "-" + str(end) +
+                                               " failed with status " + str(response.status_code))
+        return response.json()["entries"]
+
+    def entries(self, index_from, index_to):
+        """Generate entries of range [index_from, index_to) by requests of batch_size entries"""
+        index = index_from
+        while index < index_to:
+            entries = self.get_entries(index, min(index + self.batch_size, index_to) - 1)
+            if not entries:
+                raise CertificateTransparencyError("No entries returned from " + str(index))
+            for entry in entries[:index_to - index]:
+                yield entry
+            index += len(entries)
+
+    @staticmethod
+    def parse_entry(entry):
+        """Extract timestamp and certificate from an entry
+
+        For a precertificate the whole pre-certificate from extra data is returned,
+        the TBSCertificate in the leaf cannot be parsed as a certificate.
+
+        :param entry: Dictionary with base64 encoded `leaf_input` and `extra_data`
+        :return: tuple (timestamp in milliseconds, DER certificate)
+        """
+        leaf = base64.b64decode(entry["leaf_input"])
+        version, leaf_type, timestamp, entry_type = CertificateTransparency.LEAF_HEADER.unpack_from(leaf)
+        if version != 0 or leaf_type != 0:
+            raise CertificateTransparencyError("Unknown MerkleTreeLeaf version " + str(version))
+        if entry_type == CertificateTransparency.ENTRY_X509:
+            offset = CertificateTransparency.LEAF_HEADER.size
+            certificate = leaf
+        elif entry_type == CertificateTransparency.ENTRY_PRECERT:
+            offset = 0
+            certificate = base64.b64decode(entry["extra_data"])
+        else:
+            raise CertificateTransparencyError("Unknown entry type " + str(entry_type))
+        length = int.from_bytes(certificate[offset:offset + 3], "big")
+        return timestamp, certificate[offset + 3:offset + 3 + length]
+
+    @staticmethod
+    def convert_entry(entry):
+        """Convert an entry to a line of a temporary file
+
+        :return: Key in JSON with `timestamp` attribute or None for non-RSA certificates
+        """
+        from rapid7 import Rapid7
+
+        timestamp, certificate = CertificateTransparency.parse_entry(entry)
+        key = Rapid7.Converter.certificate_key(certificate)
+        if key is None:
+            return None
+        js = json.loads(key.get_as_string(), object_pairs_hook=collections.OrderedDict)
+        js["timestamp"] = timestamp
+        return json.dumps(js)
+
+    def download(self, index_from, index_to, out_path) -> bool:
+        """Download RSA keys of entries [index_from, index_to) into JSON-lines file
+
+        :return: True on success
+        """
+        try:
+            with open(out_path, "w") as fp:
+                for entry in self.entries(index_from, index_to):
+                    try:
+                        line = self.convert_entry(entry)
+                    except Exception as e:
+                        logging.warning("Cannot parse CT entry: " + str(e))
+                        continue
+                    if line is not None:
+                        fp.write(line + "\n")
+        except Exception as e:
+            logging.error("Downloading CT entries " + str(index_from) + "-" + str(index_to) + " failed: " + str(e))
+            return False
+        return True
+
+    @staticmethod
+    def shards(index_from, index_to, shard_size):
+        """Split range into shards aligned to multiples of shard_size
+
+        :return: list of tuples (from, to)
+        """
+        shards = []
+        start = index_from
+        while start < index_to:
+            end = min((start // shard_size + 1) * shard_size, index_to)
+            shards.append((start, end))
+            start = end
+        return shards
+
+    @staticmethod
+    def shard_path(shards_path, shard):
+        return join(shards_path, str(shard[0]) + "-" + str(shard[1]) + ".json")
+
+    def download_shard(self, shard, shards_path, retries):
+        """Download one shard, the file exists only if the download succeeded
+
+        :return: True on success
+        """
+        path = self.shard_path(shards_path, shard)
+        if isfile(path):
+            return True
+        part_path = path + ".part"
+        for attempt in range(retries + 1):
+            if self.download(shard[0], shard[1], part_path):
+                os.replace(part_path, path)
+                return True
+            logging.warning("Downloading CT entries " + str(shard[0]) + "-" + str(shard[1]) +
+                            " failed, attempt " + str(attempt + 1) + ".")
+        if isfile(part_path):
+            os.remove(part_path)
+        return False
+
+    @staticmethod
+    def recover(out_dir, shards_path, index_from, journal):
+        """Record merged files missing in the journal and remove shards already merged
+
+        :return: entry after the last downloaded one contiguous from index_from
+        """
+        for f in listdir(out_dir):
+            match = CertificateTransparency.TEMPORARY_NAME.match(f)
+            if match and not journal.is_bucketed(f):
+                journal.add_range(int(match.group(1)), int(match.group(2)))
+        start = journal.downloaded_until(index_from)
+        for f in listdir(shards_path):
+            match = CertificateTransparency.TEMPORARY_NAME.match(f)
+            if match and int(match.group(2)) <= start:
+                os.remove(join(shards_path, f))
+        return start
+
+    def download_sharded(self, index_from, index_to, out_dir, shards_path, shard_size=100000, workers=4,
+                         retries=2, journal=None):
+        """Download range of entries by several parallel downloads
+
+        Shards are downloaded into their own files and failed shards are retried separately. Contiguous
+        completed shards from the beginning of the range are merged in order into `out_dir/from-to.json`,
+        completed shards after a failed one are kept in `shards_path` and reused by a later call.
+        With a journal, ranges already merged by an interrupted run are skipped.
+
+        :param index_from:  First entry
+        :param index_to:    Entry after the last one
+        :param out_dir:     Directory of merged files
+        :param shards_path: Directory for shard files
+        :param shard_size:  Number of entries of a shard
+        :param workers:     Number of parallel downloads
+        :param retries:     Number of retries of a failed shard
+        :param journal:     Journal of CT ingestion, optional
+        :return: entry after the last downloaded one, index_from if nothing was downloaded
+        """
+        if not os.path.exists(shards_path):
+            os.makedirs(shards_path)
+        if journal is not None:
+            index_from = self.recover(out_dir, shards_path, index_from, journal)
+        shards = self.shards(index_from, index_to, shard_size)
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            results = list(executor.map(lambda shard: self.download_shard(shard, shards_path, retries), shards))
+
+        completed = index_from
+        merged = []
+        for shard, success in zip(shards, results):
+            if not success:
+                break
+            merged.append(shard)
+            completed = shard[1]
+        if not merged:
+            return completed
+
+        out_path = join(out_dir, str(index_from) + "-" + str(completed) + ".json")
+        with open(out_path + ".part", "wb") as fop:
+            for shard in merged:
+                with open(self.shard_path(shards_path, shard), "rb") as fp:
+                    shutil.copyfileobj(fp, fop)
+        os.replace(out_path + ".part", out_path)
+        if journal is not None:
+            journal.add_range(index_from, completed)
+        for shard in merged:
+            os.remove(self.shard_path(shards_path, shard))
+        return completed
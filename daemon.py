@@ -0,0 +1,95 @@
+import fcntl
+import logging
+import os
+import threading
+import time
+
+
+class InstanceLockError(Exception):
+    """Another instance holds the lock"""
+    pass
+
+
+class InstanceLock:
+    """Exclusive lock of a file held by a running instance
+
+    The lock is an advisory `flock`, so it is released by the system also when the process is killed and
+    no stale lock is left behind. The file contains PID of the holder.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fp = None
+
+    def acquire(self):
+        """
+        :raise: InstanceLockError if another process holds the lock
+        """
+        fp = open(self.path, "a+")
+        try:
+            fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            fp.seek(0)
+            holder = fp.read().strip()
+            fp.close()
+            raise InstanceLockError("Another instance is running" + (" with PID " + holder if holder else ""))
+        fp.truncate(0)
+        fp.write(str(os.getpid()))
+        fp.flush()
+        self.fp = fp
+
+    def release(self):
+        if self.fp is not None:
+            fcntl.flock(self.fp, fcntl.LOCK_UN)
+            self.fp.close()
+            self.fp = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
+
+
+class Scheduler:
+    """Periodic tasks run one at a time in the calling thread
+
+    A task is run first when the scheduler starts, unless it is delayed, and then `interval` seconds after
+    the start of its previous run, a run longer than the interval delays the next one. Tasks due at the
+    same time run in the order they were added. A failing task is logged and scheduled again.
+    """
+
+    def __init__(self):
+        self.tasks = []
+        self.stopped = threading.Event()
+
+    def add(self, name, interval, function, delay=0):
+        """
+        :param name:     Name of the task used in logs
+        :param interval: Interval between starts of runs in seconds
+        :param function: Callable without arguments
+        :param delay:    Delay of the first run in seconds
+        """
+        self.tasks.append({"name": name, "interval": interval, "function": function,
+                           "next": time.monotonic() + delay})
+
+    def stop(self):
+        """Stop after the running task finishes, safe to call from a signal handler"""
+        self.stopped.set()
+
+    def run(self):
+        while self.tasks and not self.stopped.is_set():
+            task = min(self.tasks, key=lambda t: t["next"])
+            delay = task["next"] - time.monotonic()
+            if delay > 0:
+                self.stopped.wait(delay)
+                continue
+            started = time.monotonic()
+            try:
+                task["function"]()
+            except Exception as e:
+                logging.error("Scheduled task " + task["name"] + " failed: ")
+                logging.error(str(e))
+            task["next"] = max(started + task["interval"], time.monotonic())
@@ -1,5 +1,9 @@
 import collections
+import heapq
 import json
+import os
+import shutil
+import tempfile
 from hashlib import sha224
 from json import JSONDecodeError
 
@@ -43,6 +47,18 @@ class Dataset:
 
     @staticmethod
     def file_keys(fp):
+        """Generate keys from a JSON-lines file or a binary key store
+
+        :param fp: Text or binary file object, format is detected from the file header
+        """
+        binary = fp.buffer if hasattr(fp, "buffer") else fp
+        if hasattr(binary, "peek"):
+            from keystore import KeyStore, KeyStoreReader
+            if KeyStore.is_key_store(binary.peek(len(KeyStore.MAGIC))):
+                KeyStore.check_version(binary.read(len(KeyStore.MAGIC)))
+                yield from KeyStoreReader.stream(binary)
+                return
+
         while True:
             try:
                 line = fp.readline()
@@ -82,29 +98,196 @@ class Dataset:
         return stats
 
     @staticmethod
-    def remove_duplicities(file_in, file_out):
+    def remove_duplicities(file_in, file_out, memory_limit=None, temporary_path=None, estimator=None):
+        """Merge duplicate keys of a file in a single pass
+
+        Keys are written in the order of their last occurrence, sources of all occurrences are merged
+        and counts are summed.
+
+        :param file_in:        Path to JSON-lines file or binary key store with keys
+        :param file_out:       Path to the output file
+        :param memory_limit:   Approximate memory budget in bytes, None for unlimited
+        :param temporary_path: Directory for spilled partitions, system default if None
+        :param estimator:      PriorProbabilityEstimator fed by every unique key, optional
+        """
         with open(file_in) as fp:
-            hashes = Dataset.compute_counts(fp)
-
-        duplicities = {}
-        with open(file_out, "w") as fop:
-            with open(file_in) as fp:
-                for k in Dataset.file_keys(fp):
-                    fingerprint = k.fingerprint()
-
-                    # If there left only one key
-                    if hashes[fingerprint] == 1:
-                        # If it had a duplicities, compute new key with all sources and counts
-                        if fingerprint in duplicities:
-                            sources = list(dict.fromkeys(duplicities[fingerprint]["sources"]+k.source))
-                            k = Key(sources, k.n, k.e, duplicities[fingerprint]["count"])
-                            duplicities.pop(fingerprint)
-                        fop.write(k.get_as_string() + "\n")
-                        hashes.pop(fingerprint)
-                    else:
-                        # If we found this key first time, save number of counts we expect
-                        if fingerprint not in duplicities:
-                            duplicities[fingerprint] = {"sources": [], "count": hashes[fingerprint]}
-                        sources = list(dict.fromkeys(duplicities[fingerprint]["sources"] + k.source))
-                        duplicities[fingerprint]["sources"] = sources
-                        hashes[fingerprint] -= 1
+            Dataset.write_unique(Dataset.file_keys(fp), file_out, memory_limit, temporary_path, estimator)
+
+    @staticmethod
+    def write_unique(keys, file_out, memory_limit=None, temporary_path=None, estimator=None):
+        """Merge duplicate keys of a stream and write them as JSON-lines
+
+        :param keys:           Iterable of keys
+        :param file_out:       Path to the output file
+        :param memory_limit:   Approximate memory budget in bytes, None for unlimited
+        :param temporary_path: Directory for spilled partitions, system default if None
+        :param estimator:      PriorProbabilityEstimator fed by every unique key, optional
+        """
+        merger = KeyMerger(memory_limit, temporary_path)
+        try:
+            for k in keys:
+                merger.add(k)
+            # Renamed when complete, an interrupted run does not leave a file looking like a complete one
+            with open(file_out + ".tmp", "w") as fop:
+                for k in merger.keys():
+                    fop.write(k.get_as_string() + "\n")
+                    if estimator is not None:
+                        estimator.add_key(k)
+            os.replace(file_out + ".tmp", file_out)
+        finally:
+            merger.close()
+
+
+class KeyMerger:
+    """Single pass merging of duplicate keys with a bounded memory
+
+    Keys are held in a dictionary ordered by the last occurrence of their fingerprint. When the estimated
+    size of the dictionary crosses the memory limit, it is spilled into partition files by a fingerprint
+    prefix. Partitions are merged one by one at the end and their results are combined by an external merge.
+    A partition whose unique keys do not fit into the memory limit is split again by the next hex digit of
+    fingerprints, so the memory stays bounded also for data sets much larger than the limit.
+    """
+
+    PARTITIONS = 16
+    ENTRY_OVERHEAD = 256
+    FINGERPRINT_LENGTH = 16
+
+    def __init__(self, memory_limit=None, temporary_path=None):
+        self.memory_limit = memory_limit
+        self.temporary_path = temporary_path
+        self.merged = {}
+        self.memory = 0
+        self.sequence = 0
+        self.spill_dir = None
+        self.spill_fps = None
+
+    def add(self, key: Key):
+        fingerprint = key.fingerprint()
+        previous = self.merged.pop(fingerprint, None)
+        if previous is not None:
+            key = self.merge(previous[1], key)
+            self.memory -= previous[2]
+        size = self.key_size(key)
+        # Re-inserted entry moves to the end, so the dictionary is ordered by the last occurrence
+        self.merged[fingerprint] = (self.sequence, key, size)
+        self.sequence += 1
+        self.memory += size
+        if self.memory_limit is not None and self.memory > self.memory_limit:
+            self.spill()
+
+    @staticmethod
+    def key_size(key: Key) -> int:
+        """Estimated memory of a merged key in bytes"""
+        return KeyMerger.ENTRY_OVERHEAD + key.n.bit_length() // 4 + len(str(key.source))
+
+    @staticmethod
+    def merge(first: Key, second: Key) -> Key:
+        sources = list(dict.fromkeys(first.source + second.source))
+        return Key(sources, second.n, second.e, first.count + second.count)
+
+    def spill(self):
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix="dedup-", dir=self.temporary_path)
+            self.spill_fps = [open(os.path.join(self.spill_dir, "%x.part" % i), "w")
+                              for i in range(self.PARTITIONS)]
+        for fingerprint, (sequence, key, _) in self.merged.items():
+            partition = int(fingerprint[0], 16) * self.PARTITIONS // 16
+            self.spill_fps[partition].write(str(sequence) + "\t" + fingerprint + "\t" + key.get_as_string() + "\n")
+        self.merged = {}
+        self.memory = 0
+
+    def keys(self):
+        """Generate merged keys ordered by their last occurrence"""
+        if self.spill_dir is None:
+            for _, key, _ in self.merged.values():
+                yield key
+            return
+
+        self.spill()
+        runs = []
+        for i, fp in enumerate(self.spill_fps):
+            fp.close()
+            runs.append(self.merge_partition(fp.name, os.path.join(self.spill_dir, "%x.run" % i)))
+        self.spill_fps = []
+        fps = [open(run) for run in runs]
+        try:
+            for _, line in heapq.merge(*[self.read_run(fp) for fp in fps]):
+                yield Key.parse_from_string(line)
+        finally:
+            for fp in fps:
+                fp.close()
+
+    def merge_partition(self, partition_path, run_path, depth=1):
+        """Merge keys of one partition and store them into a run ordered by the last occurrence
+
+        :param partition_path: Spilled lines of keys with the same fingerprint prefix
+        :param run_path:       Path of the run
+        :param depth:          Length of the common fingerprint prefix of the partition
+        """
+        merged = {}
+        memory = 0
+        with open(partition_path) as fp:
+            for line in fp:
+                sequence, fingerprint, string = line.split("\t", 2)
+                key = Key.parse_from_string(string)
+                previous = merged.get(fingerprint)
+                if previous is not None:
+                    key = KeyMerger.merge(previous[1], key)
+                    memory -= previous[2]
+                size = self.key_size(key)
+                merged[fingerprint] = (int(sequence), key, size)
+                memory += size
+                if self.memory_limit is not None and memory > self.memory_limit and depth < self.FINGERPRINT_LENGTH:
+                    merged = None
+                    break
+        if merged is None:
+            return self.split_partition(partition_path, run_path, depth)
+        os.remove(partition_path)
+        with open(run_path, "w") as fop:
+            for sequence, key, _ in sorted(merged.values(), key=lambda item: item[0]):
+                fop.write(str(sequence) + "\t" + key.get_as_string() + "\n")
+        return run_path
+
+    def split_partition(self, partition_path, run_path, depth):
+        """Split a partition by the next hex digit of fingerprints and merge its parts recursively
+
+        Lines keep their order in the parts, so keys are merged the same way as in a single partition.
+        """
+        base = partition_path[:-len(".part")]
+        part_paths = [base + "%x.part" % i for i in range(16)]
+        fps = [open(path, "w") for path in part_paths]
+        try:
+            with open(partition_path) as fp:
+                for line in fp:
+                    fingerprint = line.split("\t", 2)[1]
+                    fps[int(fingerprint[depth], 16)].write(line)
+        finally:
+            for fop in fps:
+                fop.close()
+        os.remove(partition_path)
+        runs = [self.merge_partition(path, base + "%x.run" % i, depth + 1) for i, path in enumerate(part_paths)]
+        fps = [open(run) for run in runs]
+        try:
+            with open(run_path, "w") as fop:
+                for sequence, string in heapq.merge(*[self.read_run(fp) for fp in fps]):
+                    fop.write(str(sequence) + "\t" + string)
+        finally:
+            for fp in fps:
+                fp.close()
+        for run in runs:
+            os.remove(run)
+        return run_path
+
+    @staticmethod
+    def read_run(fp):
+        for line in fp:
+            sequence, string = line.split("\t", 1)
+            yield int(sequence), string
+
+    def close(self):
+        if self.spill_fps:
+            for fp in self.spill_fps:
+                fp.close()
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
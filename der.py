@@ -0,0 +1,150 @@
+class DerError(Exception):
+    """Certificate uses a DER encoding not handled by the fast path"""
+    pass
+
+
+class Der:
+    """Minimal DER walker extracting RSA key, CN of subject and validity start of X.509 certificates
+
+    Only fields needed for a key are decoded, everything else is skipped by its length. Encodings it does
+    not handle raise DerError, so the caller can fall back to a full X.509 parser.
+    """
+
+    SEQUENCE = 0x30
+    SET = 0x31
+    INTEGER = 0x02
+    BIT_STRING = 0x03
+    OID = 0x06
+    UTC_TIME = 0x17
+    GENERALIZED_TIME = 0x18
+    VERSION = 0xa0
+
+    RSA_ENCRYPTION = bytes.fromhex("2a864886f70d010101")
+    COMMON_NAME = bytes.fromhex("550403")
+    STRING_ENCODINGS = {0x0c: "UTF-8", 0x13: "ascii", 0x16: "ascii"}
+
+    @staticmethod
+    def element(data, offset, tag=None):
+        """Decode tag and length of an element
+
+        :return: tuple (tag, start of content, end of content)
+        :raise: DerError
+        """
+        try:
+            actual = data[offset]
+            length = data[offset + 1]
+        except IndexError:
+            raise DerError("Truncated element")
+        if tag is not None and actual != tag:
+            raise DerError("Unexpected tag " + hex(actual))
+        start = offset + 2
+        if length & 0x80:
+            size = length & 0x7f
+            if size == 0 or size > 4:
+                raise DerError("Unsupported length")
+            length = int.from_bytes(data[start:start + size], "big")
+            start += size
+        end = start + length
+        if end > len(data):
+            raise DerError("Truncated element")
+        return actual, start, end
+
+    @staticmethod
+    def children(data, start, end, limit=None):
+        """List (tag, start, end) of elements in content [start, end), at most limit of them"""
+        element = Der.element
+        children = []
+        while start < end and (limit is None or len(children) < limit):
+            child = element(data, start)
+            if child[2] > end:
+                raise DerError("Element exceeds its parent")
+            children.append(child)
+            start = child[2]
+        return children
+
+    @staticmethod
+    def parse_certificate(data: bytes):
+        """Extract RSA key of a DER certificate
+
+        :param data: DER encoded certificate
+        :return: tuple (n, e, CN of subject or None, validity start as YYYY-MM-DD) or None for non-RSA key
+        :raise: DerError
+        """
+        _, start, end = Der.element(data, 0, Der.SEQUENCE)
+        _, start, end = Der.element(data, start, Der.SEQUENCE)
+        fields = Der.children(data, start, end, 7)
+        if fields and fields[0][0] == Der.VERSION:
+            fields = fields[1:]
+        if len(fields) < 6:
+            raise DerError("Missing fields of TBSCertificate")
+        _, _, _, validity, subject, public_key_info = fields[:6]
+
+        if public_key_info[0] != Der.SEQUENCE:
+            raise DerError("Malformed SubjectPublicKeyInfo")
+        children = Der.children(data, public_key_info[1], public_key_info[2])
+        if len(children) != 2:
+            raise DerError("Malformed SubjectPublicKeyInfo")
+        algorithm, key = children
+        if algorithm[0] != Der.SEQUENCE or key[0] != Der.BIT_STRING:
+            raise DerError("Malformed SubjectPublicKeyInfo")
+        oid_tag, oid_start, oid_end = Der.element(data, algorithm[1], Der.OID)
+        if data[oid_start:oid_end] != Der.RSA_ENCRYPTION:
+            return None
+        n, e = Der.rsa_public_key(data, key[1], key[2])
+        return n, e, Der.common_name(data, subject), Der.not_before(data, validity)
+
+    @staticmethod
+    def rsa_public_key(data, start, end):
+        if start >= end or data[start] != 0:
+            raise DerError("Unsupported padding of key")
+        _, start, end = Der.element(data, start + 1, Der.SEQUENCE)
+        integers = Der.children(data, start, end)
+        if len(integers) != 2 or any(tag != Der.INTEGER for tag, _, _ in integers):
+            raise DerError("Malformed RSAPublicKey")
+        values = []
+        for _, integer_start, integer_end in integers:
+            if integer_start == integer_end or data[integer_start] & 0x80:
+                raise DerError("Non-positive integer")
+            values.append(int.from_bytes(data[integer_start:integer_end], "big"))
+        return values[0], values[1]
+
+    @staticmethod
+    def common_name(data, subject):
+        """First CN of subject"""
+        if subject[0] != Der.SEQUENCE:
+            raise DerError("Malformed subject")
+        for tag, start, end in Der.children(data, subject[1], subject[2]):
+            if tag != Der.SET:
+                raise DerError("Malformed subject")
+            for attribute_tag, attribute_start, attribute_end in Der.children(data, start, end):
+                oid_tag, oid_start, oid_end = Der.element(data, attribute_start, Der.OID)
+                if data[oid_start:oid_end] != Der.COMMON_NAME:
+                    continue
+                value_tag, value_start, value_end = Der.element(data, oid_end)
+                encoding = Der.STRING_ENCODINGS.get(value_tag)
+                if encoding is None:
+                    raise DerError("Unsupported string type " + hex(value_tag))
+                try:
+                    return data[value_start:value_end].decode(encoding)
+                except UnicodeDecodeError:
+                    raise DerError("Malformed string")
+        return None
+
+    @staticmethod
+    def not_before(data, validity):
+        if validity[0] != Der.SEQUENCE:
+            raise DerError("Malformed validity")
+        tag, start, end = Der.element(data, validity[1])
+        value = data[start:end]
+        if not value[:-1].isdigit():
+            raise DerError("Malformed time")
+        if tag == Der.UTC_TIME and len(value) == 13 and value.endswith(b"Z"):
+            year = int(value[0:2])
+            year += 2000 if year < 50 else 1900
+            month, day = value[2:4], value[4:6]
+        elif tag == Der.GENERALIZED_TIME and len(value) == 15 and value.endswith(b"Z"):
+            year = int(value[0:4])
+            month, day = value[4:6], value[6:8]
+        else:
+            raise DerError("Unsupported time")
+        return "%04d-%s-%s" % (year, month.decode("ascii"), day.decode("ascii"))
@@ -0,0 +1,118 @@
+import json
+import os
+import threading
+
+
+def save_json_atomically(path, content):
+    """Write JSON to a temporary file and replace the target, a crash never leaves a damaged file"""
+    temporary = path + ".tmp"
+    with open(temporary, "w") as fp:
+        json.dump(content, fp)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(temporary, path)
+
+
+class Journal:
+    """On-disk progress journal of CT ingestion
+
+    Records downloaded ranges of entries, bucketing progress of temporary files (read offset and sizes
+    of the day files written by a file at the last checkpoint) and state of processed days. Every change
+    is written atomically.
+    """
+
+    DAY_CLASSIFIED = "classified"
+    DAY_UPLOADED = "uploaded"
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.content = {"downloaded": [], "bucketed": [], "bucketing": {}, "days": {}}
+        if os.path.exists(path):
+            with open(path) as fp:
+                self.content.update(json.load(fp))
+
+    def save(self):
+        save_json_atomically(self.path, self.content)
+
+    def add_range(self, index_from, index_to):
+        """Record downloaded range [index_from, index_to) and merge overlapping ranges"""
+        with self.lock:
+            ranges = sorted(self.content["downloaded"] + [[index_from, index_to]])
+            merged = []
+            for start, end in ranges:
+                if merged and start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+            self.content["downloaded"] = merged
+            self.save()
+
+    def downloaded_until(self, index_from) -> int:
+        """End of downloaded entries contiguous from index_from"""
+        end = index_from
+        for start, stop in self.content["downloaded"]:
+            if start <= end < stop:
+                end = stop
+        return end
+
+    def forget_ranges(self, index_to):
+        """Drop ranges entirely before index_to, they are already stored in configuration"""
+        with self.lock:
+            self.content["downloaded"] = [r for r in self.content["downloaded"] if r[1] > index_to]
+            self.save()
+
+    def is_bucketed(self, name) -> bool:
+        return name in self.content["bucketed"]
+
+    def bucketing_checkpoint(self, name):
+        """Last checkpoint of bucketing of a temporary file
+
+        :return: tuple (read offset, dictionary day -> size of its file) or None
+        """
+        checkpoint = self.content["bucketing"].get(name)
+        if checkpoint is None:
+            return None
+        return checkpoint["offset"], checkpoint["days"]
+
+    def is_bucketing(self) -> bool:
+        """Whether bucketing of a temporary file was interrupted"""
+        return bool(self.content["bucketing"])
+
+    def checkpoint_bucketing(self, name, offset, days):
+        with self.lock:
+            self.content["bucketing"][name] = {"offset": offset, "days": dict(days)}
+            self.save()
+
+    def mark_bucketed(self, name):
+        with self.lock:
+            self.content["bucketing"].pop(name, None)
+            if name not in self.content["bucketed"]:
+                self.content["bucketed"].append(name)
+            self.save()
+
+    def forget_bucketed(self, name):
+        with self.lock:
+            if name in self.content["bucketed"]:
+                self.content["bucketed"].remove(name)
+                self.save()
+
+    def day_state(self, day):
+        """State of a day with the size of its day file at that time
+
+        :return: tuple (state, size) or (None, None)
+        """
+        state = self.content["days"].get(day)
+        if state is None:
+            return None, None
+        return state["state"], state["size"]
+
+    def mark_day(self, day, state, size=None):
+        with self.lock:
+            self.content["days"][day] = {"state": state, "size": size}
+            self.save()
+
+    def forget_day(self, day):
+        with self.lock:
+            if self.content["days"].pop(day, None) is not None:
+                self.save()
@@ -0,0 +1,216 @@
+import json
+import logging
+import os
+import shutil
+from json import JSONDecodeError
+
+import numpy as np
+
+from classification import PriorProbabilityEstimator
+from dataset import Key
+from journal import save_json_atomically
+
+
+class KeyIndex:
+    """Persistent index of unique keys of a growing JSON-lines file
+
+    Only lines appended since the last update are read. Fingerprints of unique keys with mask codes of
+    classified keys (-1 for keys left out by a registry filter) are stored in runs sorted by fingerprint,
+    every field of a run in a separate contiguous array file. A new run is written by every update and runs are merged into one when there are more
+    than MAX_RUNS of them. The index keeps statistics and mask frequencies of unique keys, so an
+    estimation is computed without reading the file again.
+    """
+
+    STATE_FILE = "index.json"
+    BATCH_SIZE = 65536
+    MAX_RUNS = 8
+    VERSION = 3
+    ENTRY = np.dtype([("fingerprint", "<u8"), ("code", "<i4")])
+
+    def __init__(self, path):
+        """
+        :param path: Directory of the index, created on the first update
+        """
+        self.path = path
+        self.state = self.empty_state()
+        state_path = os.path.join(path, self.STATE_FILE)
+        if os.path.exists(state_path):
+            with open(state_path) as fp:
+                self.state.update(json.load(fp))
+
+    @staticmethod
+    def empty_state() -> dict:
+        return {
+            "version": KeyIndex.VERSION,
+            "table": None,
+            "offset": 0,
+            "runs": [],
+            "next_run": 0,
+            "keys": 0,
+            "occurrences": 0,
+            "exponents": {},
+            "frequencies": {}
+        }
+
+    def run_path(self, run, field):
+        return os.path.join(self.path, "%d.%s.npy" % (run, field))
+
+    def load_runs(self) -> list:
+        """Memory maps of fields of runs"""
+        return [{field: np.load(self.run_path(run, field), mmap_mode="r") for field in self.ENTRY.names}
+                for run in self.state["runs"]]
+
+    def save_run(self, run, entries):
+        for field in self.ENTRY.names:
+            np.save(self.run_path(run, field), entries[field])
+
+    def remove_run(self, run):
+        for field in self.ENTRY.names:
+            os.remove(self.run_path(run, field))
+
+    def save(self):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        save_json_atomically(os.path.join(self.path, self.STATE_FILE), self.state)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        self.state = self.empty_state()
+
+    def estimator(self, table) -> PriorProbabilityEstimator:
+        """Estimator of indexed unique keys"""
+        estimator = PriorProbabilityEstimator(table)
+        for mask, count in self.state["frequencies"].items():
+            estimator.add_mask(mask, count)
+        return estimator
+
+    def classified(self):
+        """Fingerprints and mask codes of classified unique keys
+
+        :return: numpy array of ENTRY sorted by fingerprint
+        """
+        runs = self.merge(self.load_runs())
+        classified = runs["code"] >= 0
+        entries = np.zeros(int(classified.sum()), dtype=self.ENTRY)
+        for field in self.ENTRY.names:
+            entries[field] = runs[field][classified]
+        return entries
+
+    def statistics(self) -> dict:
+        """Statistics of indexed keys in the format of Dataset.statistics
+
+        `new` is the number of keys not seen before by the registry or None without a registry.
+        """
+        return {
+            "keys": self.state["keys"],
+            "duplicities": self.state["occurrences"] - self.state["keys"],
+            "exponents": dict(self.state["exponents"]),
+            "new": self.state.get("new")
+        }
+
+    def update(self, file_path, table, registry_filter=None) -> int:
+        """Index lines appended to a file since the last update
+
+        The index is rebuilt if the file is shorter than the indexed part, the classification table
+        has changed or the index was written by an older version.
+
+        :param file_path:       JSON-lines file with keys
+        :param table:           ClassificationTable for mask frequencies
+        :param registry_filter: RegistryFilter of unique keys, counts of new keys are kept in the index
+        :return: number of new unique keys
+        """
+        if self.state["table"] != table.hash or self.state.get("version") != self.VERSION or \
+                os.path.getsize(file_path) < self.state["offset"]:
+            self.remove()
+            self.state["table"] = table.hash
+        estimator = self.estimator(table)
+        estimator.key_filter = registry_filter
+        registered = registry_filter.new if registry_filter is not None else 0
+        runs = self.load_runs()
+        new_runs = []
+        added = 0
+        with open(file_path, "rb") as fp:
+            fp.seek(self.state["offset"])
+            offset = self.state["offset"]
+            batch = []
+            for line in fp:
+                if not line.endswith(b"\n"):
+                    break
+                offset += len(line)
+                try:
+                    batch.append(Key.parse_from_string(line))
+                except UnicodeDecodeError as e:
+                    logging.error("Error with decoding line: " + e.reason)
+                except JSONDecodeError as e:
+                    logging.error("Error with decoding line: " + e.msg)
+                if len(batch) >= self.BATCH_SIZE:
+                    added += self.add_batch(batch, runs + new_runs, new_runs, estimator)
+                    batch = []
+            if batch:
+                added += self.add_batch(batch, runs + new_runs, new_runs, estimator)
+
+        entries = self.merge(new_runs)
+        if len(entries["fingerprint"]) > 0:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            run = self.state["next_run"]
+            self.save_run(run, entries)
+            self.state["runs"].append(run)
+            self.state["next_run"] = run + 1
+        obsolete = []
+        if len(self.state["runs"]) > self.MAX_RUNS:
+            obsolete = self.state["runs"]
+            run = self.state["next_run"]
+            self.save_run(run, self.merge(self.load_runs()))
+            self.state["runs"] = [run]
+            self.state["next_run"] = run + 1
+        self.state["offset"] = offset
+        if registry_filter is not None:
+            self.state["new"] = self.state.get("new", 0) + registry_filter.new - registered
+        self.state["frequencies"] = estimator.frequencies
+        self.save()
+        for run in obsolete:
+            self.remove_run(run)
+        return added
+
+    @staticmethod
+    def merge(runs) -> dict:
+        """Concatenate runs into one sorted by fingerprint
+
+        :param runs: List of dictionaries of field arrays
+        :return: dictionary of field arrays
+        """
+        merged = {field: np.concatenate([run[field] for run in runs] + [np.zeros(0, dtype=KeyIndex.ENTRY[field])])
+                  for field in KeyIndex.ENTRY.names}
+        order = np.argsort(merged["fingerprint"], kind="stable")
+        return {field: values[order] for field, values in merged.items()}
+
+    def add_batch(self, batch, runs, new_runs, estimator) -> int:
+        """Add keys of a batch with fingerprints not present in runs"""
+        fingerprints = np.array([int(k.fingerprint(), 16) for k in batch], dtype=np.uint64)
+        unique, first = np.unique(fingerprints, return_index=True)
+        new = np.ones(len(unique), dtype=bool)
+        for run in runs:
+            run_fingerprints = run["fingerprint"]
+            if len(run_fingerprints) == 0:
+                continue
+            position = np.minimum(np.searchsorted(run_fingerprints, unique), len(run_fingerprints) - 1)
+            new &= run_fingerprints[position] != unique
+        keys = [batch[index] for index in first[new]]
+        self.state["occurrences"] += sum(k.count for k in batch)
+        self.state["keys"] += len(keys)
+        exponents = self.state["exponents"]
+        for k in keys:
+            e = str(k.e)
+            exponents[e] = exponents.get(e, 0) + 1
+        entries = {"fingerprint": unique[new], "code": np.full(len(keys), -1, dtype=self.ENTRY["code"])}
+        if keys:
+            classified = keys if estimator.key_filter is None else estimator.key_filter(keys)
+            codes = estimator.table.mask_codes(classified)
+            estimator.add_codes(codes)
+            # The filter returns the classified keys themselves
+            positions = {id(k): position for position, k in enumerate(keys)}
+            entries["code"][[positions[id(k)] for k in classified]] = codes
+        new_runs.append(entries)
+        return len(keys)
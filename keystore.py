@@ -0,0 +1,186 @@
+import json
+import mmap
+import struct
+
+from dataset import Key
+
+
+class KeyStoreError(Exception):
+    """Binary key store is damaged or has unknown format"""
+    pass
+
+
+class KeyStore:
+    """Compact binary format of keys used between pipeline stages
+
+    File starts with MAGIC followed by length-prefixed records. Record is a little endian
+    payload length (4 B) and a payload::
+
+        n length (2 B) | e length (2 B) | count (8 B) | sources count (4 B) | n | e | sources
+
+    Moduli and exponents are stored as unsigned big endian integers. Every source is a type tag (1 B)
+    and a length-prefixed (4 B) UTF-8 value, where tag 0 is None, 1 is a string and 2 is a JSON value.
+    Version 1 of the format had 2 B counts and lengths of sources, its files are rejected.
+    """
+
+    MAGIC_PREFIX = b"CMoCLKS"
+    MAGIC = MAGIC_PREFIX + b"2"
+
+    RECORD_LENGTH = struct.Struct("<I")
+    RECORD_HEADER = struct.Struct("<HHQI")
+    SOURCE_HEADER = struct.Struct("<BI")
+
+    SOURCE_NONE = 0
+    SOURCE_STRING = 1
+    SOURCE_JSON = 2
+
+    @staticmethod
+    def is_key_store(head: bytes) -> bool:
+        """Check the header of a key store of any version, see check_version"""
+        return head[:len(KeyStore.MAGIC_PREFIX)] == KeyStore.MAGIC_PREFIX
+
+    @staticmethod
+    def check_version(head: bytes):
+        """
+        :raise: KeyStoreError if a key store has another version of the format
+        """
+        version = bytes(head[len(KeyStore.MAGIC_PREFIX):len(KeyStore.MAGIC)])
+        if version != KeyStore.MAGIC[len(KeyStore.MAGIC_PREFIX):]:
+            raise KeyStoreError("Unsupported version " + version.decode("ascii", "replace") + " of key store.")
+
+    @staticmethod
+    def encode(key: Key) -> bytes:
+        n = key.n.to_bytes((key.n.bit_length() + 7) // 8, "big")
+        e = key.e.to_bytes((key.e.bit_length() + 7) // 8, "big")
+        sources = key.source if isinstance(key.source, list) else [key.source]
+        parts = [KeyStore.RECORD_HEADER.pack(len(n), len(e), key.count, len(sources)), n, e]
+        for source in sources:
+            if source is None:
+                parts.append(KeyStore.SOURCE_HEADER.pack(KeyStore.SOURCE_NONE, 0))
+                continue
+            if isinstance(source, str):
+                tag = KeyStore.SOURCE_STRING
+                value = source.encode("UTF-8")
+            else:
+                tag = KeyStore.SOURCE_JSON
+                value = json.dumps(source).encode("UTF-8")
+            parts.append(KeyStore.SOURCE_HEADER.pack(tag, len(value)))
+            parts.append(value)
+        payload = b"".join(parts)
+        return KeyStore.RECORD_LENGTH.pack(len(payload)) + payload
+
+    @staticmethod
+    def decode(buffer, offset=0) -> Key:
+        n_len, e_len, count, sources_count = KeyStore.RECORD_HEADER.unpack_from(buffer, offset)
+        offset += KeyStore.RECORD_HEADER.size
+        n = int.from_bytes(buffer[offset:offset + n_len], "big")
+        offset += n_len
+        e = int.from_bytes(buffer[offset:offset + e_len], "big")
+        offset += e_len
+        sources = []
+        for _ in range(sources_count):
+            tag, length = KeyStore.SOURCE_HEADER.unpack_from(buffer, offset)
+            offset += KeyStore.SOURCE_HEADER.size
+            value = bytes(buffer[offset:offset + length]).decode("UTF-8")
+            offset += length
+            if tag == KeyStore.SOURCE_NONE:
+                sources.append(None)
+            elif tag == KeyStore.SOURCE_STRING:
+                sources.append(value)
+            else:
+                sources.append(json.loads(value))
+        return Key(sources, n, e, count)
+
+    @staticmethod
+    def to_json_lines(file_in, file_out):
+        """Convert binary key store to JSON-lines readable by classify_rsa_key.jar
+
+        :param file_in:  Path to binary key store
+        :param file_out: Path to JSON-lines output
+        """
+        with KeyStoreReader(file_in) as reader:
+            with open(file_out, "w") as fop:
+                for k in reader:
+                    fop.write(k.get_as_string() + "\n")
+
+
+class KeyStoreWriter:
+    """Append keys to a binary key store"""
+
+    def __init__(self, path):
+        self.fp = open(path, "wb")
+        self.fp.write(KeyStore.MAGIC)
+
+    def write(self, key: Key):
+        self.fp.write(KeyStore.encode(key))
+
+    def write_encoded(self, record: bytes):
+        """Write a record already encoded by KeyStore.encode"""
+        self.fp.write(record)
+
+    def close(self):
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class KeyStoreReader:
+    """Read keys from a memory-mapped binary key store"""
+
+    def __init__(self, path):
+        self.fp = open(path, "rb")
+        try:
+            self.buffer = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file cannot be mapped
+            self.buffer = b""
+        if not KeyStore.is_key_store(self.buffer):
+            self.close()
+            raise KeyStoreError("File " + path + " is not a key store.")
+        try:
+            KeyStore.check_version(self.buffer)
+        except KeyStoreError:
+            self.close()
+            raise
+
+    def __iter__(self):
+        return self.records(self.buffer, len(KeyStore.MAGIC))
+
+    @staticmethod
+    def records(buffer, offset):
+        size = len(buffer)
+        while offset + KeyStore.RECORD_LENGTH.size <= size:
+            length, = KeyStore.RECORD_LENGTH.unpack_from(buffer, offset)
+            offset += KeyStore.RECORD_LENGTH.size
+            if offset + length > size:
+                raise KeyStoreError("Truncated record at offset " + str(offset) + ".")
+            yield KeyStore.decode(buffer, offset)
+            offset += length
+
+    @staticmethod
+    def stream(fp):
+        """Read records sequentially from a binary file object positioned after MAGIC"""
+        while True:
+            head = fp.read(KeyStore.RECORD_LENGTH.size)
+            if len(head) < KeyStore.RECORD_LENGTH.size:
+                break
+            length, = KeyStore.RECORD_LENGTH.unpack(head)
+            payload = fp.read(length)
+            if len(payload) < length:
+                raise KeyStoreError("Truncated record.")
+            yield KeyStore.decode(payload)
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,142 @@
+import os
+import resource
+import time
+from datetime import datetime
+
+from journal import save_json_atomically
+
+
+class Stage:
+    """Measurement of one pipeline stage
+
+    Wall time, CPU time and peak RSS are measured by the context manager, counters of bytes and records
+    are set by the caller inside the stage.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.records = 0
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.peak_rss = 0
+        self.error = None
+        self._wall_start = 0.0
+        self._cpu_start = 0.0
+
+    @staticmethod
+    def cpu_time_now() -> float:
+        """CPU time of this process and its finished children, e.g. bucketing workers and pigz"""
+        times = os.times()
+        return times.user + times.system + times.children_user + times.children_system
+
+    @staticmethod
+    def peak_rss_now() -> int:
+        """Peak resident set size in bytes of this process or its largest finished child"""
+        usage = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                    resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        return usage * 1024
+
+    def __enter__(self):
+        self._wall_start = time.perf_counter()
+        self._cpu_start = self.cpu_time_now()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.wall_time = time.perf_counter() - self._wall_start
+        self.cpu_time = self.cpu_time_now() - self._cpu_start
+        self.peak_rss = self.peak_rss_now()
+        if exc_value is not None:
+            self.error = str(exc_value)
+        return False
+
+    def records_per_second(self) -> float:
+        return self.records / self.wall_time if self.wall_time > 0 else 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "wall_time": round(self.wall_time, 3),
+            "cpu_time": round(self.cpu_time, 3),
+            "input_bytes": self.input_bytes,
+            "output_bytes": self.output_bytes,
+            "records": self.records,
+            "records_per_second": round(self.records_per_second(), 1),
+            "peak_rss": self.peak_rss,
+            "error": self.error
+        }
+
+
+class Metrics:
+    """Timing and throughput of pipeline stages of one run
+
+    Stages are recorded in the order they finish, a summary is printed into the notification mail and
+    all stages are saved as JSON, one file per run, so regressions can be tracked across runs.
+
+    Peak RSS is the peak of the process since its start, so it grows monotonically across stages.
+    """
+
+    DIRECTORY = "metrics"
+
+    def __init__(self):
+        self.started = datetime.now()
+        self.stages = []
+
+    def stage(self, name) -> Stage:
+        """Context manager measuring a stage
+
+        :param name: Name of the stage, e.g. `rapid7 2024-01-01 process` or `ct download`
+        """
+        if not self.stages:
+            self.started = datetime.now()
+        stage = Stage(name)
+        self.stages.append(stage)
+        return stage
+
+    def summary(self) -> str:
+        lines = ["Stage timing:"]
+        for stage in self.stages:
+            line = "  %s: wall %.1f s, CPU %.1f s, records %d (%.0f/s), in %s, out %s, peak RSS %s" % (
+                stage.name, stage.wall_time, stage.cpu_time, stage.records, stage.records_per_second(),
+                Metrics.format_bytes(stage.input_bytes), Metrics.format_bytes(stage.output_bytes),
+                Metrics.format_bytes(stage.peak_rss))
+            if stage.error is not None:
+                line += ", failed: " + stage.error
+            lines.append(line)
+        return "\n".join(lines)
+
+    @staticmethod
+    def format_bytes(size) -> str:
+        for unit in ("B", "KiB", "MiB", "GiB"):
+            if size < 1024 or unit == "GiB":
+                return ("%d %s" if unit == "B" else "%.1f %s") % (size, unit)
+            size /= 1024
+
+    def save(self, storage_path) -> str:
+        """Save stages into `storage_path/metrics/<start of run>.json`
+
+        :return: path of the saved file
+        """
+        directory = os.path.join(storage_path, self.DIRECTORY)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, self.started.strftime("%Y-%m-%dT%H-%M-%S") + ".json")
+        save_json_atomically(path, {
+            "started": self.started.isoformat(timespec="seconds"),
+            "finished": datetime.now().isoformat(timespec="seconds"),
+            "stages": [stage.to_dict() for stage in self.stages]
+        })
+        return path
+
+    @staticmethod
+    def path_size(path) -> int:
+        """Size of a file or of all files in a directory, 0 if it does not exist"""
+        if os.path.isfile(path):
+            return os.path.getsize(path)
+        size = 0
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for f in files:
+                    size += os.path.getsize(os.path.join(root, f))
+        return size
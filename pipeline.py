@@ -0,0 +1,593 @@
+import asyncio
+import json
+import os
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from os import listdir
+from os.path import join
+
+from datetime import date
+
+from classification import ClassificationTable, PriorProbabilityEstimator
+from cmocl import CMoCL, CMoCLError
+from cmocl_async import AsyncCMoCL
+from configuration import Configuration
+from ct import CertificateTransparency
+from dataset import Dataset
+from journal import Journal
+from keyindex import KeyIndex
+from metrics import Metrics
+from rapid7 import Rapid7
+from registry import KeyRegistry, RegistryFilter
+from rollup import Rollups
+from session import Session
+
+
+class Pipeline:
+    """Processing of Rapid7 and CT data sets into CMoCL
+
+    Clients with their pooled HTTP session, the classification table, the registry and indexes of CT days
+    are created once, so a daemon reuses them in every cycle. Stages of a cycle are measured into
+    `metrics`, which is reported and replaced by `report_metrics`.
+
+    Failures of a data set or a day are logged and the next one is processed, a failed communication
+    with CMoCL raises CMoCLError.
+    """
+
+    CMOCL_RAPID7_SOURCE = "rapid7"
+    CMOCL_RAPID7_PERIOD = CMoCL.PERIOD_OCCASIONAL
+    CMOCL_CT_SOURCE = "ct"
+    CMOCL_CT_PERIOD = CMoCL.PERIOD_DAY
+
+    RAPID7_TEMPORARY_PATH = "temp-rapid7"
+    RAPID7_MAX_DATA_SETS = 5
+    CT_TEMPORARY_PATH = "temp-ct"
+    CT_DAYS_PATH = "temp-ct-days"
+    CT_SHARDS_PATH = "temp-ct-shards"
+    CT_DAYS_INDEX_PATH = "temp-ct-days-index"
+    CT_JOURNAL = "temp-ct-journal.json"
+    CT_ROLLUPS_PATH = "temp-ct-rollups"
+
+    def __init__(self, conf: Configuration):
+        """
+        :param conf: Loaded configuration
+        :raise: Exception if CMoCL client or classification table cannot be prepared
+        """
+        self.conf = conf
+        self.metrics = Metrics()
+
+        # Shared HTTP session of API clients
+        self.session = Session(retries=int(conf.get_or_default(conf.CONF_HTTP_RETRIES, 3)),
+                               backoff_factor=float(conf.get_or_default(conf.CONF_HTTP_BACKOFF, 0.5)),
+                               timeout=float(conf.get_or_default(conf.CONF_HTTP_TIMEOUT, 60)),
+                               pool_size=conf.get_http_pool_size())
+        self.cmocl = CMoCL(conf.get(conf.CONF_CMOCL_API_URL), conf.get(conf.CONF_CMOCL_API_KEY), self.session)
+
+        # Prepare storage for results
+        self.storage_path = "storage"
+        if conf.exists(conf.CONF_STORAGE_PATH):
+            conf.get(conf.CONF_STORAGE_PATH)
+        if not os.path.exists(self.storage_path):
+            os.makedirs(self.storage_path)
+        self.dedup_memory_limit = conf.get_dedup_memory_limit()
+        self.rapid7_workers = int(conf.get_or_default(conf.CONF_RAPID7_WORKERS, 1))
+
+        # Registry of already seen keys, optional
+        self.registry = None
+        self.registry_new_only = bool(conf.get_or_default(conf.CONF_REGISTRY_NEW_ONLY, False))
+        if conf.get_or_default(conf.CONF_REGISTRY_PATH, ""):
+            self.registry = KeyRegistry(conf.get(conf.CONF_REGISTRY_PATH))
+
+        # Load classification table once for all data sets
+        self.classification_table = ClassificationTable("classification-table.json", self.storage_path)
+
+        self.rapid7 = None
+        self.ct_logs = None
+        self.journal = None
+        self.rollups = None
+        self.indexes = {}
+
+    def report_metrics(self):
+        """Print timing of stages of the finished cycle, save them into storage and start a new cycle"""
+        if self.metrics.stages:
+            print(self.metrics.summary())
+            try:
+                self.metrics.save(self.storage_path)
+            except OSError as e:
+                logging.error("Cannot save stage timing.")
+                logging.error(str(e))
+        self.metrics = Metrics()
+
+    @staticmethod
+    def save_estimation(estimator: PriorProbabilityEstimator, out_path, source, period, _date) -> dict:
+        """Save estimation with its mask histogram
+
+        The histogram is written first, so every stored estimation has one for a later re-estimation.
+
+        :return: saved estimation
+        """
+        estimator.save_histogram(os.path.dirname(out_path), source, period, _date)
+        estimation = estimator.to_json()
+        estimator.save(os.path.dirname(out_path), estimation)
+        return estimation
+
+    def registry_filter(self, source, day: date):
+        if self.registry is None:
+            return None
+        return RegistryFilter(self.registry, source, day, self.registry_new_only)
+
+    def process_rapid7(self):
+        """Download, classify and upload the oldest Rapid7 data sets missing in CMoCL"""
+        conf = self.conf
+        metrics = self.metrics
+        try:
+            # Temporary data folder
+            temporary_path = self.RAPID7_TEMPORARY_PATH
+            if not os.path.exists(temporary_path):
+                os.makedirs(temporary_path)
+
+            # Load Rapid7 API
+            if self.rapid7 is None:
+                self.rapid7 = Rapid7(conf.get(conf.CONF_RAPID7_API_KEY), self.session,
+                                     int(conf.get_or_default(conf.CONF_RAPID7_CHUNK_SIZE, 1048576)),
+                                     int(conf.get_or_default(conf.CONF_RAPID7_CONNECTIONS, 1)),
+                                     conf.get_or_default(conf.CONF_RAPID7_DECOMPRESSOR, "") or None)
+            rapid7 = self.rapid7
+            rapid7_quotas = rapid7.get_quota_info()
+            if "quota_left" not in rapid7_quotas:
+                logging.error("An unexpected response from Rapid7 quota endpoint.")
+                return
+            elif rapid7_quotas["quota_left"] <= 0:
+                logging.error("Your Rapid7 quota is currently exhausted.")
+                return
+
+            # Get list of 5 oldest not processed Rapid7 data sets
+            data_sets = rapid7.get_data_sets_list()
+            to_process = {}
+            for _date in self.cmocl.missing(self.CMOCL_RAPID7_SOURCE, self.CMOCL_RAPID7_PERIOD,
+                                            reversed(list(data_sets))):
+                to_process[_date] = data_sets[_date]
+                if len(to_process) >= min(rapid7_quotas["quota_left"], self.RAPID7_MAX_DATA_SETS):
+                    break
+
+            # Process Rapid7 data sets
+            for _date in to_process:
+                print("Rapid7 " + _date)
+                out_path = self.storage_path + "/rapid7-" + _date + "/prior_probability.json"
+                tmp_path = temporary_path + "/rapid7-" + _date
+                estimation = None
+                if not os.path.exists(out_path):
+                    registry_filter = self.registry_filter(self.CMOCL_RAPID7_SOURCE, date.fromisoformat(_date))
+                    estimator = PriorProbabilityEstimator(self.classification_table, registry_filter)
+                    if not os.path.exists(tmp_path):
+                        try:
+                            info = rapid7.get_data_info(to_process[_date])
+                            print("Downloading, converting and removing duplicities")
+                            with metrics.stage("rapid7 " + _date + " process") as stage:
+                                stage.input_bytes = int(info.get("size", 0))
+                                results = rapid7.process(to_process[_date], tmp_path, info, self.rapid7_workers,
+                                                         self.dedup_memory_limit, temporary_path, estimator)
+                                stage.records = results["all"]
+                                stage.output_bytes = Metrics.path_size(tmp_path)
+                            print("  Certificates: " + str(results["all"]) + ", RSA keys: " + str(results["rsa"]) +
+                                  ", errors: " + str(results["errors"]))
+                        except Exception as e:
+                            if os.path.exists(tmp_path):
+                                os.remove(tmp_path)
+                            logging.error("An error occurs during downloading " + _date + ": ")
+                            logging.error(str(e))
+                            continue
+                    else:
+                        with metrics.stage("rapid7 " + _date + " load") as stage:
+                            stage.input_bytes = Metrics.path_size(tmp_path)
+                            with open(tmp_path) as fp:
+                                for k in Dataset.file_keys(fp):
+                                    estimator.add_key(k)
+                                    stage.records += 1
+                    print("Statistics: ")
+                    with open(tmp_path) as fp:
+                        stats = Dataset.statistics(fp)
+                        print("  Unique keys: " + str(stats["keys"]))
+                        print("  Duplicities: " + str(stats["duplicities"]))
+                    try:
+                        print("Estimation prior probability")
+                        with metrics.stage("rapid7 " + _date + " classify") as stage:
+                            stage.records = stats["keys"]
+                            stage.input_bytes = Metrics.path_size(tmp_path)
+                            estimation = self.save_estimation(estimator, out_path, self.CMOCL_RAPID7_SOURCE,
+                                                              self.CMOCL_RAPID7_PERIOD, _date)
+                            stage.output_bytes = Metrics.path_size(out_path)
+                        if registry_filter is not None:
+                            print("  New keys: " + str(registry_filter.new) + ", recurring keys: " +
+                                  str(registry_filter.recurring))
+                    except Exception as e:
+                        logging.error("A critical error occurs during classification, Rapid7 " + _date + ": ")
+                        logging.error(str(e))
+                        continue
+                    os.remove(tmp_path)
+                try:
+                    print("Uploading results to CMoCL Database")
+                    with metrics.stage("rapid7 " + _date + " upload") as stage:
+                        stage.input_bytes = Metrics.path_size(out_path)
+                        res = self.cmocl.upload(self.CMOCL_RAPID7_SOURCE, self.CMOCL_RAPID7_PERIOD, _date, out_path,
+                                                estimation)
+                    if not res:
+                        logging.error("Cannot upload results to CMoCL, Rapid7 " + _date + ".")
+                    else:
+                        print("Rapid7 " + _date + " successfully processed.\n")
+                except CMoCLError as e:
+                    logging.error("A critical error occurs during communication with CMoCL, Rapid7 " + _date + ": ")
+                    logging.error(str(e))
+                    raise
+        except CMoCLError:
+            raise
+        except Exception as e:
+            logging.error("A critical error occurs in Rapid7 process: ")
+            logging.error(str(e))
+
+    @staticmethod
+    def ct_log_name(url) -> str:
+        """Name of a CT log used for its directories, e.g. `ct.googleapis.com-logs-argon2024`"""
+        return re.sub(r"[^A-Za-z0-9.]+", "-", re.sub(r"^https?://", "", url).strip("/"))
+
+    def prepare_ct(self):
+        for path in (self.CT_TEMPORARY_PATH, self.CT_DAYS_PATH, self.CT_SHARDS_PATH, self.CT_DAYS_INDEX_PATH):
+            if not os.path.exists(path):
+                os.makedirs(path)
+        if self.journal is None:
+            self.journal = Journal(self.CT_JOURNAL)
+        if self.rollups is None:
+            self.rollups = Rollups(self.CT_ROLLUPS_PATH)
+        if self.ct_logs is None:
+            # Every log has its own client, cursor, temporary files and journal of downloads and bucketing,
+            # the single log of `ct-log-url` keeps the original paths
+            ct_logs = []
+            batch_size = int(self.conf.get_or_default(self.conf.CONF_CT_BATCH_SIZE, 256))
+            for log in self.conf.get_ct_logs():
+                log["name"] = self.ct_log_name(log["url"])
+                log["client"] = CertificateTransparency(log["url"], self.session, batch_size)
+                if log["single"]:
+                    log["temporary_path"] = self.CT_TEMPORARY_PATH
+                    log["shards_path"] = self.CT_SHARDS_PATH
+                    log["journal"] = self.journal
+                else:
+                    log["temporary_path"] = join(self.CT_TEMPORARY_PATH, log["name"])
+                    log["shards_path"] = join(self.CT_SHARDS_PATH, log["name"])
+                    log["journal"] = Journal(self.CT_JOURNAL[:-len(".json")] + "-" + log["name"] + ".json")
+                    if not os.path.exists(log["temporary_path"]):
+                        os.makedirs(log["temporary_path"])
+                ct_logs.append(log)
+            self.ct_logs = ct_logs
+
+    def download_ct_log(self, log):
+        """Download new entries of one CT log into its temporary files, runs in a thread per log
+
+        :return: entry after the last downloaded one or None if the log is not available
+        """
+        conf = self.conf
+        stage_name = "ct download" if log["single"] else "ct download " + log["name"]
+        try:
+            ct_last_entry = log["journal"].downloaded_until(log["last-entry"])
+            ct_entries = log["client"].get_log_size()
+            print("Downloading "+str(ct_entries-ct_last_entry)+" entries from CT " + log["url"])
+            with self.metrics.stage(stage_name) as stage:
+                downloaded_size = Metrics.path_size(log["temporary_path"])
+                ct_completed = log["client"].download_sharded(
+                    ct_last_entry, ct_entries, log["temporary_path"], log["shards_path"],
+                    int(conf.get_or_default(conf.CONF_CT_SHARD_SIZE, 100000)), log["workers"],
+                    int(conf.get_or_default(conf.CONF_CT_RETRIES, 2)), log["journal"])
+                stage.records = ct_completed - ct_last_entry
+                stage.output_bytes = Metrics.path_size(log["temporary_path"]) - downloaded_size
+        except Exception as e:
+            logging.error("An error occurs during downloading CT " + log["url"] + ": ")
+            logging.error(str(e))
+            return None
+        if ct_completed == ct_last_entry and ct_entries > ct_last_entry:
+            logging.error("Downloading of CT " + log["url"] + " exits with an error.")
+        elif ct_completed < ct_entries:
+            logging.error("Downloaded CT " + log["url"] + " entries only up to "+str(ct_completed) +
+                          ", the rest is left for the next run.")
+        return ct_completed
+
+    def download_ct(self):
+        """Download new entries of all CT logs and append their keys into shared day files
+
+        Logs are downloaded concurrently, each by its own number of workers. Their temporary files are
+        then bucketed one log after another, so a bucketing checkpoint of a log never covers lines of
+        another one, and each day is deduplicated once across all logs. A log interrupted during bucketing
+        is resumed first, before other logs append to the day files its checkpoint rolls back.
+        """
+        conf = self.conf
+        with ThreadPoolExecutor(max_workers=len(self.ct_logs)) as executor:
+            completed = list(executor.map(self.download_ct_log, self.ct_logs))
+
+        # Process to dates, files left by an interrupted run are resumed
+        logs = sorted(zip(self.ct_logs, completed), key=lambda item: not item[0]["journal"].is_bucketing())
+        for log, ct_completed in logs:
+            print("Processing to dates files" + ("" if log["single"] else " of CT " + log["url"]))
+            with self.metrics.stage("ct bucket" if log["single"] else "ct bucket " + log["name"]) as stage:
+                stage.input_bytes = Metrics.path_size(log["temporary_path"])
+                days_size = Metrics.path_size(self.CT_DAYS_PATH)
+                stage.records = CertificateTransparency.process_temporary(
+                    log["temporary_path"], self.CT_DAYS_PATH, log["journal"],
+                    int(conf.get_or_default(conf.CONF_CT_BUCKET_WORKERS, 1)),
+                    int(conf.get_or_default(conf.CONF_CT_OPEN_FILES, 64)))
+                stage.output_bytes = Metrics.path_size(self.CT_DAYS_PATH) - days_size
+            if ct_completed is not None:
+                conf.update_ct_last_download_entry(ct_completed, None if log["single"] else log["url"])
+                log["last-entry"] = ct_completed
+                log["journal"].forget_ranges(ct_completed)
+
+    def day_index(self, day) -> KeyIndex:
+        """Index of a day file, kept in memory between cycles"""
+        if day not in self.indexes:
+            self.indexes[day] = KeyIndex(join(self.CT_DAYS_INDEX_PATH, day))
+        return self.indexes[day]
+
+    def index_ct_day(self, f, d: date) -> KeyIndex:
+        """Index new keys of a day file, also of the current day"""
+        path = join(self.CT_DAYS_PATH, f)
+        index = self.day_index(f[0:10])
+        with self.metrics.stage("ct " + d.isoformat() + " dedup") as stage:
+            stage.input_bytes = os.path.getsize(path) - index.state["offset"]
+            stage.records = index.update(path, self.classification_table,
+                                         self.registry_filter(self.CMOCL_CT_SOURCE, d))
+        return index
+
+    def forget_ct_day(self, f, d: date):
+        os.remove(join(self.CT_DAYS_PATH, f))
+        self.day_index(f[0:10]).remove()
+        del self.indexes[f[0:10]]
+        self.journal.forget_day(d.isoformat())
+
+    @staticmethod
+    def day_file_date(f) -> date:
+        return date(int(f[0:4]), int(f[5:7]), int(f[8:10]))
+
+    def poll_ct(self):
+        """Download new CT entries and index them, finished days are left for process_ct"""
+        try:
+            self.prepare_ct()
+            self.download_ct()
+            for f in listdir(self.CT_DAYS_PATH):
+                try:
+                    self.index_ct_day(f, self.day_file_date(f))
+                except Exception as e:
+                    logging.error("An error occurs during indexing CT " + f + ": ")
+                    logging.error(str(e))
+        except Exception as e:
+            logging.error("A critical error occurs in CT process: ")
+            logging.error(str(e))
+
+    def process_ct(self):
+        """Download new CT entries, classify finished days and upload them into CMoCL"""
+        try:
+            self.prepare_ct()
+            journal = self.journal
+            today = date.today()
+            uploads = []
+            print("Certificate Transparency monitor")
+            self.download_ct()
+
+            # Process all past days
+            ct_days_path = self.CT_DAYS_PATH
+            ct_missing = set(self.cmocl.missing(self.CMOCL_CT_SOURCE, self.CMOCL_CT_PERIOD,
+                                                [f[0:10] for f in listdir(ct_days_path)]))
+            for f in listdir(ct_days_path):
+                path = join(ct_days_path, f)
+                try:
+                    d = self.day_file_date(f)
+                    if d.isoformat() not in ct_missing:
+                        logging.error("CT "+f+" is already in CMoCL")
+                        self.forget_ct_day(f, d)
+                        continue
+                    # New keys are indexed on every run, also for the current day
+                    index = self.index_ct_day(f, d)
+                    if d >= today:
+                        continue
+                    print("Processing "+f)
+                    out_path = self.storage_path + "/ct-" + f + "/prior_probability.json"
+                    day_size = os.path.getsize(path)
+                    state, classified_size = journal.day_state(d.isoformat())
+                    estimation = None
+                    if state == Journal.DAY_CLASSIFIED and classified_size == day_size and os.path.exists(out_path):
+                        print("Using estimation of the previous run")
+                        if not self.rollups.has_day(d):
+                            self.rollups.save_day(d, index)
+                    else:
+                        print("Statistics: ")
+                        stats = index.statistics()
+                        print("  Unique keys: " + str(stats["keys"]))
+                        print("  Duplicities: " + str(stats["duplicities"]))
+                        if stats["new"] is not None:
+                            print("  New keys: " + str(stats["new"]))
+
+                        try:
+                            print("Estimation prior probability")
+                            with self.metrics.stage("ct " + d.isoformat() + " classify") as stage:
+                                stage.records = stats["keys"]
+                                estimation = self.save_estimation(
+                                    index.estimator(self.classification_table), out_path, self.CMOCL_CT_SOURCE,
+                                    self.CMOCL_CT_PERIOD, d.isoformat())
+                                stage.output_bytes = Metrics.path_size(out_path)
+                            # Summary of the day for week and month estimations, kept after the day file is
+                            # removed, replaced when the day is classified again with more keys
+                            self.rollups.save_day(d, index)
+                            journal.mark_day(d.isoformat(), Journal.DAY_CLASSIFIED, day_size)
+                        except Exception as e:
+                            logging.error("A critical error occurs during classification, CT " + d.isoformat() + ": ")
+                            logging.error(str(e))
+                            continue
+                    uploads.append((f, d, out_path, estimation))
+                except (OSError, OverflowError) as e:
+                    logging.error("Wrong format of file name "+f+".")
+                    logging.error(str(e))
+                except Exception as e:
+                    logging.error("An error occurs during processing CT " + f + ": ")
+                    logging.error(str(e))
+
+            self.upload_ct_days(uploads)
+            self.process_ct_rollups(today)
+        except CMoCLError:
+            raise
+        except Exception as e:
+            logging.error("A critical error occurs in CT process: ")
+            logging.error(str(e))
+
+    async def upload_concurrently(self, uploads) -> list:
+        """Upload estimations by `cmocl-uploads` concurrent requests
+
+        :param uploads: List of dictionaries with keyword arguments of CMoCL.upload
+        :return: list of upload results in the given order, an exception in place of a failed upload
+        """
+        conf = self.conf
+        async with AsyncCMoCL(conf.get(conf.CONF_CMOCL_API_URL), conf.get(conf.CONF_CMOCL_API_KEY),
+                              int(conf.get_or_default(conf.CONF_CMOCL_UPLOADS, 8)),
+                              float(conf.get_or_default(conf.CONF_HTTP_TIMEOUT, 60))) as cmocl:
+            return await cmocl.upload_many(uploads)
+
+    def upload_ct_days(self, days):
+        """Upload estimations of classified days concurrently and forget uploaded days
+
+        Days left after an outage are uploaded together instead of one request after another.
+
+        :param days: List of tuples (day file, date, path to prior_probability.json, estimation or None to
+                     read it from the file)
+        """
+        if not days:
+            return
+        print("Uploading results of " + str(len(days)) + " CT days to CMoCL Database")
+        with self.metrics.stage("ct upload") as stage:
+            stage.records = len(days)
+            stage.input_bytes = sum(Metrics.path_size(out_path) for _, _, out_path, _ in days)
+            results = asyncio.run(self.upload_concurrently([
+                {"source": self.CMOCL_CT_SOURCE, "period": self.CMOCL_CT_PERIOD, "date": d.isoformat(),
+                 "file_path": out_path, "estimation": estimation} for _, d, out_path, estimation in days]))
+        self.cmocl.forget_stored_dates(self.CMOCL_CT_SOURCE, self.CMOCL_CT_PERIOD)
+        error = None
+        for (f, d, _, _), res in zip(days, results):
+            if isinstance(res, CMoCLError):
+                logging.error("A critical error occurs during communication with CMoCL, CT " + d.isoformat() + ": ")
+                logging.error(str(res))
+                error = res
+            elif isinstance(res, Exception):
+                logging.error("An error occurs during uploading CT " + d.isoformat() + ": ")
+                logging.error(str(res))
+            elif not res:
+                logging.error("Cannot upload results to CMoCL, CT " + d.isoformat() + ".")
+            else:
+                print("CT " + d.isoformat() + " successfully processed.")
+                self.journal.mark_day(d.isoformat(), Journal.DAY_UPLOADED)
+                self.forget_ct_day(f, d)
+        if error is not None:
+            raise error
+
+    def process_ct_rollups(self, today: date):
+        """Estimate and upload ended weeks and months of classified days missing in CMoCL"""
+        # Periods with days still waiting for classification or upload keep summaries of their days
+        pending = set()
+        for f in listdir(self.CT_DAYS_PATH):
+            try:
+                day = self.day_file_date(f)
+            except (ValueError, OverflowError):
+                continue
+            for period in Rollups.PERIODS:
+                pending.add((period, Rollups.period_days(period, day)[0]))
+
+        for period in Rollups.PERIODS:
+            candidates = [start.isoformat() for start in self.rollups.complete_periods(period, today)]
+            for start in self.cmocl.missing(self.CMOCL_CT_SOURCE, period, candidates):
+                print("Processing CT " + period + " " + start)
+                out_path = self.storage_path + "/ct-" + period + "-" + start + "/prior_probability.json"
+                try:
+                    with self.metrics.stage("ct " + period + " " + start + " rollup") as stage:
+                        days = Rollups.period_days(period, date.fromisoformat(start))
+                        estimator = self.rollups.estimator(self.classification_table, days)
+                        stage.records = int(estimator.counts.sum())
+                        estimation = self.save_estimation(estimator, out_path, self.CMOCL_CT_SOURCE, period, start)
+                        stage.output_bytes = Metrics.path_size(out_path)
+                    print("  Unique keys: " + str(stage.records))
+                    print("Uploading results to CMoCL Database")
+                    res = self.cmocl.upload(self.CMOCL_CT_SOURCE, period, start, out_path, estimation)
+                    if not res:
+                        logging.error("Cannot upload results to CMoCL, CT " + period + " " + start + ".")
+                        pending.add((period, date.fromisoformat(start)))
+                    else:
+                        print("CT " + period + " " + start + " successfully processed.\n")
+                except CMoCLError as e:
+                    logging.error("A critical error occurs during communication with CMoCL, CT " + period + " " +
+                                  start + ": ")
+                    logging.error(str(e))
+                    raise
+                except Exception as e:
+                    logging.error("An error occurs during processing CT " + period + " " + start + ": ")
+                    logging.error(str(e))
+                    pending.add((period, date.fromisoformat(start)))
+
+        for day in self.rollups.obsolete_days(today, pending):
+            self.rollups.remove_day(day)
+
+    def reestimate(self):
+        """Estimate stored data sets again from their mask histograms with the current classification table
+
+        Only estimations which changed are uploaded. Records already stored in CMoCL are replaced only with
+        `cmocl-replace`, since CMoCL API does not document replacing of records, otherwise they are skipped
+        and left for a later run. The histogram then records the new table, so an interrupted re-estimation
+        continues with the remaining data sets.
+        """
+        table = self.classification_table
+        replace = bool(self.conf.get_or_default(self.conf.CONF_CMOCL_REPLACE, False))
+        counts = {"unchanged": 0, "uploaded": 0, "skipped": 0, "failed": 0}
+        for f in sorted(listdir(self.storage_path)):
+            histogram_path = join(self.storage_path, f, PriorProbabilityEstimator.HISTOGRAM_FILE)
+            out_path = join(self.storage_path, f, PriorProbabilityEstimator.OUTPUT_FILE)
+            if not os.path.exists(histogram_path):
+                continue
+            try:
+                with open(histogram_path) as fp:
+                    histogram = json.load(fp)
+                if histogram["table"] == table.hash:
+                    counts["unchanged"] += 1
+                    continue
+                name = histogram["source"] + " " + histogram["period"] + " " + histogram["date"]
+                with self.metrics.stage("reestimate " + name) as stage:
+                    estimator = PriorProbabilityEstimator.from_histogram(table, histogram)
+                    stage.records = int(estimator.counts.sum())
+                    estimation = json.loads(json.dumps(estimator.to_json()))
+                previous = None
+                if os.path.exists(out_path):
+                    with open(out_path) as fp:
+                        previous = json.load(fp)
+                if estimation != previous:
+                    # Records which failed to upload before are uploaded
+                    upload = self.cmocl.upload
+                    if histogram["date"] in self.cmocl.stored_dates(histogram["source"], histogram["period"]):
+                        if not replace:
+                            logging.warning("Re-estimation of " + name + " is already stored in CMoCL, skipped. "
+                                            "Set cmocl-replace to replace it.")
+                            counts["skipped"] += 1
+                            continue
+                        upload = self.cmocl.replace
+                    print("Uploading re-estimation of " + name)
+                    if not upload(histogram["source"], histogram["period"], histogram["date"],
+                                  estimation=estimation):
+                        logging.error("Cannot upload results to CMoCL, " + name + ".")
+                        counts["failed"] += 1
+                        continue
+                    estimator.save(join(self.storage_path, f))
+                    counts["uploaded"] += 1
+                else:
+                    counts["unchanged"] += 1
+                estimator.save_histogram(join(self.storage_path, f), histogram["source"], histogram["period"],
+                                         histogram["date"])
+            except CMoCLError as e:
+                logging.error("A critical error occurs during communication with CMoCL, " + f + ": ")
+                logging.error(str(e))
+                raise
+            except Exception as e:
+                logging.error("An error occurs during re-estimation of " + f + ": ")
+                logging.error(str(e))
+                counts["failed"] += 1
+        print("Re-estimation: " + str(counts["uploaded"]) + " uploaded, " + str(counts["unchanged"]) +
+              " unchanged, " + str(counts["skipped"]) + " skipped, " + str(counts["failed"]) + " failed")
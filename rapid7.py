@@ -1,11 +1,18 @@
-import gzip
 import json
 import logging
 import os
 import shutil
 import sys
-import requests
+import threading
+import time
+import zlib
 import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from journal import save_json_atomically
+from session import Session
 
 
 class Rapid7Error(Exception):
@@ -13,9 +20,32 @@ class Rapid7Error(Exception):
     pass
 
 
+class Rapid7IntegrityError(Rapid7Error):
+    """Downloaded data set does not have expected size or fingerprint."""
+    pass
+
+
 class Rapid7:
-    def __init__(self, api_key):
+    RESUMABLE_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                        requests.exceptions.Timeout)
+    RESUME_RETRIES = 5
+    PROGRESS_INTERVAL = 10
+    DECOMPRESSORS = ("pigz", "isal", "zlib_ng", "zlib")
+    DECOMPRESS_CHUNK_SIZE = 1048576
+
+    def __init__(self, api_key, session=None, chunk_size=1048576, connections=1, decompressor=None):
+        """
+        :param api_key:      API key for Rapid7 OpenData
+        :param session:      Shared HTTP session, a new one is created if None
+        :param chunk_size:   Size of downloaded chunks in bytes
+        :param connections:  Number of connections downloading byte ranges of a data set in parallel
+        :param decompressor: Preferred decompressor, one of DECOMPRESSORS, the first available if None
+        """
         self.api_key = api_key
+        self.session = session if session is not None else Session()
+        self.chunk_size = chunk_size
+        self.connections = connections
+        self.decompressor = decompressor
         self.base_url = "https://us.api.insight.rapid7.com/opendata"
         self.data_url = self.base_url + "/studies/sonar.ssl/"
         self.quota_url = self.base_url + "/quota/"
@@ -33,7 +63,7 @@ class Rapid7:
         :return: list of names of data sets
         :raise: Rapid7Error
         """
-        response = requests.get(self.data_url, headers={"X-Api-Key": self.api_key})
+        response = self.session.get(self.data_url, headers={"X-Api-Key": self.api_key})
         if response.ok:
             response_json = json.loads(response.content)
 
@@ -53,7 +83,7 @@ class Rapid7:
             raise Rapid7Error("get_data_sets - request failed")
 
     def get_quota_info(self):
-        response = requests.get(self.quota_url, headers={"X-Api-Key": self.api_key})
+        response = self.session.get(self.quota_url, headers={"X-Api-Key": self.api_key})
         if response.ok:
             return json.loads(response.content)
         else:
@@ -68,7 +98,7 @@ class Rapid7:
         :return: dictionary with keys `size` and `fingerprint`
         :raise: Rapid7Error
         """
-        response = requests.get(self.data_url + data_name + "/", headers={"X-Api-Key": self.api_key})
+        response = self.session.get(self.data_url + data_name + "/", headers={"X-Api-Key": self.api_key})
         if response.ok:
             return response.json()
         else:
@@ -76,8 +106,271 @@ class Rapid7:
             logging.error(response.content)
             raise Rapid7Error("get_data_info - request failed")
 
+    def get_download_url(self, data_name) -> str:
+        """Get signed URL of a data set
+
+        :param data_name: Name of data set
+        :return: URL
+        :raise: Rapid7Error
+        """
+        response = self.session.get(self.data_url + data_name + "/download/",
+                                    headers={"X-Api-Key": self.api_key})
+        if response.ok:
+            response_json = response.json()
+            if "url" in response_json:
+                return response_json["url"]
+            logging.error("Rapid7 API - download: unknown response.")
+            logging.error(response.content)
+            raise Rapid7Error("download - unknown response")
+        else:
+            logging.error("Rapid7 API - download: Request failed.")
+            logging.error(response.content)
+            raise Rapid7Error("download - request failed")
+
+    def open_range(self, url, start, end=None):
+        """Request bytes [start, end) of a URL, the whole content for start 0 and no end
+
+        :raise: Rapid7Error if the request failed or the server ignored the range
+        """
+        headers = {}
+        if start > 0 or end is not None:
+            headers["Range"] = "bytes=" + str(start) + "-" + ("" if end is None else str(end - 1))
+        response = self.session.get(url, stream=True, headers=headers)
+        if response.status_code == 416 and end is None and self.range_total(response) == start:
+            # Nothing is left after start, e.g. of a complete partial file
+            return response
+        if not response.ok or (headers and response.status_code != 206):
+            response.close()
+            logging.error("Rapid7 API - download: Request failed with status " + str(response.status_code) + ".")
+            raise Rapid7Error("download - request failed")
+        return response
+
+    @staticmethod
+    def range_total(response):
+        """Total length from `Content-Range` of a 206 or 416 response, None if it is missing"""
+        try:
+            return int(response.headers["content-range"].rsplit("/", 1)[1])
+        except (KeyError, ValueError):
+            return None
+
+    @staticmethod
+    def total_length(response) -> int:
+        if response.status_code in (206, 416):
+            return Rapid7.range_total(response)
+        return int(response.headers.get("content-length"))
+
+    @staticmethod
+    def check_size(info, total_length):
+        if info is not None and total_length != info["size"]:
+            logging.error("Rapid7 API - download: different size.")
+            logging.error("Expected: "+str(info["size"])+", Real: "+str(total_length))
+            raise Rapid7IntegrityError("download - downloading file does not have expected size")
+
+    @staticmethod
+    def check_fingerprint(info, hash_calc):
+        fingerprint = hash_calc.hexdigest()
+        if info is not None and fingerprint != info["fingerprint"]:
+            logging.error("Rapid7 API - download: different fingerprint.")
+            logging.error("Expected: "+str(info["fingerprint"])+", Real: "+fingerprint)
+            raise Rapid7IntegrityError("download - downloading file does not have expected fingerprint")
+
+    def stream(self, data_name, info=None, show_progress=False, start=0, hash_calc=None):
+        """Generate compressed chunks of a data set
+
+        Size is checked before the first chunk and SHA-1 fingerprint after the last one. A dropped connection
+        is resumed by a range request from the last received byte of the same signed URL.
+
+        :param data_name: Name of data sets
+        :param info:      Dictionary obtained by get_data_info with keys `size` and `fingerprint`
+        :param show_progress: Show progress to stdout
+        :param start:     Offset of the first chunk, for resuming a partial download
+        :param hash_calc: SHA-1 of bytes before start
+        :raise: Rapid7Error
+        """
+        if hash_calc is None:
+            hash_calc = hashlib.sha1()
+        position = start
+        total_length = info["size"] if info is not None and start >= info["size"] else None
+        url = None
+        failures = 0
+        while total_length is None or position < total_length:
+            if url is None:
+                url = self.get_download_url(data_name)
+            attempt_start = position
+            try:
+                with self.open_range(url, position) as r:
+                    if total_length is None:
+                        total_length = self.total_length(r)
+                        self.check_size(info, total_length)
+                        if show_progress:
+                            print("Downloading " + data_name + " ["+str(total_length)+" B]")
+                    # Body of 416 is not a part of the data set
+                    chunks = r.iter_content(chunk_size=self.chunk_size) if r.status_code != 416 else []
+                    for chunk in chunks:
+                        if chunk:
+                            hash_calc.update(chunk)
+                            position += len(chunk)
+                            yield chunk
+                            if show_progress:
+                                self.show_progress(position, total_length)
+                if position < total_length:
+                    raise requests.exceptions.ChunkedEncodingError("connection closed before the end")
+            except self.RESUMABLE_ERRORS as e:
+                # Only failures without any progress are counted
+                failures = failures + 1 if position == attempt_start else 1
+                if failures > self.RESUME_RETRIES:
+                    raise Rapid7Error("download - connection failed: " + str(e))
+                logging.warning("Rapid7 API - download: connection dropped at " + str(position) + " B, resuming.")
+        if show_progress:
+            sys.stdout.write("\n")
+        self.check_fingerprint(info, hash_calc)
+
+    @staticmethod
+    def show_progress(position, total_length):
+        done = int(50 * position / total_length)
+        sys.stdout.write("\r[%s%s]" % ('=' * done, ' ' * (50 - done)))
+        sys.stdout.flush()
+
+    def stream_parallel(self, data_name, part_path, info=None, show_progress=False):
+        """Generate compressed chunks of a data set downloaded by parallel range requests
+
+        Byte ranges are downloaded by `connections` threads into part_path and chunks are read back in order
+        as soon as they are contiguous, so the fingerprint is computed during the download. Progress of
+        ranges is stored in `part_path.ranges` and an interrupted download is resumed by a later call.
+
+        :param data_name: Name of data sets
+        :param part_path: Path to the partial file, removed if the data set is damaged
+        :param info:      Dictionary obtained by get_data_info with keys `size` and `fingerprint`
+        :param show_progress: Show progress to stdout
+        :raise: Rapid7Error
+        """
+        url = self.get_download_url(data_name)
+        with self.open_range(url, 0, 1) as r:
+            total_length = self.total_length(r)
+        self.check_size(info, total_length)
+
+        state_path = part_path + ".ranges"
+        ranges = None
+        if os.path.exists(part_path) and os.path.exists(state_path):
+            with open(state_path) as fp:
+                state = json.load(fp)
+            if state["size"] == total_length:
+                ranges = state["ranges"]
+        if ranges is None:
+            step = -(-total_length // self.connections)
+            ranges = [[start, min(start + step, total_length), start] for start in range(0, total_length, step)]
+        with open(part_path, "r+b" if os.path.exists(part_path) else "wb") as fp:
+            fp.truncate(total_length)
+        if show_progress:
+            print("Downloading " + data_name + " ["+str(total_length)+" B] by " + str(len(ranges)) + " connections")
+
+        condition = threading.Condition()
+        stop = threading.Event()
+
+        def save_ranges():
+            with condition:
+                content = {"size": total_length, "ranges": [list(r) for r in ranges]}
+            save_json_atomically(state_path, content)
+
+        def download_range(byte_range):
+            failures = 0
+            with open(part_path, "r+b") as fop:
+                while byte_range[2] < byte_range[1] and not stop.is_set():
+                    attempt_start = byte_range[2]
+                    try:
+                        with self.open_range(url, byte_range[2], byte_range[1]) as r:
+                            fop.seek(byte_range[2])
+                            for chunk in r.iter_content(chunk_size=self.chunk_size):
+                                if stop.is_set():
+                                    return
+                                fop.write(chunk)
+                                fop.flush()
+                                with condition:
+                                    byte_range[2] += len(chunk)
+                                    condition.notify_all()
+                        if byte_range[2] < byte_range[1]:
+                            raise requests.exceptions.ChunkedEncodingError("connection closed before the end")
+                    except self.RESUMABLE_ERRORS as e:
+                        failures = failures + 1 if byte_range[2] == attempt_start else 1
+                        if failures > self.RESUME_RETRIES:
+                            raise Rapid7Error("download - connection failed: " + str(e))
+                        logging.warning("Rapid7 API - download: connection dropped at " + str(byte_range[2]) +
+                                        " B, resuming.")
+
+        hash_calc = hashlib.sha1()
+        position = 0
+        saved = time.monotonic()
+        with ThreadPoolExecutor(max_workers=max(1, len(ranges))) as executor:
+            futures = [executor.submit(download_range, byte_range) for byte_range in ranges]
+            try:
+                # Unbuffered, a read buffer could keep bytes not written yet
+                with open(part_path, "rb", buffering=0) as fp:
+                    for byte_range in ranges:
+                        while position < byte_range[1]:
+                            with condition:
+                                while byte_range[2] <= position:
+                                    for future in futures:
+                                        if future.done() and future.exception() is not None:
+                                            raise future.exception()
+                                    condition.wait(1)
+                                available = byte_range[2]
+                            fp.seek(position)
+                            while position < available:
+                                chunk = fp.read(min(self.chunk_size, available - position))
+                                hash_calc.update(chunk)
+                                position += len(chunk)
+                                yield chunk
+                            if show_progress:
+                                self.show_progress(position, total_length)
+                            if time.monotonic() - saved > self.PROGRESS_INTERVAL:
+                                save_ranges()
+                                saved = time.monotonic()
+            finally:
+                stop.set()
+                save_ranges()
+        if show_progress:
+            sys.stdout.write("\n")
+        try:
+            self.check_fingerprint(info, hash_calc)
+        except Rapid7IntegrityError:
+            os.remove(part_path)
+            os.remove(state_path)
+            raise
+        os.remove(state_path)
+
+    def stream_resumable(self, data_name, part_path, info=None, show_progress=False):
+        """Generate compressed chunks of a data set downloaded by one connection into part_path
+
+        Chunks already stored in part_path by an interrupted call are generated first and the download is
+        resumed after them by a range request.
+
+        :param data_name: Name of data sets
+        :param part_path: Path to the partial file, removed if the data set is damaged
+        :param info:      Dictionary obtained by get_data_info with keys `size` and `fingerprint`
+        :param show_progress: Show progress to stdout
+        :raise: Rapid7Error
+        """
+        start = 0
+        hash_calc = hashlib.sha1()
+        if os.path.exists(part_path):
+            with open(part_path, "rb") as f:
+                for chunk in iter(lambda: f.read(self.chunk_size), b""):
+                    hash_calc.update(chunk)
+                    start += len(chunk)
+                    yield chunk
+        try:
+            with open(part_path, "ab") as f:
+                for chunk in self.stream(data_name, info, show_progress, start, hash_calc):
+                    f.write(chunk)
+                    yield chunk
+        except Rapid7IntegrityError:
+            os.remove(part_path)
+            raise
+
     def download(self, data_name, out_path, info=None, show_progress=False):
-        """Download
+        """Download into `out_path.part`, which is renamed when complete
+
+        A partial file of an interrupted download is resumed, a damaged one is removed.
 
         :param data_name: Name of data sets
         :param out_path:  Path to a file, where should be dataset stored
@@ -85,65 +378,196 @@ class Rapid7:
         :param show_progress: Show progress to stdout
         :raise: Rapid7Error
         """
-        response = requests.get(self.data_url + data_name + "/download/", headers={"X-Api-Key": self.api_key})
-        if response.ok:
-            response_json = response.json()
+        part_path = out_path + ".part"
+        if self.connections > 1:
+            chunks = self.stream_parallel(data_name, part_path, info, show_progress)
+        else:
+            chunks = self.stream_resumable(data_name, part_path, info, show_progress)
+        for _ in chunks:
+            pass
+        os.replace(part_path, out_path)
 
-            if "url" in response_json:
-                url = response_json["url"]
-                with requests.get(url, stream=True) as r:
-                    total_length = int(r.headers.get('content-length'))
-                    if info is not None and total_length != info["size"]:
-                        logging.error("Rapid7 API - download: different size.")
-                        logging.error("Expected: "+str(info["size"])+", Real: "+str(total_length))
-                        raise Rapid7Error("download - downloading file does not have expected size")
-
-                    if show_progress:
-                        print("Downloading " + data_name + " ["+str(total_length)+" B]")
-                        dl = 0
-
-                    hash_calc = hashlib.sha1()
-                    with open(out_path, 'wb') as f:
-                        for chunk in r.iter_content(chunk_size=8192):
-                            if chunk:
-                                f.write(chunk)
-                                hash_calc.update(chunk)
+    def process(self, data_name, file_out, info=None, workers=1, memory_limit=None, temporary_path=None,
+                estimator=None):
+        """Download, decompress, convert and remove duplicities of a data set without intermediate files
 
-                                if show_progress:
-                                    dl += len(chunk)
-                                    done = int(50 * dl / total_length)
-                                    sys.stdout.write("\r[%s%s]" % ('=' * done, ' ' * (50 - done)))
-                                    sys.stdout.flush()
-                    if show_progress:
-                        sys.stdout.write("\n")
-
-                    fingerprint = hash_calc.hexdigest()
-                    if info is not None and fingerprint != info["fingerprint"]:
-                        logging.error("Rapid7 API - download: different size.")
-                        logging.error("Expected: "+str(info["size"])+", Real: "+str(total_length))
-                        raise Rapid7Error("download - downloading file does not have expected size")
-            else:
-                logging.error("Rapid7 API - download: unknown response.")
-                logging.error(response.content)
-                raise Rapid7Error("download - unknown response")
+        :param data_name:      Name of data sets
+        :param file_out:       Path to JSON-lines file with unique keys
+        :param info:           Dictionary obtained by get_data_info with keys `size` and `fingerprint`
+        :param workers:        Number of worker processes decoding certificates
+        :param memory_limit:   Memory budget of removing duplicities in bytes, None for unlimited
+        :param temporary_path: Directory for spilled partitions of removing duplicities
+        :param estimator:      PriorProbabilityEstimator fed by every unique key, optional
+        :return: dictionary with counters `rsa`, `all` and `errors`
+        :raise: Rapid7Error
+        """
+        from dataset import Dataset
+        from keystore import KeyStore
+
+        results = {"rsa": 0, "all": 0, "errors": 0}
+        # Compressed data set is kept until the end, so a later call resumes an interrupted download
+        if self.connections > 1:
+            chunks = self.stream_parallel(data_name, file_out + ".gz.part", info)
         else:
-            logging.error("Rapid7 API - download: Request failed.")
-            logging.error(response.content)
-            raise Rapid7Error("download - request failed")
+            chunks = self.stream_resumable(data_name, file_out + ".gz.part", info)
+        lines = Rapid7.lines(Rapid7.decompress_stream(chunks, self.decompressor))
+        records = Rapid7.Converter.convert_lines(lines, results, data_name, True, workers)
+        keys = (KeyStore.decode(record, KeyStore.RECORD_LENGTH.size) for batch in records for record in batch)
+        Dataset.write_unique(keys, file_out, memory_limit, temporary_path, estimator)
+        if os.path.exists(file_out + ".gz.part"):
+            os.remove(file_out + ".gz.part")
+        return results
+
+    @staticmethod
+    def zlib_module(name):
+        """zlib compatible module of a decompressor or None if it is not installed"""
+        try:
+            if name == "isal":
+                from isal import isal_zlib as module
+            elif name == "zlib_ng":
+                from zlib_ng import zlib_ng as module
+            elif name == "zlib":
+                module = zlib
+            else:
+                return None
+        except ImportError:
+            return None
+        return module
+
+    @staticmethod
+    def decompressor_name(preferred=None) -> str:
+        """First available decompressor, the preferred one is tried first
+
+        pigz runs in its own process, so decompression uses other cores than conversion. isal and zlib-ng
+        bindings are faster drop-in replacements of zlib.
+        """
+        for name in ([preferred] if preferred else []) + list(Rapid7.DECOMPRESSORS):
+            if name == "pigz":
+                if shutil.which("pigz") is not None:
+                    return name
+            elif Rapid7.zlib_module(name) is not None:
+                return name
+        return "zlib"
+
+    @staticmethod
+    def decompress_stream(chunks, decompressor=None):
+        """Decompress gz archive incrementally
+
+        :param chunks:       Iterable of compressed chunks, concatenated gzip members are supported
+        :param decompressor: Preferred decompressor, one of DECOMPRESSORS, the first available if None
+        :return: generator of decompressed chunks
+        """
+        name = Rapid7.decompressor_name(decompressor)
+        if name == "pigz":
+            yield from Rapid7.pigz_stream(chunks)
+            return
+
+        module = Rapid7.zlib_module(name)
+        decompressor = module.decompressobj(16 + module.MAX_WBITS)
+        for chunk in chunks:
+            while chunk:
+                data = decompressor.decompress(chunk)
+                if data:
+                    yield data
+                if not decompressor.eof:
+                    break
+                chunk = decompressor.unused_data
+                decompressor = module.decompressobj(16 + module.MAX_WBITS)
+        data = decompressor.flush()
+        if data:
+            yield data
 
     @staticmethod
-    def decompress(file_in, file_out=None):
+    def pigz_stream(chunks):
+        """Decompress chunks by pigz process, chunks are fed by a thread
+
+        :raise: Rapid7Error if pigz fails, errors of chunks are raised after the output is read
+        """
+        import subprocess
+
+        process = subprocess.Popen(["pigz", "-dc"], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   stderr=subprocess.DEVNULL)
+        errors = []
+
+        def feed():
+            try:
+                for chunk in chunks:
+                    process.stdin.write(chunk)
+            except BrokenPipeError:
+                pass
+            except Exception as e:
+                errors.append(e)
+            finally:
+                try:
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        try:
+            for data in iter(lambda: process.stdout.read(Rapid7.DECOMPRESS_CHUNK_SIZE), b""):
+                yield data
+        finally:
+            if process.poll() is None and feeder.is_alive():
+                process.kill()
+            feeder.join()
+            process.stdout.close()
+            returncode = process.wait()
+        if errors:
+            raise errors[0]
+        if returncode != 0:
+            raise Rapid7Error("decompress - pigz failed with code " + str(returncode))
+
+    @staticmethod
+    def lines(chunks):
+        """Split decompressed chunks into text lines
+
+        :param chunks: Iterable of bytes
+        :return: generator of lines including the line separator
+        """
+        rest = b""
+        for chunk in chunks:
+            parts = (rest + chunk).split(b"\n")
+            rest = parts.pop()
+            for part in parts:
+                yield part.decode("UTF-8", "replace") + "\n"
+        if rest:
+            yield rest.decode("UTF-8", "replace")
+
+    @staticmethod
+    def file_chunks(file_in):
+        with open(file_in, "rb") as fp:
+            for chunk in iter(lambda: fp.read(Rapid7.DECOMPRESS_CHUNK_SIZE), b""):
+                yield chunk
+
+    @staticmethod
+    def file_lines(file_in, decompressor=None):
+        """Generate text lines of a data set, a gz archive is decompressed on the fly
+
+        :param file_in:      Path to a data set, gz archive if it ends with `.gz`
+        :param decompressor: Preferred decompressor of gz archive
+        """
+        if file_in.endswith(".gz"):
+            yield from Rapid7.lines(Rapid7.decompress_stream(Rapid7.file_chunks(file_in), decompressor))
+            return
+        with open(file_in) as fp:
+            yield from fp
+
+    @staticmethod
+    def decompress(file_in, file_out=None, decompressor=None):
         """Decompress gz archive
 
-        :param file_in:  Path to archive
-        :param file_out: Where store the decompressed data
+        :param file_in:      Path to archive
+        :param file_out:     Where store the decompressed data
+        :param decompressor: Preferred decompressor, the first available if None
         :return:
         """
         if file_out is None:
             file_out = os.path.splitext(file_in)[0]
-        with gzip.open(file_in, 'rb') as f_in:
-            with open(file_out, 'wb') as f_out:
-                shutil.copyfileobj(f_in, f_out)
+        with open(file_out, 'wb') as f_out:
+            for data in Rapid7.decompress_stream(Rapid7.file_chunks(file_in), decompressor):
+                f_out.write(data)
 
     class Converter:
         @staticmethod
@@ -167,33 +591,163 @@ class Rapid7:
             return None
 
         @staticmethod
-        def convert(file_in, file_out):
+        def convert_certificate(line):
+            """Extract RSA key from one line of a data set
+
+            :param line: Line in format `name,base64 DER certificate`
+            :return: Key or None for non-RSA certificates
+            """
             import base64
+
+            cert64 = line.split(",")[1]
+            return Rapid7.Converter.certificate_key(base64.b64decode(cert64))
+
+        @staticmethod
+        def certificate_key(cert_bin):
+            """Extract RSA key from a DER certificate
+
+            Fields are read by the DER walker, certificates it does not handle or cannot decode are parsed
+            by cryptography.
+
+            :param cert_bin: DER encoded certificate
+            :return: Key or None for non-RSA certificates
+            """
+            from dataset import Key
+            from der import Der, DerError
+
+            try:
+                fields = Der.parse_certificate(cert_bin)
+            except (DerError, ValueError):
+                return Rapid7.Converter.certificate_key_x509(cert_bin)
+            if fields is None:
+                return None
+            n, e, cname, not_before = fields
+            return Key([cname, not_before], n, e, 1)
+
+        @staticmethod
+        def certificate_key_x509(cert_bin):
             from dataset import Key
             from cryptography.x509.base import load_der_x509_certificate
             from cryptography.hazmat.backends import default_backend
             from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicKey
 
+            cert = load_der_x509_certificate(cert_bin, default_backend())
+            pub = cert.public_key()
+
+            if not isinstance(pub, RSAPublicKey):
+                return None
+            not_before = cert.not_valid_before
+            cname = Rapid7.Converter.try_get_cname(cert)
+
+            pub_num = pub.public_numbers()
+            return Key([cname, not_before.strftime('%Y-%m-%d')], pub_num.n, pub_num.e, 1)
+
+        @staticmethod
+        def convert_batch(batch):
+            """Convert a batch of lines, runs in worker processes
+
+            :param batch: tuple (index of the first line, list of lines, binary output)
+            :return: tuple (serialized keys, counters, list of (line index, error message))
+            """
+            from keystore import KeyStore
+
+            first, lines, binary = batch
+            records = []
+            results = {"rsa": 0, "all": 0, "errors": 0}
+            errors = []
+            for cnt, line in enumerate(lines, first):
+                results["all"] += 1
+                try:
+                    key = Rapid7.Converter.convert_certificate(line)
+                    if key is not None:
+                        records.append(KeyStore.encode(key) if binary else key.get_as_string() + "\n")
+                        results["rsa"] += 1
+                except Exception as e:
+                    results["errors"] += 1
+                    errors.append((cnt, str(e)))
+            return records, results, errors
+
+        @staticmethod
+        def batches(lines, batch_size, binary):
+            batch = []
+            first = 0
+            for line in lines:
+                batch.append(line)
+                if len(batch) >= batch_size:
+                    yield first, batch, binary
+                    first += len(batch)
+                    batch = []
+            if batch:
+                yield first, batch, binary
+
+        @staticmethod
+        def process_pool(workers):
+            """Pool of worker processes safe to start next to running threads
+
+            Download and decompression threads may be running, so workers are not forked from this process
+            but started by a fork server, or spawned where it is not available.
+            """
+            import multiprocessing
+            methods = multiprocessing.get_all_start_methods()
+            return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn").Pool(workers)
+
+        @staticmethod
+        def convert_lines(lines, results, name, binary=False, workers=1, batch_size=10000):
+            """Convert lines of a data set to serialized keys
+
+            Batches are converted by a pool of worker processes if `workers` is greater than 1. Results are
+            generated in the order of input lines and at most two batches per worker are in flight.
+
+            :param lines:      Iterable of data set lines
+            :param results:    Dictionary with counters `rsa`, `all` and `errors` to update
+            :param name:       Name of data set used in warnings
+            :param binary:     Serialize keys into binary key store records instead of JSON-lines
+            :param workers:    Number of worker processes
+            :param batch_size: Number of lines in one batch
+            :return: generator of lists of serialized keys
+            """
+            def collect(output):
+                records, batch_results, errors = output
+                for counter in batch_results:
+                    results[counter] += batch_results[counter]
+                for cnt, message in errors:
+                    logging.warning('Processing of dataset %s: %s, line %d' % (name, message, cnt))
+                return records
+
+            batches = Rapid7.Converter.batches(lines, batch_size, binary)
+            if workers <= 1:
+                for batch in batches:
+                    yield collect(Rapid7.Converter.convert_batch(batch))
+                return
+
+            from collections import deque
+            with Rapid7.Converter.process_pool(workers) as pool:
+                pending = deque()
+                for batch in batches:
+                    pending.append(pool.apply_async(Rapid7.Converter.convert_batch, (batch,)))
+                    if len(pending) >= 2 * workers:
+                        yield collect(pending.popleft().get())
+                while pending:
+                    yield collect(pending.popleft().get())
+
+        @staticmethod
+        def convert(file_in, file_out, binary=False, workers=1, batch_size=10000):
+            """Extract RSA keys from a data set
+
+            :param file_in:    Path to data set, gz archive is decompressed on the fly
+            :param file_out:   Path to output file with keys
+            :param binary:     Store keys into a binary key store instead of JSON-lines
+            :param workers:    Number of worker processes decoding certificates
+            :param batch_size: Number of lines sent to a worker at once
+            :return: dictionary with counters `rsa`, `all` and `errors`
+            """
+            from keystore import KeyStoreWriter
+
             results = {"rsa": 0, "all": 0, "errors": 0}
-            with open(file_in) as fp:
-                with open(file_out, "w") as fop:
-                    for cnt, line in enumerate(fp):
-                        results["all"] += 1
-                        try:
-                            cert64 = line.split(",")[1]
-                            cert_bin = base64.b64decode(cert64)
-                            cert = load_der_x509_certificate(cert_bin, default_backend())
-                            pub = cert.public_key()
-
-                            if isinstance(pub, RSAPublicKey):
-                                not_before = cert.not_valid_before
-                                cname = Rapid7.Converter.try_get_cname(cert)
-
-                                pub_num = pub.public_numbers()
-                                key = Key([cname, not_before.strftime('%Y-%m-%d')], pub_num.n, pub_num.e, 1)
-                                fop.write(key.get_as_string() + "\n")
-                                results["rsa"] += 1
-                        except Exception as e:
-                            results["errors"] += 1
-                            logging.warning('Processing of dataset %s: %s, line %d' % (file_in, e, cnt))
+            lines = Rapid7.file_lines(file_in)
+            with (KeyStoreWriter(file_out) if binary else open(file_out, "w")) as fop:
+                write = fop.write_encoded if binary else fop.write
+                for records in Rapid7.Converter.convert_lines(lines, results, file_in, binary, workers, batch_size):
+                    for record in records:
+                        write(record)
             return results
@@ -0,0 +1,225 @@
+import json
+import os
+from datetime import date
+
+import numpy as np
+
+from journal import save_json_atomically
+
+
+class KeyRegistry:
+    """Persistent registry of keys seen in any source with the date and source of their first occurrence
+
+    Entries are stored in runs sorted by fingerprint and opened as memory maps, so lookups touch only
+    the searched pages and memory does not grow with the number of keys. Every field of a run is a separate
+    contiguous array file, so lookups and merges search the fingerprints without copying them. Every registration writes a new
+    run and the last runs are merged while the newest is at least half of the previous one, which keeps
+    a logarithmic number of runs. Runs are merged by streaming them in chunks, so also merges into the
+    largest run need memory of a few chunks.
+    """
+
+    STATE_FILE = "registry.json"
+    ENTRY = np.dtype([("fingerprint", "<u8"), ("day", "<u4"), ("source", "<u2")])
+    MERGE_CHUNK = 1 << 20
+
+    def __init__(self, path):
+        """
+        :param path: Directory of the registry
+        """
+        self.path = path
+        self.state = {"runs": [], "next_run": 0, "sources": []}
+        if not os.path.exists(path):
+            os.makedirs(path)
+        state_path = os.path.join(path, self.STATE_FILE)
+        if os.path.exists(state_path):
+            with open(state_path) as fp:
+                self.state.update(json.load(fp))
+        self.runs = [self.load_run(run) for run in self.state["runs"]]
+
+    def __len__(self):
+        return sum(len(run["fingerprint"]) for run in self.runs)
+
+    def run_path(self, run, field):
+        return os.path.join(self.path, "%d.%s.npy" % (run, field))
+
+    def load_run(self, run):
+        """Memory maps of fields of a run, runs in one structured file of older versions are split first"""
+        legacy_path = os.path.join(self.path, "%d.npy" % run)
+        if os.path.exists(legacy_path):
+            self.save_run(run, np.load(legacy_path))
+            os.remove(legacy_path)
+        return {field: np.load(self.run_path(run, field), mmap_mode="r") for field in self.ENTRY.names}
+
+    def save_run(self, run, entries):
+        for field in self.ENTRY.names:
+            np.save(self.run_path(run, field), np.ascontiguousarray(entries[field], dtype=self.ENTRY[field]))
+
+    def remove_run(self, run):
+        for field in self.ENTRY.names:
+            os.remove(self.run_path(run, field))
+
+    def save(self):
+        save_json_atomically(os.path.join(self.path, self.STATE_FILE), self.state)
+
+    def source_id(self, source) -> int:
+        if source not in self.state["sources"]:
+            self.state["sources"].append(source)
+        return self.state["sources"].index(source)
+
+    @staticmethod
+    def fingerprints(keys):
+        return np.array([int(k.fingerprint(), 16) for k in keys], dtype=np.uint64)
+
+    def find(self, fingerprints):
+        """Find registered entries of fingerprints
+
+        :param fingerprints: numpy uint64 array
+        :return: tuple (boolean array of found fingerprints, array of their entries)
+        """
+        found = np.zeros(len(fingerprints), dtype=bool)
+        entries = np.zeros(len(fingerprints), dtype=self.ENTRY)
+        for run in self.runs:
+            run_fingerprints = run["fingerprint"]
+            position = np.minimum(np.searchsorted(run_fingerprints, fingerprints), len(run_fingerprints) - 1)
+            match = run_fingerprints[position] == fingerprints
+            for field in self.ENTRY.names:
+                entries[field][match] = run[field][position[match]]
+            found |= match
+        return found, entries
+
+    def first_seen(self, key):
+        """Date and source of the first occurrence of a key
+
+        :return: tuple (date, source) or None for an unknown key
+        """
+        found, entries = self.find(self.fingerprints([key]))
+        if not found[0]:
+            return None
+        return date.fromordinal(int(entries[0]["day"])), self.state["sources"][int(entries[0]["source"])]
+
+    def register(self, keys, source, day: date):
+        """Register keys and find out which of them are new
+
+        A key is new if it was not registered before or its first occurrence is the same source and day,
+        so registering a data set again gives the same result.
+
+        :param keys:   List of keys
+        :param source: Name of the source, e.g. `rapid7` or `ct`
+        :param day:    Date of the data set
+        :return: numpy boolean array, True for new keys
+        """
+        if not keys:
+            return np.zeros(0, dtype=bool)
+        source_id = self.source_id(source)
+        fingerprints = self.fingerprints(keys)
+        found, entries = self.find(fingerprints)
+        new = ~found | ((entries["day"] == day.toordinal()) & (entries["source"] == source_id))
+
+        unique, first = np.unique(fingerprints[~found], return_index=True)
+        if len(unique) > 0:
+            self.add_run({
+                "fingerprint": unique,
+                "day": np.full(len(unique), day.toordinal(), dtype=self.ENTRY["day"]),
+                "source": np.full(len(unique), source_id, dtype=self.ENTRY["source"])
+            })
+            # Later occurrences of a key within the batch are recurring
+            first_occurrence = np.zeros(len(keys), dtype=bool)
+            first_occurrence[np.flatnonzero(~found)[first]] = True
+            new[~found] = first_occurrence[~found]
+        return new
+
+    def add_run(self, run):
+        """Save a run sorted by fingerprint, merged with the last runs while they are at most twice its size
+
+        :param run: Dictionary of field arrays
+        """
+        merged = [run]
+        size = len(run["fingerprint"])
+        obsolete = []
+        runs = self.state["runs"]
+        while runs and len(self.runs[-1]["fingerprint"]) <= 2 * size:
+            merged.insert(0, self.runs.pop())
+            size += len(merged[0]["fingerprint"])
+            obsolete.append(runs.pop())
+        number = self.state["next_run"]
+        if len(merged) == 1:
+            self.save_run(number, run)
+        else:
+            self.merge_runs(merged, number)
+        del merged
+        runs.append(number)
+        self.state["next_run"] = number + 1
+        self.save()
+        self.runs.append(self.load_run(number))
+        for number in obsolete:
+            self.remove_run(number)
+
+    def merge_runs(self, runs, number):
+        """Merge runs sorted by fingerprint into a new run chunk by chunk
+
+        Every step takes entries up to the smallest last fingerprint of the next MERGE_CHUNK entries of runs,
+        so memory is bounded by MERGE_CHUNK entries per run, whatever the size of runs.
+
+        :param runs:   Runs sorted by fingerprint, from the oldest
+        :param number: Number of the merged run
+        """
+        total = sum(len(run["fingerprint"]) for run in runs)
+        out = {field: np.lib.format.open_memmap(self.run_path(number, field), mode="w+", dtype=self.ENTRY[field],
+                                                shape=(total,))
+               for field in self.ENTRY.names}
+        positions = [0] * len(runs)
+        written = 0
+        while written < total:
+            bound = None
+            for run, position in zip(runs, positions):
+                if position + self.MERGE_CHUNK < len(run["fingerprint"]):
+                    last = run["fingerprint"][position + self.MERGE_CHUNK - 1]
+                    bound = last if bound is None else min(bound, last)
+            pieces = []
+            for i, run in enumerate(runs):
+                end = positions[i] + self.MERGE_CHUNK
+                if bound is not None:
+                    fingerprints = run["fingerprint"][positions[i]:end]
+                    end = positions[i] + np.searchsorted(fingerprints, bound, side="right")
+                pieces.append({field: np.array(run[field][positions[i]:end]) for field in self.ENTRY.names})
+                positions[i] += len(pieces[-1]["fingerprint"])
+            # Position of an entry in the merged chunk is its position in its piece plus the number of
+            # smaller entries of other pieces, equal entries of older runs go first
+            size = sum(len(piece["fingerprint"]) for piece in pieces)
+            for i, piece in enumerate(pieces):
+                rank = np.arange(len(piece["fingerprint"])) + written
+                for j, other in enumerate(pieces):
+                    if j != i:
+                        rank += np.searchsorted(other["fingerprint"], piece["fingerprint"],
+                                                side="right" if j < i else "left")
+                for field in self.ENTRY.names:
+                    out[field][rank] = piece[field]
+            written += size
+        for array in out.values():
+            array.flush()
+        del out
+
+
+class RegistryFilter:
+    """Register keys passed to an estimator and count new and recurring keys
+
+    Used as the key filter of PriorProbabilityEstimator, with `new_only` only keys first seen in the data
+    set are classified.
+    """
+
+    def __init__(self, registry: KeyRegistry, source, day: date, new_only=False):
+        self.registry = registry
+        self.source = source
+        self.day = day
+        self.new_only = new_only
+        self.new = 0
+        self.recurring = 0
+
+    def __call__(self, keys):
+        new = self.registry.register(keys, self.source, self.day)
+        count = int(new.sum())
+        self.new += count
+        self.recurring += len(keys) - count
+        if self.new_only:
+            return [k for k, is_new in zip(keys, new) if is_new]
+        return keys
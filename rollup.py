@@ -0,0 +1,90 @@
+import os
+from datetime import date, timedelta
+
+import numpy as np
+
+from classification import ClassificationTable, PriorProbabilityEstimator
+from cmocl import CMoCL
+from keyindex import KeyIndex
+
+
+class Rollups:
+    """Week and month estimations merged from summaries of classified days
+
+    A summary of a day is the array of fingerprints and mask codes of its classified unique keys taken from
+    its KeyIndex. Summaries of the days of a period are merged by fingerprint, so a key seen on more days
+    of the period is counted once, and no day file is read again.
+    """
+
+    PERIODS = (CMoCL.PERIOD_WEEK, CMoCL.PERIOD_MONTH)
+
+    def __init__(self, path):
+        """
+        :param path: Directory of day summaries
+        """
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def summary_path(self, day: date):
+        return os.path.join(self.path, day.isoformat() + ".npy")
+
+    def has_day(self, day: date) -> bool:
+        return os.path.exists(self.summary_path(day))
+
+    def days(self) -> list:
+        return sorted(date.fromisoformat(f[:-len(".npy")]) for f in os.listdir(self.path) if f.endswith(".npy"))
+
+    def save_day(self, day: date, index: KeyIndex):
+        """Store summary of a classified day"""
+        path = self.summary_path(day)
+        np.save(path + ".tmp.npy", index.classified())
+        os.replace(path + ".tmp.npy", path)
+
+    def remove_day(self, day: date):
+        if self.has_day(day):
+            os.remove(self.summary_path(day))
+
+    @staticmethod
+    def period_days(period, day: date) -> list:
+        """Days of the week (from Monday) or the month containing a day"""
+        if period == CMoCL.PERIOD_WEEK:
+            start = day - timedelta(days=day.weekday())
+            return [start + timedelta(days=i) for i in range(7)]
+        start = day.replace(day=1)
+        end = (start + timedelta(days=32)).replace(day=1)
+        return [start + timedelta(days=i) for i in range((end - start).days)]
+
+    def complete_periods(self, period, today: date) -> list:
+        """Ended periods with summaries of all their days
+
+        :return: list of first days of periods
+        """
+        periods = []
+        available = set(self.days())
+        for day in sorted(available):
+            days = self.period_days(period, day)
+            if days[0] not in periods and days[-1] < today and available.issuperset(days):
+                periods.append(days[0])
+        return periods
+
+    def estimator(self, table: ClassificationTable, days) -> PriorProbabilityEstimator:
+        """Estimator of unique keys of days"""
+        entries = np.concatenate([np.load(self.summary_path(day)) for day in days])
+        _, first = np.unique(entries["fingerprint"], return_index=True)
+        estimator = PriorProbabilityEstimator(table)
+        estimator.add_codes(entries["code"][first])
+        return estimator
+
+    def obsolete_days(self, today: date, pending) -> list:
+        """Days whose week and month have ended and are not pending
+
+        :param today:   Current day
+        :param pending: Set of tuples (period, first day) of periods still to be uploaded
+        """
+        obsolete = []
+        for day in self.days():
+            periods = [(period, self.period_days(period, day)) for period in self.PERIODS]
+            if all(days[-1] < today and (period, days[0]) not in pending for period, days in periods):
+                obsolete.append(day)
+        return obsolete
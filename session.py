@@ -0,0 +1,33 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class Session(requests.Session):
+    """HTTP session shared by API clients
+
+    Connections are pooled per host, idempotent requests are retried with an exponential backoff
+    on 429 and 5xx responses and every request has a default timeout.
+    """
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, retries=3, backoff_factor=0.5, timeout=60, pool_size=10):
+        """
+        :param retries:        Number of retries of a failed request
+        :param backoff_factor: Backoff factor in seconds, n-th retry waits backoff_factor * 2^(n-1)
+        :param timeout:        Default connect and read timeout in seconds
+        :param pool_size:      Number of kept connections per host, at least the number of threads using a host
+        """
+        super().__init__()
+        self.timeout = timeout
+        retry = Retry(total=retries, connect=retries, read=retries, status=retries,
+                      backoff_factor=backoff_factor, status_forcelist=self.RETRY_STATUSES,
+                      respect_retry_after_header=True, raise_on_status=False)
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
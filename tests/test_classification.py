@@ -0,0 +1,151 @@
+import json
+
+import numpy as np
+import pytest
+
+from classification import ClassificationError, ClassificationTable, PriorProbabilityEstimator, Transformation, nnls
+from dataset import Key
+
+MOD3 = [{"transform": "n", "transformationId": "RemainderFromDivision", "options": {"divisor": 3}}]
+
+
+def write_table(path, identifications, table, max_distance=0.02, weights=None):
+    content = {"date": "01-01-2024 00:00:00", "groups": {"maxEuclideanDistance": max_distance},
+               "weights": weights or {}, "identifications": identifications, "table": table}
+    with open(str(path), "w") as fp:
+        json.dump(content, fp)
+    return str(path)
+
+
+@pytest.fixture
+def mixture_table(tmp_path):
+    """Three sources with mask distributions of n mod 3: (0, .5, .5), (0, .75, .25) and (.5, .5, 0)"""
+    return ClassificationTable(write_table(tmp_path / "table.json", MOD3, {
+        "A": {"1": 1, "2": 1}, "B": {"1": 3, "2": 1}, "C": {"0": 1, "1": 1}}))
+
+
+def keys_with_remainders(counts):
+    """Keys with given numbers of moduli by their remainder modulo 3"""
+    return [Key("test", 3 * (i + 100) + remainder, 65537) for remainder, count in counts.items()
+            for i in range(count)]
+
+
+def test_nnls_matches_hand_computed_solutions():
+    assert np.allclose(nnls(np.eye(2), np.array([1.0, -1.0])), [1, 0])
+    # Unconstrained solution (2, -1), with x2 = 0 the best x1 is the mean of 2 and 1
+    assert np.allclose(nnls(np.array([[1.0, 0.0], [1.0, 1.0]]), np.array([2.0, 1.0])), [1.5, 0])
+    assert np.allclose(nnls(np.array([[1.0, 0.0], [0.0, 2.0], [1.0, 1.0]]), np.array([1.0, 2.0, 2.0])), [1, 1])
+
+
+def test_estimation_of_known_mixture(mixture_table):
+    # 0.5 A + 0.25 B + 0.25 C gives mask probabilities (0.125, 0.5625, 0.3125)
+    estimator = PriorProbabilityEstimator(mixture_table)
+    for key in keys_with_remainders({0: 200, 1: 900, 2: 500}):
+        estimator.add_key(key)
+
+    estimation = json.loads(json.dumps(estimator.to_json()))
+    assert list(estimation) == ["probability", "frequencies", "groups"]
+    assert estimation["groups"] == {"Group 1": ["A"], "Group 2": ["B"], "Group 3": ["C"]}
+    assert estimation["frequencies"] == {"0": 200, "1": 900, "2": 500}
+    assert list(estimation["probability"]) == ["Group 1", "Group 2", "Group 3"]
+    assert np.allclose(list(estimation["probability"].values()), [0.5, 0.25, 0.25])
+
+
+def test_estimation_without_keys_is_uniform(mixture_table):
+    probability = PriorProbabilityEstimator(mixture_table).compute_prior_probability()
+    assert np.allclose(list(probability.values()), [1 / 3] * 3)
+
+
+def test_close_sources_are_grouped(tmp_path):
+    table = ClassificationTable(write_table(tmp_path / "table.json", MOD3, {
+        "A": {"1": 1, "2": 1}, "B": {"1": 101, "2": 100}, "C": {"0": 1}}))
+    assert table.groups == {"Group 1": ["A", "B"], "Group 2": ["C"]}
+
+
+def test_histogram_round_trip(tmp_path, mixture_table):
+    estimator = PriorProbabilityEstimator(mixture_table)
+    for key in keys_with_remainders({0: 3, 1: 10, 2: 7}):
+        estimator.add_key(key)
+    path = estimator.save_histogram(str(tmp_path / "ct-2024-01-01"), "ct", "day", "2024-01-01")
+    with open(path) as fp:
+        histogram = json.load(fp)
+
+    assert {k: histogram[k] for k in ("source", "period", "date", "table")} == \
+        {"source": "ct", "period": "day", "date": "2024-01-01", "table": mixture_table.hash}
+    restored = PriorProbabilityEstimator.from_histogram(mixture_table, histogram)
+    assert restored.to_json() == estimator.to_json()
+
+    histogram["identifications"] = [dict(MOD3[0], options={"divisor": 5})]
+    with pytest.raises(ClassificationError):
+        PriorProbabilityEstimator.from_histogram(mixture_table, histogram)
+
+
+@pytest.mark.parametrize("identification", [
+    {"transform": "n", "transformationId": "RemainderFromDivision", "options": {"divisor": 3}},
+    {"transform": "n", "transformationId": "RemainderFromDivision", "options": {"divisor": 65537}},
+    {"transform": "e", "transformationId": "RemainderFromDivision", "options": {"divisor": 7}},
+    {"transform": "nblen", "transformationId": "RemainderFromDivision", "options": {"divisor": 2}},
+    {"transform": "n", "transformationId": "LeastSignificantBits", "options": {"bits": 1, "skip": 1}},
+    {"transform": "n", "transformationId": "LeastSignificantBits", "options": {"bits": 16, "skip": 24}},
+    {"transform": "e", "transformationId": "LeastSignificantBits", "options": {"bits": 5}},
+    {"transform": "n", "transformationId": "MostSignificantBits", "options": {"bits": 6, "skip": 1}},
+    {"transform": "n", "transformationId": "MostSignificantBits", "options": {"bits": 16, "skip": 30}},
+    {"transform": "e", "transformationId": "MostSignificantBits", "options": {"bits": 4}},
+    {"transform": "nblen", "transformationId": "MostSignificantBits", "options": {"bits": 3, "skip": 1}},
+])
+def test_vectorized_mask_codes_match_scalar_masks(tmp_path, identification):
+    mask = Transformation(identification).format(0)
+    table = ClassificationTable(write_table(tmp_path / "table.json", [identification], {"A": {mask: 1}}))
+    random = np.random.default_rng(7)
+    # Lengths around limb boundaries and keys shorter than the window of most significant bits
+    lengths = [1, 2, 5, 20, 63, 64, 65, 127, 128, 129, 512, 1024, 2047, 2048, 4096]
+    lengths += [int(length) for length in random.integers(1, 4200, 200)]
+    keys = []
+    for length in lengths:
+        n = int.from_bytes(random.bytes(length // 8 + 1), "big") % (1 << length) | (1 << (length - 1))
+        e = random.choice([3, 65537, int(random.integers(1, 1 << 62)) * (1 << 70) + 1])
+        keys.append(Key("test", n, int(e)))
+
+    expected = [table.mask_code(table.mask(key.n, key.e)) for key in keys]
+    assert table.mask_codes(keys).tolist() == expected
+
+
+def test_vectorized_mask_codes_of_real_table():
+    table = ClassificationTable("classification-table.json")
+    random = np.random.default_rng(11)
+    keys = [Key("test", int.from_bytes(random.bytes(length // 8), "big") | 1, 65537)
+            for length in random.choice([512, 1024, 2048, 3072, 4096], 500)]
+    expected = [table.mask_code(table.mask(key.n, key.e)) for key in keys]
+    assert table.mask_codes(keys).tolist() == expected
+
+
+def compiled(table):
+    return (table.identifications, table.max_distance, table.sources, table.masks, dict(table.groups),
+            table.source_matrix.tolist(), table.source_weights.tolist(), table.matrix.tolist())
+
+
+def test_cached_table_is_same_as_compiled(tmp_path, monkeypatch):
+    path = write_table(tmp_path / "table.json", MOD3, {"A": {"1": 1, "2": 1}, "B": {"1": 3, "2": 1}},
+                       weights={"B": 2})
+    cache = tmp_path / "cache"
+    table = ClassificationTable(path, str(cache))
+    assert [file.name for file in cache.iterdir()] == [ClassificationTable.CACHE_PREFIX + table.hash[:16] + ".npz"]
+
+    monkeypatch.setattr(ClassificationTable, "compile", lambda self, content: pytest.fail("Cache was not used"))
+    cached = ClassificationTable(path, str(cache))
+    assert compiled(cached) == compiled(table)
+    keys = keys_with_remainders({0: 2, 1: 3, 2: 4})
+    assert cached.mask_codes(keys).tolist() == table.mask_codes(keys).tolist()
+
+
+def test_changed_table_invalidates_cache(tmp_path):
+    path = write_table(tmp_path / "table.json", MOD3, {"A": {"1": 1, "2": 1}, "B": {"1": 3, "2": 1}})
+    cache = tmp_path / "cache"
+    table = ClassificationTable(path, str(cache))
+    write_table(path, MOD3, {"A": {"1": 1, "2": 1}, "B": {"0": 1, "2": 1}})
+
+    changed = ClassificationTable(path, str(cache))
+    assert changed.hash[:16] != table.hash[:16]
+    assert len(list(cache.iterdir())) == 2
+    assert changed.masks == ["0", "1", "2"]
+    assert changed.source_matrix.tolist() == [[0, 0.5, 0.5], [0.5, 0, 0.5]]
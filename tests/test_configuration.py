@@ -0,0 +1,22 @@
+import json
+
+from configuration import Configuration
+
+
+def configuration(tmp_path, monkeypatch, content):
+    monkeypatch.chdir(tmp_path)
+    with open(Configuration.CONFIGURATION_PATH, "w") as fp:
+        json.dump(content, fp)
+    return Configuration()
+
+
+def test_http_pool_size_covers_workers_of_logs_on_one_host(tmp_path, monkeypatch):
+    conf = configuration(tmp_path, monkeypatch, {"ct-workers": 8, "rapid7-connections": 4, "ct-logs": [
+        {"url": "ct.googleapis.com/logs/argon2024"}, {"url": "https://ct.googleapis.com/logs/xenon2024"},
+        {"url": "oak.ct.letsencrypt.org/2024h1", "workers": 12}]})
+    assert conf.get_http_pool_size() == 16
+
+    conf = configuration(tmp_path, monkeypatch, {"ct-log-url": "ct.googleapis.com/rocketeer", "ct-workers": 4,
+                                                 "rapid7-connections": 16})
+    assert conf.get_http_pool_size() == 17
+    assert configuration(tmp_path, monkeypatch, {}).get_http_pool_size() == 10
@@ -0,0 +1,282 @@
+import base64
+import json
+import os
+import struct
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+from benchmark import SyntheticData
+import ct as ct_module
+from ct import CertificateTransparency
+from journal import Journal
+from session import Session
+
+ENTRIES = 95
+MAX_BATCH = 7
+
+
+def log_entry(certificate, timestamp, precertificate=False):
+    """Entry of get-entries, a precertificate is stored only in extra data as in real logs"""
+    length = len(certificate).to_bytes(3, "big")
+    if precertificate:
+        leaf = struct.pack(">BBQH", 0, 0, timestamp, CertificateTransparency.ENTRY_PRECERT) + bytes(32) + \
+            length + certificate + bytes(2)
+        extra_data = length + certificate + bytes(3)
+    else:
+        leaf = struct.pack(">BBQH", 0, 0, timestamp, CertificateTransparency.ENTRY_X509) + length + \
+            certificate + bytes(2)
+        extra_data = bytes(3)
+    return {"leaf_input": base64.b64encode(leaf).decode("ascii"),
+            "extra_data": base64.b64encode(extra_data).decode("ascii")}
+
+
+@pytest.fixture(scope="module")
+def log():
+    """Entries of a stand-in log with keys of SyntheticData, every fifth one is a precertificate"""
+    data = SyntheticData(ENTRIES, duplicate_ratio=0.1, days=2)
+    keys, entries = [], []
+    for record, index in data.indices():
+        key = data.key(index)
+        timestamp = data.timestamp(record)
+        certificate = SyntheticData.certificate(key.n, key.e, key.source[0], data.start + timedelta(days=1))
+        entries.append(log_entry(certificate, timestamp, record % 5 == 0))
+        keys.append((key, timestamp))
+    return keys, entries
+
+
+def log_handler(entries, failing=()):
+    """Handler of a stand-in CT log returning at most MAX_BATCH entries per get-entries
+
+    :param failing: Set of entries, get-entries starting inside [from, to) of a range fail with 500
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        requests = []
+        failing_ranges = list(failing)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == "/ct/v1/get-sth":
+                self.send_json(200, {"tree_size": len(entries), "timestamp": 0})
+            elif url.path == "/ct/v1/get-entries":
+                query = parse_qs(url.query)
+                start, end = int(query["start"][0]), int(query["end"][0])
+                self.requests.append((start, end))
+                if any(first <= start < last for first, last in self.failing_ranges):
+                    self.send_json(500, {"error": "unavailable"})
+                else:
+                    self.send_json(200, {"entries": entries[start:min(end + 1, start + MAX_BATCH)]})
+            else:
+                self.send_json(404, {})
+
+        def send_json(self, status, content):
+            body = json.dumps(content).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def client(url):
+    return CertificateTransparency(url, Session(retries=0), batch_size=10)
+
+
+def read_lines(path):
+    with open(path) as fp:
+        return [json.loads(line) for line in fp]
+
+
+def assert_keys(lines, keys):
+    assert [(int(line["n"], 16), line["timestamp"]) for line in lines] == [(k.n, ts) for k, ts in keys]
+
+
+def test_get_sth_and_entries(http_server, log):
+    keys, entries = log
+    ct = client(http_server(log_handler(entries)))
+
+    assert ct.get_log_size() == ENTRIES
+    assert len(list(ct.entries(3, 40))) == 37
+    assert CertificateTransparency.parse_entry(entries[5])[0] == keys[5][1]
+
+
+def test_download_converts_entries_in_order(tmp_path, http_server, log):
+    keys, entries = log
+    out_path = str(tmp_path / "0-30.json")
+
+    assert client(http_server(log_handler(entries))).download(0, 30, out_path)
+    assert_keys(read_lines(out_path), keys[:30])
+
+
+def test_download_sharded_merges_shards(tmp_path, http_server, log):
+    keys, entries = log
+    out_dir, shards_path = tmp_path / "temporary", str(tmp_path / "shards")
+    out_dir.mkdir()
+    journal = Journal(str(tmp_path / "journal.json"))
+
+    completed = client(http_server(log_handler(entries))).download_sharded(
+        0, ENTRIES, str(out_dir), shards_path, shard_size=20, workers=3, retries=0, journal=journal)
+    assert completed == ENTRIES
+    assert os.listdir(str(out_dir)) == ["0-%d.json" % ENTRIES]
+    assert_keys(read_lines(str(out_dir / ("0-%d.json" % ENTRIES))), keys)
+    assert os.listdir(shards_path) == []
+    assert journal.downloaded_until(0) == ENTRIES
+
+
+def test_download_sharded_keeps_shards_after_failed_one(tmp_path, http_server, log):
+    keys, entries = log
+    out_dir, shards_path = tmp_path / "temporary", str(tmp_path / "shards")
+    out_dir.mkdir()
+    journal_path = str(tmp_path / "journal.json")
+    failing = log_handler(entries, failing=[(40, 60)])
+
+    completed = client(http_server(failing)).download_sharded(
+        0, ENTRIES, str(out_dir), shards_path, shard_size=20, workers=3, retries=1, journal=Journal(journal_path))
+    assert completed == 40
+    assert sorted(os.listdir(shards_path)) == ["60-80.json", "80-95.json"]
+    assert len([r for r in failing.requests if r[0] == 40]) == 2
+
+    # Next run downloads only the failed shard and reuses the kept ones
+    handler = log_handler(entries)
+    journal = Journal(journal_path)
+    completed = client(http_server(handler)).download_sharded(
+        journal.downloaded_until(0), ENTRIES, str(out_dir), shards_path, shard_size=20, workers=3, retries=0,
+        journal=journal)
+    assert completed == ENTRIES
+    assert all(40 <= start < 60 for start, _ in handler.requests)
+    assert sorted(os.listdir(str(out_dir))) == ["0-40.json", "40-%d.json" % ENTRIES]
+    assert_keys(read_lines(str(out_dir / "0-40.json")) + read_lines(str(out_dir / ("40-%d.json" % ENTRIES))), keys)
+    assert journal.downloaded_until(0) == ENTRIES
+
+
+class Crash(Exception):
+    pass
+
+
+@pytest.fixture
+def temporary(tmp_path):
+    """Directory with two temporary files of synthetic CT lines spread over three days"""
+    path = tmp_path / "temporary"
+    path.mkdir()
+    for i, name in enumerate(["0-400.json", "400-700.json"]):
+        SyntheticData(400 - 100 * i, days=3, seed=i + 1).write_ct(str(path / name))
+    return path
+
+
+def bucket_without_crash(tmp_path, temporary):
+    days = tmp_path / "expected-days"
+    days.mkdir()
+    copy = tmp_path / "expected-temporary"
+    copy.mkdir()
+    for f in os.listdir(str(temporary)):
+        with open(str(temporary / f), "rb") as fp, open(str(copy / f), "wb") as fop:
+            fop.write(fp.read())
+    CertificateTransparency.process_temporary(str(copy), str(days))
+    return read_days(days)
+
+
+def read_days(path):
+    result = {}
+    for f in os.listdir(str(path)):
+        with open(str(path / f), "rb") as fp:
+            result[f] = fp.read()
+    return result
+
+
+def crash_after(monkeypatch, owner, name, calls):
+    """Let a function of owner run `calls` times and raise Crash on the next call"""
+    original = getattr(owner, name)
+    counter = {"calls": 0}
+
+    def patched(*args, **kwargs):
+        counter["calls"] += 1
+        if counter["calls"] > calls:
+            raise Crash()
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr(owner, name, patched)
+
+
+def test_process_temporary_resumes_from_checkpoint(tmp_path, temporary, monkeypatch):
+    expected = bucket_without_crash(tmp_path, temporary)
+    days = tmp_path / "days"
+    days.mkdir()
+    journal_path = str(tmp_path / "journal.json")
+    monkeypatch.setattr(CertificateTransparency, "CHECKPOINT_LINES", 50)
+
+    # Crash in the second file after lines following its last checkpoint were written
+    with monkeypatch.context() as m:
+        crash_after(m, ct_module.DayWriters, "write", 400 + 170)
+        with pytest.raises(Crash):
+            CertificateTransparency.process_temporary(str(temporary), str(days), Journal(journal_path))
+    assert os.listdir(str(temporary)) == ["400-700.json"]
+    journal = Journal(journal_path)
+    offset, _ = journal.bucketing_checkpoint("400-700.json")
+    assert offset > 0
+
+    lines = CertificateTransparency.process_temporary(str(temporary), str(days), journal)
+    assert lines == 300 - 150
+    assert read_days(days) == expected
+    assert os.listdir(str(temporary)) == []
+    assert journal.bucketing_checkpoint("400-700.json") is None
+
+
+def test_resumed_bucketing_keeps_day_files_of_other_writers(tmp_path, temporary, monkeypatch):
+    expected = bucket_without_crash(tmp_path, temporary)
+    days = tmp_path / "days"
+    days.mkdir()
+    (days / "1999-12-31.json").write_bytes(b"old\n")
+    journal_path = str(tmp_path / "journal.json")
+    monkeypatch.setattr(CertificateTransparency, "CHECKPOINT_LINES", 50)
+
+    with monkeypatch.context() as m:
+        crash_after(m, ct_module.DayWriters, "write", 400 + 170)
+        with pytest.raises(Crash):
+            CertificateTransparency.process_temporary(str(temporary), str(days), Journal(journal_path))
+    # Another writer of the days directory before the interrupted file is resumed
+    with open(str(days / "1999-12-31.json"), "ab") as fp:
+        fp.write(b"appended\n")
+    (days / "2000-01-01.json").write_bytes(b"new\n")
+
+    CertificateTransparency.process_temporary(str(temporary), str(days), Journal(journal_path))
+    expected.update({"1999-12-31.json": b"old\nappended\n", "2000-01-01.json": b"new\n"})
+    assert read_days(days) == expected
+
+
+def test_process_temporary_repeats_interrupted_merge_of_buckets(tmp_path, temporary, monkeypatch):
+    expected = bucket_without_crash(tmp_path, temporary)
+    days = tmp_path / "days"
+    days.mkdir()
+    journal_path = str(tmp_path / "journal.json")
+
+    # Crash in the second file after its first bucketed day was appended to day files
+    copyfileobj = ct_module.shutil.copyfileobj
+    copied = []
+
+    def copy_and_crash(fp, fop):
+        if "400-700" in fp.name:
+            if copied:
+                raise Crash()
+            copied.append(fp.name)
+        copyfileobj(fp, fop)
+
+    with monkeypatch.context() as m:
+        m.setattr(ct_module.shutil, "copyfileobj", copy_and_crash)
+        with pytest.raises(Crash):
+            CertificateTransparency.process_temporary(str(temporary), str(days), Journal(journal_path), workers=2)
+    buckets = "400-700.json" + CertificateTransparency.BUCKETS_SUFFIX
+    assert sorted(os.listdir(str(temporary))) == ["400-700.json", buckets]
+    assert Journal(journal_path).bucketing_checkpoint("400-700.json") is not None
+
+    journal = Journal(journal_path)
+    CertificateTransparency.process_temporary(str(temporary), str(days), journal, workers=2)
+    assert read_days(days) == expected
+    assert os.listdir(str(temporary)) == []
@@ -0,0 +1,72 @@
+from datetime import datetime, timezone
+
+import pytest
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from cryptography.x509.oid import NameOID
+
+from benchmark import SyntheticData
+from der import Der, DerError
+from rapid7 import Rapid7
+
+RSA_KEY = rsa.generate_private_key(public_exponent=65537, key_size=1024)
+EC_KEY = ec.generate_private_key(ec.SECP256R1())
+
+
+def certificate(attributes, not_before=datetime(2021, 3, 4, tzinfo=timezone.utc), key=RSA_KEY):
+    """Self-signed DER certificate with a subject of (OID, value) attributes"""
+    name = x509.Name([x509.NameAttribute(oid, value) for oid, value in attributes])
+    builder = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key()) \
+        .serial_number(1).not_valid_before(not_before).not_valid_after(datetime(2051, 1, 1, tzinfo=timezone.utc))
+    return builder.sign(RSA_KEY, hashes.SHA256()).public_bytes(serialization.Encoding.DER)
+
+
+CERTIFICATES = {
+    "utf-8 cn": certificate([(NameOID.COMMON_NAME, "Příliš žluťoučký kůň.cz")]),
+    "missing cn": certificate([(NameOID.ORGANIZATION_NAME, "Example")]),
+    "multiple cn": certificate([(NameOID.COMMON_NAME, "first.example"), (NameOID.COMMON_NAME, "second.example")]),
+    "utc time 1999": certificate([(NameOID.COMMON_NAME, "old.example")], datetime(1999, 12, 31, tzinfo=timezone.utc)),
+    "utc time 2000": certificate([(NameOID.COMMON_NAME, "new.example")], datetime(2000, 1, 1, tzinfo=timezone.utc)),
+    "generalized time": certificate([(NameOID.COMMON_NAME, "future.example")],
+                                    datetime(2050, 6, 1, tzinfo=timezone.utc)),
+    "ec key": certificate([(NameOID.COMMON_NAME, "ec.example")], key=EC_KEY),
+}
+
+
+@pytest.mark.parametrize("name", sorted(CERTIFICATES))
+def test_fast_path_matches_cryptography(name, monkeypatch):
+    der = CERTIFICATES[name]
+    expected = Rapid7.Converter.certificate_key_x509(der)
+
+    # The fast path must handle these certificates without falling back
+    monkeypatch.setattr(Rapid7.Converter, "certificate_key_x509", staticmethod(lambda cert_bin: pytest.fail()))
+    key = Rapid7.Converter.certificate_key(der)
+    if expected is None:
+        assert key is None
+    else:
+        assert key.get_as_string() == expected.get_as_string()
+
+
+def test_malformed_time_falls_back_to_cryptography(monkeypatch):
+    der = CERTIFICATES["utc time 2000"]
+    damaged = der.replace(b"000101000000Z", b"0a0101000000Z", 1)
+    assert damaged != der
+    with pytest.raises(DerError):
+        Der.parse_certificate(damaged)
+
+    calls = []
+    monkeypatch.setattr(Rapid7.Converter, "certificate_key_x509", staticmethod(lambda cert_bin: calls.append(cert_bin)))
+    Rapid7.Converter.certificate_key(damaged)
+    assert calls == [damaged]
+
+
+def test_public_key_info_without_key_raises_der_error():
+    der = SyntheticData.der
+    algorithm = der(0x30, der(0x06, Der.RSA_ENCRYPTION) + der(0x05, b""))
+    name = SyntheticData.der_name("short.example")
+    validity = der(0x30, der(0x17, b"240101000000Z") + der(0x17, b"491231235959Z"))
+    tbs = der(0x30, der(0xa0, SyntheticData.der_integer(2)) + SyntheticData.der_integer(1) + algorithm + name +
+              validity + name + der(0x30, algorithm))
+    with pytest.raises(DerError):
+        Der.parse_certificate(der(0x30, tbs + algorithm + der(0x03, b"\x00")))
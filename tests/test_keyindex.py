@@ -0,0 +1,36 @@
+import numpy as np
+
+from classification import ClassificationTable
+from dataset import Key
+from keyindex import KeyIndex
+
+
+def append_keys(path, numbers):
+    with open(path, "a") as fp:
+        for n in numbers:
+            fp.write(Key("test", n, 65537).get_as_string() + "\n")
+
+
+def test_updates_index_appended_unique_keys(tmp_path, monkeypatch):
+    monkeypatch.setattr(KeyIndex, "BATCH_SIZE", 16)
+    monkeypatch.setattr(KeyIndex, "MAX_RUNS", 2)
+    table = ClassificationTable("classification-table.json")
+    path = str(tmp_path / "keys.json")
+    index = KeyIndex(str(tmp_path / "index"))
+    added = []
+    for numbers in [range(1001, 1101, 2), range(1051, 1151, 2), range(1001, 1021, 2), range(2001, 2041, 2)]:
+        append_keys(path, numbers)
+        added.append(KeyIndex(index.path).update(path, table))
+
+    assert added == [50, 25, 0, 20]
+    index = KeyIndex(index.path)
+    assert index.state["keys"] == 95 and index.state["occurrences"] == 130
+    assert len(index.state["runs"]) <= 2
+    for run in index.load_runs():
+        assert run["fingerprint"].dtype == np.uint64 and run["fingerprint"].flags["C_CONTIGUOUS"]
+    classified = index.classified()
+    assert classified.dtype == KeyIndex.ENTRY and len(classified) == 95
+    assert np.all(classified["fingerprint"][1:] > classified["fingerprint"][:-1])
+    expected = sorted(int(Key("test", n, 65537).fingerprint(), 16)
+                      for n in list(range(1001, 1151, 2)) + list(range(2001, 2041, 2)))
+    assert classified["fingerprint"].tolist() == expected
@@ -0,0 +1,189 @@
+import json
+import os
+import shutil
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+
+from benchmark import SyntheticData
+from classification import PriorProbabilityEstimator
+from configuration import Configuration
+from ct import DayWriters
+from pipeline import Pipeline
+from test_ct import crash_after, log_entry, log_handler
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def log_entries(records, seed):
+    """Entries of a stand-in log with unique keys spread over two days"""
+    data = SyntheticData(records, duplicate_ratio=0, days=2, seed=seed)
+    entries = []
+    for record, index in data.indices():
+        key = data.key(index)
+        certificate = SyntheticData.certificate(key.n, key.e, key.source[0], data.start + timedelta(days=1))
+        entries.append(log_entry(certificate, data.timestamp(record)))
+    return entries
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    """Working directory of the pipeline with the classification table"""
+    shutil.copy(os.path.join(REPOSITORY, "classification-table.json"), str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def configure(logs):
+    with open(Configuration.CONFIGURATION_PATH, "w") as fp:
+        json.dump({"cmocl-api-url": "http://127.0.0.1:1", "cmocl-api-key": "", "ct-logs": logs,
+                   "ct-shard-size": 40, "ct-workers": 2, "ct-retries": 0, "ct-batch-size": 16,
+                   "http-retries": 0}, fp)
+    return Configuration()
+
+
+def day_lines():
+    lines = 0
+    for f in os.listdir(Pipeline.CT_DAYS_PATH):
+        with open(os.path.join(Pipeline.CT_DAYS_PATH, f)) as fp:
+            lines += sum(1 for _ in fp)
+    return lines
+
+
+def test_logs_are_downloaded_into_shared_days(workspace, http_server):
+    first = log_entries(100, 1)
+    # The second log repeats 50 entries of the first one
+    second = first[50:] + log_entries(50, 2)
+    urls = [http_server(log_handler(first)), http_server(log_handler(second))]
+    conf = configure([{"url": urls[0]}, {"url": urls[1], "workers": 1}])
+
+    pipeline = Pipeline(conf)
+    pipeline.poll_ct()
+
+    assert day_lines() == 200
+    assert sum(index.statistics()["keys"] for index in pipeline.indexes.values()) == 150
+    assert [log["last-entry"] for log in Configuration().get(Configuration.CONF_CT_LOGS)] == [100, 100]
+    for log in pipeline.ct_logs:
+        assert os.listdir(log["temporary_path"]) == []
+
+
+def test_failed_log_does_not_hold_back_others(workspace, http_server):
+    first = log_entries(100, 1)
+    urls = [http_server(log_handler(first)), http_server(log_handler(log_entries(50, 2), failing=[(0, 50)]))]
+    conf = configure([{"url": urls[0]}, {"url": urls[1]}])
+
+    Pipeline(conf).poll_ct()
+
+    assert day_lines() == 100
+    assert [log.get("last-entry", 0) for log in Configuration().get(Configuration.CONF_CT_LOGS)] == [100, 0]
+
+
+def cmocl_handler(stored=()):
+    """Handler of a stand-in CMoCL API accepting every upload and replacement
+
+    :param stored: Dates of stored CT day records
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        uploads = []
+        replaced = []
+
+        def do_GET(self):
+            body = json.dumps(list(stored) if self.path == "/ct/day" else []).encode()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            self.uploads.append(json.loads(self.rfile.read(int(self.headers["Content-Length"]))))
+            self.send_response(201)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_PUT(self):
+            self.replaced.append((self.path, json.loads(self.rfile.read(int(self.headers["Content-Length"])))))
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def test_classified_days_are_uploaded_from_memory(workspace, http_server):
+    handler = cmocl_handler()
+    conf = configure([])
+    conf.conf["cmocl-api-url"] = http_server(handler)
+    conf.conf["cmocl-api-key"] = "key"
+    pipeline = Pipeline(conf)
+    pipeline.prepare_ct()
+    days = []
+    for day in (date(2024, 1, 1), date(2024, 1, 2)):
+        open(os.path.join(Pipeline.CT_DAYS_PATH, day.isoformat() + ".json"), "w").close()
+        days.append((day.isoformat() + ".json", day, "missing/prior_probability.json", {"day": day.isoformat()}))
+
+    pipeline.upload_ct_days(days)
+
+    assert sorted(upload["estimation"]["day"] for upload in handler.uploads) == ["2024-01-01", "2024-01-02"]
+    assert os.listdir(Pipeline.CT_DAYS_PATH) == []
+
+
+def stored_estimation(pipeline, day):
+    """Estimation of a CT day stored with a histogram of another classification table"""
+    path = os.path.join(pipeline.storage_path, "ct-" + day + ".json")
+    estimator = PriorProbabilityEstimator(pipeline.classification_table)
+    data = SyntheticData(200, seed=3)
+    for _, index in data.indices():
+        estimator.add_key(data.key(index))
+    estimator.save_histogram(path, "ct", "day", day)
+    with open(os.path.join(path, PriorProbabilityEstimator.HISTOGRAM_FILE)) as fp:
+        histogram = json.load(fp)
+    histogram["table"] = "previous"
+    with open(os.path.join(path, PriorProbabilityEstimator.HISTOGRAM_FILE), "w") as fp:
+        json.dump(histogram, fp)
+    with open(os.path.join(path, PriorProbabilityEstimator.OUTPUT_FILE), "w") as fp:
+        json.dump({"probability": {}}, fp)
+    return os.path.join(path, PriorProbabilityEstimator.HISTOGRAM_FILE)
+
+
+@pytest.mark.parametrize("replace", [False, True])
+def test_reestimation_replaces_stored_records_only_when_enabled(workspace, http_server, replace):
+    handler = cmocl_handler(stored=["2024-01-01"])
+    conf = configure([])
+    conf.conf.update({"cmocl-api-url": http_server(handler), "cmocl-api-key": "key", "cmocl-replace": replace})
+    pipeline = Pipeline(conf)
+    stored = stored_estimation(pipeline, "2024-01-01")
+    missing = stored_estimation(pipeline, "2024-01-02")
+
+    pipeline.reestimate()
+
+    assert [upload["date"] for upload in handler.uploads] == ["2024-01-02"]
+    assert [path for path, _ in handler.replaced] == (["/ct/day/2024-01-01"] if replace else [])
+    for path, reestimated in ((stored, replace), (missing, True)):
+        with open(path) as fp:
+            assert (json.load(fp)["table"] == pipeline.classification_table.hash) == reestimated
+
+
+def test_interrupted_bucketing_of_log_keeps_lines_of_other_logs(workspace, http_server, monkeypatch):
+    first, second = log_entries(100, 1), log_entries(100, 2)
+    urls = [http_server(log_handler(first)), http_server(log_handler(second))]
+    conf = configure([{"url": urls[0]}, {"url": urls[1]}])
+
+    # Crash while the second log is bucketed, after the first log has appended all its lines
+    with monkeypatch.context() as m:
+        crash_after(m, DayWriters, "write", 100 + 60)
+        pipeline = Pipeline(conf)
+        pipeline.poll_ct()
+    assert pipeline.ct_logs[1]["journal"].is_bucketing()
+
+    # Both logs grow before the next run, so the first one has new lines for the same days
+    first += log_entries(50, 3)
+    second += log_entries(50, 4)
+    Pipeline(Configuration()).poll_ct()
+
+    assert day_lines() == 300
+    assert [log["last-entry"] for log in Configuration().get(Configuration.CONF_CT_LOGS)] == [150, 150]
@@ -0,0 +1,143 @@
+import gzip
+import hashlib
+import json
+import os
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+
+from benchmark import SyntheticData
+from rapid7 import Rapid7, Rapid7Error
+from session import Session
+
+DATA_NAME = "20240101_443_certs.gz"
+
+
+def data_set_handler(content, failures=()):
+    """Handler of Rapid7 API serving one data set with range requests
+
+    :param content:  Bytes of the data set
+    :param failures: Failures of the following requests of the data set, one per request, tuples
+                     ("drop", position) cut the response at position, ("status", code) answer an error
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        ranges = []
+        pending = list(failures)
+
+        def do_GET(self):
+            if self.path.endswith("/download/"):
+                self.send_body(200, json.dumps({"url": "http://%s:%d/file" % self.server.server_address}).encode())
+                return
+            byte_range = self.headers.get("Range")
+            self.ranges.append(byte_range)
+            failure, value = self.pending.pop(0) if self.pending else (None, None)
+            if failure == "status":
+                self.send_body(value, b"")
+                return
+            start, end = 0, len(content)
+            if byte_range is not None:
+                first, last = byte_range[len("bytes="):].split("-")
+                start, end = int(first), int(last) + 1 if last else len(content)
+                if start >= len(content):
+                    self.send_response(416)
+                    self.send_header("Content-Range", "bytes */%d" % len(content))
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end - 1, len(content)))
+            else:
+                self.send_response(200)
+            self.send_header("Content-Length", str(end - start))
+            self.end_headers()
+            body = content[start:end]
+            if failure == "drop":
+                body = body[:max(0, value - start)]
+            self.wfile.write(body)
+            self.close_connection = True
+
+        def send_body(self, status, body):
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+@pytest.fixture(scope="module")
+def data_set(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("rapid7") / "certs")
+    SyntheticData(300, duplicate_ratio=0.2).write_rapid7(path)
+    with open(path, "rb") as fp:
+        return gzip.compress(fp.read())
+
+
+def client(url, connections=1):
+    rapid7 = Rapid7("key", Session(retries=0), chunk_size=4096, connections=connections, decompressor="zlib")
+    rapid7.data_url = url + "/"
+    return rapid7
+
+
+def info(content):
+    return {"size": len(content), "fingerprint": hashlib.sha1(content).hexdigest()}
+
+
+def test_download_resumes_dropped_connection(tmp_path, http_server, data_set):
+    handler = data_set_handler(data_set, failures=[("drop", len(data_set) // 3)])
+    out_path = str(tmp_path / "data.gz")
+    client(http_server(handler)).download(DATA_NAME, out_path, info(data_set))
+
+    with open(out_path, "rb") as fp:
+        assert fp.read() == data_set
+    assert handler.ranges[0] is None
+    assert handler.ranges[1].startswith("bytes=") and 0 < int(handler.ranges[1][6:-1]) <= len(data_set) // 3
+    assert not os.path.exists(out_path + ".part")
+
+
+def test_parallel_download_resumes_dropped_ranges(tmp_path, http_server, data_set):
+    handler = data_set_handler(data_set, failures=[("drop", 0), ("drop", len(data_set) // 4)])
+    out_path = str(tmp_path / "data.gz")
+    client(http_server(handler), connections=3).download(DATA_NAME, out_path, info(data_set))
+
+    with open(out_path, "rb") as fp:
+        assert fp.read() == data_set
+    assert not os.path.exists(out_path + ".part.ranges")
+
+
+def test_process_resumes_partial_download_of_failed_call(tmp_path, http_server, data_set):
+    expected_path = str(tmp_path / "expected")
+    client(http_server(data_set_handler(data_set))).process(DATA_NAME, expected_path, info(data_set))
+
+    half = len(data_set) // 2
+    handler = data_set_handler(data_set, failures=[("drop", half), ("status", 403)])
+    url = http_server(handler)
+    out_path = str(tmp_path / "keys")
+    with pytest.raises(Rapid7Error):
+        client(url).process(DATA_NAME, out_path, info(data_set))
+    downloaded = os.path.getsize(out_path + ".gz.part")
+    assert 0 < downloaded <= half
+    assert not os.path.exists(out_path)
+
+    results = client(url).process(DATA_NAME, out_path, info(data_set), workers=2)
+    assert handler.ranges[-1] == "bytes=%d-" % downloaded
+    assert results["all"] == 300
+    with open(out_path) as fp, open(expected_path) as expected:
+        assert fp.read() == expected.read()
+    assert not os.path.exists(out_path + ".gz.part")
+
+
+def test_download_completes_whole_partial_file_without_info(tmp_path, http_server, data_set):
+    handler = data_set_handler(data_set)
+    out_path = str(tmp_path / "data.gz")
+    with open(out_path + ".part", "wb") as fp:
+        fp.write(data_set)
+    client(http_server(handler)).download(DATA_NAME, out_path)
+
+    with open(out_path, "rb") as fp:
+        assert fp.read() == data_set
+    assert handler.ranges == ["bytes=%d-" % len(data_set)]
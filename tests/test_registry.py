@@ -0,0 +1,48 @@
+import os
+from datetime import date
+
+import numpy as np
+
+from dataset import Key
+from registry import KeyRegistry
+
+
+def keys(start, count):
+    return [Key("test", n, 65537) for n in range(start, start + count)]
+
+
+def test_merged_runs_keep_first_occurrences(tmp_path, monkeypatch):
+    monkeypatch.setattr(KeyRegistry, "MERGE_CHUNK", 7)
+    registry = KeyRegistry(str(tmp_path))
+    days = [date(2024, 1, day) for day in range(1, 7)]
+    for day, (start, count) in zip(days, [(0, 40), (20, 40), (50, 5), (0, 100), (90, 3), (200, 60)]):
+        registry.register(keys(start, count), "ct" if day.day % 2 else "rapid7", day)
+
+    registry = KeyRegistry(str(tmp_path))
+    assert len(registry) == 160
+    assert len(registry.runs) < 6
+    for run in registry.runs:
+        assert run["fingerprint"].flags["C_CONTIGUOUS"]
+        assert np.all(np.diff(run["fingerprint"].astype(np.float64)) >= 0)
+    assert registry.first_seen(Key("test", 10, 65537)) == (days[0], "ct")
+    assert registry.first_seen(Key("test", 55, 65537)) == (days[1], "rapid7")
+    assert registry.first_seen(Key("test", 95, 65537)) == (days[3], "rapid7")
+    assert registry.first_seen(Key("test", 250, 65537)) == (days[5], "rapid7")
+    assert registry.first_seen(Key("test", 300, 65537)) is None
+    assert registry.register(keys(0, 40), "ct", days[0]).all()
+    assert not registry.register(keys(0, 40), "ct", days[2]).any()
+
+
+def test_structured_runs_are_split(tmp_path):
+    fingerprints = KeyRegistry.fingerprints(keys(0, 10))
+    entries = np.zeros(10, dtype=KeyRegistry.ENTRY)
+    entries["fingerprint"] = np.sort(fingerprints)
+    entries["day"] = date(2024, 1, 1).toordinal()
+    np.save(os.path.join(str(tmp_path), "0.npy"), entries)
+    with open(os.path.join(str(tmp_path), KeyRegistry.STATE_FILE), "w") as fp:
+        fp.write('{"runs": [0], "next_run": 1, "sources": ["ct"]}')
+
+    registry = KeyRegistry(str(tmp_path))
+    assert not os.path.exists(os.path.join(str(tmp_path), "0.npy"))
+    assert registry.first_seen(Key("test", 3, 65537)) == (date(2024, 1, 1), "ct")
+    assert not registry.register(keys(5, 10), "ct", date(2024, 1, 2))[:5].any()